@@ -0,0 +1,708 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import asyncpg
+import argparse
+import numpy as np
+import redis.asyncio as redis
+from config import PostgresSettings, RedisSettings
+from candidates import CANDIDATES_SQL, CITY_FILTERS, CURSOR_START, OPPOSITE_GENDER
+from cities import nearest_cities
+from interests import INTEREST_BITS, INTEREST_BYTES, to_matrix, jaccard, blended_scores
+from swipes import record_swipe, enqueue_skip, compact_skips, SkipFlusher, SKIP_STREAM_KEY
+from seen import SEEN_SQL
+from inbound_likes import LIKERS_SQL
+from send_scheduler import SendScheduler, PRIORITY_MATCH, PRIORITY_LOW
+from aiogram.methods import SendMessage
+from aiogram.exceptions import TelegramRetryAfter
+
+# Создаём экземпляры настроек
+postgres_settings = PostgresSettings()
+
+# Все синтетические данные живут в отдельной схеме, рабочие таблицы не затрагиваются
+BENCH_SCHEMA = "bench"
+
+async def connect():
+    return await asyncpg.connect(
+        user=postgres_settings.postgres_user,
+        password=postgres_settings.postgres_password,
+        database=postgres_settings.postgres_db,
+        host=postgres_settings.postgres_host
+    )
+
+async def create_pool(size):
+    # Таблицы берутся из bench, функции (record_swipe и т.п.) — из public
+    return await asyncpg.create_pool(
+        user=postgres_settings.postgres_user,
+        password=postgres_settings.postgres_password,
+        database=postgres_settings.postgres_db,
+        host=postgres_settings.postgres_host,
+        min_size=size,
+        max_size=size,
+        server_settings={"search_path": f"{BENCH_SCHEMA}, public"}
+    )
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def copy_table(conn, table):
+    """
+    Копия таблицы в схеме bench; у секционированной таблицы копируются и её секции,
+    триггеры переносятся на копию. Таблицы, которые меняют триггеры, тоже должны быть
+    скопированы: их имена ищутся по search_path, и без копии триггер писал бы в public.
+    """
+    partition_key = await conn.fetchval("SELECT pg_get_partkeydef(to_regclass('public.' || $1))", table)
+    await conn.execute(
+        f"CREATE TABLE {BENCH_SCHEMA}.{table} (LIKE public.{table} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING INDEXES)"
+        + (f" PARTITION BY {partition_key}" if partition_key else "")
+    )
+    for partition in await conn.fetch(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('public.' || $1)
+        """,
+        table
+    ):
+        await conn.execute(
+            f"CREATE TABLE {BENCH_SCHEMA}.{partition['relname']} PARTITION OF {BENCH_SCHEMA}.{table} {partition['bound']}"
+        )
+    for trigger in await conn.fetch(
+        "SELECT pg_get_triggerdef(oid) AS definition FROM pg_trigger "
+        "WHERE tgrelid = to_regclass('public.' || $1) AND NOT tgisinternal",
+        table
+    ):
+        await conn.execute(trigger['definition'].replace(" ON public.", f" ON {BENCH_SCHEMA}."))
+
+async def create_bench_schema(conn, tables):
+    """Создаёт копии таблиц (с индексами, секциями и триггерами, но без внешних ключей) в схеме bench."""
+    await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    for table in tables:
+        await copy_table(conn, table)
+    await conn.execute(f"SET search_path TO {BENCH_SCHEMA}")
+
+async def seed_cities(conn, count):
+    """Города city1..cityN на сетке 10x10 с шагом в полградуса."""
+    await conn.execute(
+        """
+        INSERT INTO Cities (id, name, normalized_name, latitude, longitude)
+        SELECT g, 'city' || g, 'city' || g, 50 + (g % 10) * 0.5, 30 + (g / 10) * 0.5
+        FROM generate_series(1, $1) AS g
+        """,
+        count
+    )
+
+async def seed_profiles(conn, count, cities=100):
+    await conn.execute(
+        """
+        INSERT INTO Profiles (
+            id, user_id, nickname, age, gender, interests, city, city_id, pref_age_min, pref_age_max,
+            combined_rating
+        )
+        SELECT g, g, 'user' || g, 18 + g % 40,
+               CASE WHEN g % 2 = 0 THEN 'м' ELSE 'ж' END,
+               'музыка, кино', 'city' || ((g / 2) % $2 + 1), (g / 2) % $2 + 1,
+               18 + (g * 7) % 25, 18 + (g * 7) % 25 + 3 + (g * 13) % 15,
+               floor(random() * 20)
+        FROM generate_series(1, $1) AS g
+        """,
+        count, cities
+    )
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+async def explain(conn, sql, *args):
+    result = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+    return json.loads(result)[0]["Plan"]
+
+async def explain_candidates(args):
+    """
+    Регрессионная проверка: на ~1M анкет выдача кандидатов должна читать Profiles
+    по индексу, а не последовательным сканированием, а мэтчи зрителя проверять
+    index-only поиском по ключу MatchEdges.
+    """
+    conn = await connect()
+    try:
+        await create_bench_schema(conn, ["Cities", "Profiles", "Matches", "MatchEdges", "Interactions"])
+        await seed_cities(conn, 100)
+        await seed_profiles(conn, args.profiles)
+        viewer_id = 2  # 'м', city2
+        await conn.execute(
+            """
+            INSERT INTO Interactions (from_profile_id, to_profile_id, action)
+            SELECT $1, g, 'skip' FROM generate_series(1, 2001, 2) AS g
+            """,
+            viewer_id
+        )
+        # Мэтчи зрителя с каждой сотой анкетой; MatchEdges заполняет триггер
+        await conn.execute(
+            "INSERT INTO Matches (profile1_id, profile2_id) SELECT $1, g FROM generate_series(101, $2, 100) AS g",
+            viewer_id, args.profiles
+        )
+        await conn.execute("ANALYZE")
+
+        near = await nearest_cities(conn, 2, 10)
+        print(f"nearest cities to city2: {', '.join(f'city{city_id}' for city_id in near)}")
+        failed = False
+        for phase, city in (("same", 2), ("near", near[0]), ("other", [2, *near])):
+            plan = await explain(
+                conn, CANDIDATES_SQL.format(city_filter=CITY_FILTERS[phase]),
+                "ж", city, CURSOR_START[0], CURSOR_START[1], [], viewer_id, viewer_id, 50, 20, 30, 25
+            )
+            scans = [
+                node["Node Type"] for node in plan_nodes(plan)
+                if node.get("Relation Name", "").lower() == "profiles"
+            ]
+            edge_scans = [
+                node["Node Type"] for node in plan_nodes(plan)
+                if node.get("Relation Name", "").lower() == "matchedges"
+            ]
+            ok = bool(scans) and "Seq Scan" not in scans and edge_scans == ["Index Only Scan"]
+            failed = failed or not ok
+            print(
+                f"phase {phase}: Profiles scanned via {scans}, MatchEdges via {edge_scans} "
+                f"-> {'OK' if ok else 'FAIL'}"
+            )
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+    return 1 if failed else 0
+
+# Индексы выдачи кандидатов до появления фильтра по возрасту: для сравнения в bench_candidate_latency
+AGELESS_CANDIDATE_INDEXES = [
+    "CREATE INDEX ON Profiles(gender, city_id, combined_rating DESC, id DESC)",
+    "CREATE INDEX ON Profiles(gender, combined_rating DESC, id DESC)",
+]
+
+async def measure_candidate_queries(conn, viewers, cities, limit):
+    """Задержки одной страницы кандидатов (своего города и фазы other) для каждого зрителя."""
+    latencies = []
+    for viewer in viewers:
+        # Для фазы other важен только размер массива пройденных городов, а не их близость
+        near = [city_id for city_id in range(viewer['city_id'] + 1, viewer['city_id'] + 11) if city_id <= cities]
+        for phase, city in (("same", viewer['city_id']), ("other", [viewer['city_id'], *near])):
+            started = time.perf_counter()
+            await conn.fetch(
+                CANDIDATES_SQL.format(city_filter=CITY_FILTERS[phase]),
+                OPPOSITE_GENDER[viewer['gender']], city, CURSOR_START[0], CURSOR_START[1], [],
+                viewer['user_id'], viewer['id'], limit, viewer['pref_age_min'], viewer['pref_age_max'], viewer['age']
+            )
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def bench_candidate_latency(args):
+    """
+    p50/p95 одной страницы кандидатов с фильтром по возрасту на синтетических данных
+    (по умолчанию 1M анкет в 100 городах). Сначала с индексами из init_db.sql, где возраст
+    и предпочтения — хвостовые ключи индекса, затем с прежними индексами без них.
+    """
+    conn = await connect()
+    try:
+        await create_bench_schema(conn, ["Cities", "Profiles", "Matches", "MatchEdges"])
+        await seed_cities(conn, args.cities)
+        await seed_profiles(conn, args.profiles, args.cities)
+        await conn.execute("ANALYZE")
+        viewers = await conn.fetch(
+            "SELECT * FROM Profiles WHERE id = ANY($1::int[])",
+            random.sample(range(1, args.profiles + 1), args.viewers)
+        )
+
+        await measure_candidate_queries(conn, viewers[:20], args.cities, args.limit)  # прогрев кэша
+        latencies = await measure_candidate_queries(conn, viewers, args.cities, args.limit)
+        p95 = percentile(latencies, 0.95)
+        print(
+            f"age-aware indexes: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+            f"p95 {p95 * 1000:.2f} ms over {len(latencies)} queries"
+        )
+
+        # Копии индексов в схеме bench получают сгенерированные имена, поэтому ищем их по определению
+        for index in await conn.fetch(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = $1 AND tablename = 'profiles' "
+            "AND indexdef LIKE '%combined_rating%'",
+            BENCH_SCHEMA
+        ):
+            await conn.execute(f"DROP INDEX {index['indexname']}")
+        for statement in AGELESS_CANDIDATE_INDEXES:
+            await conn.execute(statement)
+        await conn.execute("ANALYZE Profiles")
+        await measure_candidate_queries(conn, viewers[:20], args.cities, args.limit)
+        latencies = await measure_candidate_queries(conn, viewers, args.cities, args.limit)
+        print(
+            f"indexes without age keys: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms"
+        )
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+    return 0 if p95 <= args.p95_budget_ms / 1000 else 1
+
+def random_interest_matrix(rng, count, vocabulary, per_profile):
+    """count случайных векторов по per_profile интересов из первых vocabulary (частые интересы популярнее)."""
+    matrix = np.zeros((count, INTEREST_BYTES // 8), dtype=np.uint64)
+    for _ in range(per_profile):
+        bits = np.minimum(rng.zipf(1.3, count) - 1, vocabulary - 1)
+        np.bitwise_or.at(
+            matrix, (np.arange(count), bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64))
+        )
+    return matrix
+
+async def bench_interest_scoring(args):
+    """
+    Скорость ранжирования по интересам: сходство Жаккара битовых векторов плюс смешивание
+    с рейтингом и сортировка, для пулов кандидатов разного размера. Отдельно меряется путь
+    с упаковкой векторов из bytes, как они приходят из БД.
+    """
+    rng = np.random.default_rng(42)
+    viewer = random_interest_matrix(rng, 1, args.vocabulary, args.per_profile)[0]
+    for size in args.pools:
+        candidates = random_interest_matrix(rng, size, args.vocabulary, args.per_profile)
+        ratings = rng.integers(0, 20, size).astype(np.float64)
+
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            np.argsort(-blended_scores(viewer, candidates, ratings, 0.3), kind="stable")
+        scored = size * args.repeat / (time.perf_counter() - started)
+
+        vectors = [row.tobytes() for row in candidates]
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            np.argsort(-blended_scores(viewer, to_matrix(vectors), ratings, 0.3), kind="stable")
+        packed = size * args.repeat / (time.perf_counter() - started)
+        print(f"pool {size}: {scored:,.0f} candidates/sec scored, {packed:,.0f}/sec including unpacking from bytes")
+
+    # Сверка с прямым подсчётом по множествам битов
+    sample = random_interest_matrix(rng, 1000, args.vocabulary, args.per_profile)
+    viewer_bits = {i for i in range(INTEREST_BITS) if int(viewer[i // 64]) >> (i % 64) & 1}
+    expected = []
+    for row in sample:
+        bits = {i for i in range(INTEREST_BITS) if int(row[i // 64]) >> (i % 64) & 1}
+        union = bits | viewer_bits
+        expected.append(len(bits & viewer_bits) / len(union) if union else 0.0)
+    ok = np.allclose(jaccard(viewer, sample), expected)
+    print(f"jaccard matches set-based reference -> {'OK' if ok else 'FAIL'}")
+    return 0 if ok else 1
+
+async def run_concurrently(items, concurrency, handle):
+    """Раздаёт items concurrency воркерам и возвращает время прогона в секундах."""
+    position = 0
+
+    async def worker():
+        nonlocal position
+        while position < len(items):
+            item = items[position]
+            position += 1
+            await handle(item)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+async def bench_swipes(args):
+    """
+    Пропускная способность record_swipe под конкурентной нагрузкой. Половина свайпов —
+    встречные лайки, отправляемые одновременно, чтобы проверить, что гонка не теряет
+    и не дублирует мэтчи: в конце число мэтчей должно совпасть с числом взаимных лайков,
+    MatchEdges и Profiles.match_count — содержать по две записи на мэтч, а счётчики
+    likes_given и likes_received — сходиться с числом лайков.
+    """
+    conn = await connect()
+    try:
+        await create_bench_schema(conn, ["Profiles", "Interactions", "Matches", "MatchEdges"])
+        await seed_profiles(conn, args.profiles)
+        await conn.execute("ANALYZE")
+
+        rng = random.Random(42)
+        swipes = []
+        while len(swipes) < args.swipes:
+            a, b = rng.sample(range(1, args.profiles + 1), 2)
+            if rng.random() < 0.5:
+                swipes += [(a, b, "like"), (b, a, "like")]
+            else:
+                swipes.append((a, b, "like" if rng.random() < args.like_ratio else "skip"))
+
+        pool = await create_pool(args.concurrency)
+        latencies = []
+
+        async def swipe(item):
+            started = time.perf_counter()
+            async with pool.acquire() as worker_conn:
+                await record_swipe(worker_conn, *item)
+            latencies.append(time.perf_counter() - started)
+
+        try:
+            elapsed = await run_concurrently(swipes, args.concurrency, swipe)
+        finally:
+            await pool.close()
+
+        mutual_likes = await conn.fetchval(
+            """
+            SELECT count(*) FROM Interactions a
+            JOIN Interactions b ON b.from_profile_id = a.to_profile_id AND b.to_profile_id = a.from_profile_id
+            WHERE a.action = 'like' AND b.action = 'like' AND a.from_profile_id < a.to_profile_id
+            """
+        )
+        matches = await conn.fetchval("SELECT count(*) FROM Matches")
+        edges = await conn.fetchval("SELECT count(*) FROM MatchEdges")
+        counters = await conn.fetchrow(
+            "SELECT sum(match_count) AS matches, sum(likes_given) AS given, sum(likes_received) AS received "
+            "FROM Profiles"
+        )
+        likes = await conn.fetchval("SELECT count(*) FROM Interactions WHERE action = 'like'")
+        print(
+            f"{len(swipes)} swipes, concurrency {args.concurrency}: {len(swipes) / elapsed:.0f} swipes/sec, "
+            f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p95 {percentile(latencies, 0.95) * 1000:.2f} ms"
+        )
+        ok = (
+            mutual_likes == matches and edges == counters['matches'] == 2 * matches
+            and counters['given'] == counters['received'] == likes
+        )
+        print(
+            f"mutual likes {mutual_likes}, matches {matches}, match edges {edges}, "
+            f"sum of match_count {counters['matches']}, likes {likes}, "
+            f"sum of likes_given/likes_received {counters['given']}/{counters['received']} -> {'OK' if ok else 'FAIL'}"
+        )
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+    return 0 if ok else 1
+
+async def bench_ingest(args):
+    """
+    Пропускная способность записи пропусков: построчно через record_swipe против
+    буфера в потоке Redis с пачечной записью SkipFlusher. Для буфера отдельно меряются
+    подтверждение свайпов (XADD) и перенос накопленного потока в Interactions; в работе
+    стадии идут параллельно, и итоговая скорость — меньшая из двух.
+    Поток живёт в отдельной логической БД Redis, чтобы не смешиваться с рабочими данными.
+    """
+    redis_settings = RedisSettings()
+    redis_client = redis.Redis(
+        host=redis_settings.redis_host, port=redis_settings.redis_port, db=args.redis_db, decode_responses=True
+    )
+    conn = await connect()
+    pool = flusher = None
+    try:
+        await create_bench_schema(conn, ["Profiles", "Interactions", "Matches", "MatchEdges"])
+        await redis_client.delete(SKIP_STREAM_KEY)
+        skips = [(i // 1000 + 1, 1_000_000 + i % 1000) for i in range(args.skips)]
+        pool = await create_pool(args.concurrency)
+
+        async def direct(skip):
+            async with pool.acquire() as worker_conn:
+                await record_swipe(worker_conn, skip[0], skip[1], "skip")
+
+        elapsed = await run_concurrently(skips, args.concurrency, direct)
+        direct_rate = len(skips) / elapsed
+        print(f"row-by-row record_swipe: {direct_rate:.0f} rows/sec")
+
+        await conn.execute("TRUNCATE Interactions")
+        enqueue_elapsed = await run_concurrently(
+            skips, args.concurrency, lambda skip: enqueue_skip(redis_client, skip[0], skip[1])
+        )
+        print(f"buffered stream, XADD: {len(skips) / enqueue_elapsed:.0f} swipes/sec acknowledged")
+
+        flusher = SkipFlusher(
+            pool, redis_client, consumer="bench",
+            batch_size=args.batch_size, interval_ms=args.interval_ms, claim_idle_ms=60000
+        )
+        started = time.perf_counter()
+        await flusher.start()
+        while await conn.fetchval("SELECT count(*) FROM Interactions") < len(skips):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        await flusher.stop()
+        flush_rate = len(skips) / elapsed
+        print(
+            f"buffered stream, flush (batch {args.batch_size}, {args.interval_ms} ms): "
+            f"{flush_rate:.0f} rows/sec -> x{flush_rate / direct_rate:.1f} vs row-by-row"
+        )
+    finally:
+        if flusher and not flusher.stopping:
+            flusher.stopping = True
+            await flusher.task
+        if pool:
+            await pool.close()
+        await redis_client.delete(SKIP_STREAM_KEY)
+        await redis_client.aclose()
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+    return 0
+
+# Interactions до секционирования: суррогатный id, уникальность пары и индексы по получателю и action
+LEGACY_INTERACTIONS_DDL = [
+    """
+    CREATE TABLE Interactions (
+        id SERIAL PRIMARY KEY,
+        from_profile_id INTEGER NOT NULL,
+        to_profile_id INTEGER NOT NULL,
+        action TEXT NOT NULL CHECK (action IN ('like', 'skip')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_interaction UNIQUE (from_profile_id, to_profile_id)
+    )
+    """,
+    "CREATE INDEX ON Interactions(to_profile_id)",
+    "CREATE INDEX ON Interactions(action)",
+]
+
+INSERT_INTERACTIONS_SQL = """
+    INSERT INTO Interactions (from_profile_id, to_profile_id, action, created_at)
+    SELECT data.from_profile_id, data.to_profile_id, data.action, LOCALTIMESTAMP - make_interval(days => data.age_days)
+    FROM unnest($1::int[], $2::int[], $3::text[], $4::int[]) AS data(from_profile_id, to_profile_id, action, age_days)
+    ON CONFLICT (from_profile_id, to_profile_id) DO NOTHING
+"""
+
+async def wal_position(conn):
+    return await conn.fetchval("SELECT pg_current_wal_insert_lsn()")
+
+async def wal_bytes_since(conn, position):
+    return await conn.fetchval("SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), $1)", position)
+
+async def interactions_size(conn):
+    """Размер Interactions вместе с индексами и всеми секциями, байт."""
+    # У несекционированной таблицы pg_partition_tree пуст
+    return await conn.fetchval(
+        """
+        SELECT COALESCE(
+            (SELECT sum(pg_total_relation_size(relid)) FROM pg_partition_tree('interactions'::regclass)),
+            pg_total_relation_size('interactions'::regclass)
+        )
+        """
+    )
+
+async def measure_interactions_layout(conn, swipes, viewers, args):
+    """Запись, размер, запросы по зрителю и получателю и сворачивание пропусков для текущей Interactions."""
+    position = await wal_position(conn)
+    started = time.perf_counter()
+    for start in range(0, len(swipes), args.batch_size):
+        batch = swipes[start:start + args.batch_size]
+        await conn.execute(INSERT_INTERACTIONS_SQL, *(list(column) for column in zip(*batch)))
+    elapsed = time.perf_counter() - started
+    wal = await wal_bytes_since(conn, position)
+    size = await interactions_size(conn)
+    print(
+        f"  write: {len(swipes) / elapsed:.0f} rows/sec, WAL {wal / len(swipes):.0f} B/row, "
+        f"table + indexes {size / len(swipes):.0f} B/row"
+    )
+
+    await conn.execute("ANALYZE")
+    rng = random.Random(7)
+    queries = {
+        "seen check (50 ids)": lambda viewer: conn.fetch(
+            SEEN_SQL, viewer, rng.sample(range(1, args.profiles + 1), 50)
+        ),
+        "seen rebuild": lambda viewer: conn.fetch(
+            "SELECT to_profile_id FROM Interactions WHERE from_profile_id = $1", viewer
+        ),
+        "likers": lambda viewer: conn.fetch(LIKERS_SQL, viewer),
+    }
+    for name, query in queries.items():
+        for viewer in viewers[:20]:
+            await query(viewer)  # прогрев кэша
+        latencies = []
+        for viewer in viewers:
+            query_started = time.perf_counter()
+            await query(viewer)
+            latencies.append(time.perf_counter() - query_started)
+        print(
+            f"  {name}: p50 {percentile(latencies, 0.5) * 1000:.3f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.3f} ms"
+        )
+
+    position = await wal_position(conn)
+    started = time.perf_counter()
+    compacted = await compact_skips(conn, args.retention_days, args.compaction_batch_size)
+    elapsed = time.perf_counter() - started
+    wal = await wal_bytes_since(conn, position)
+    print(
+        f"  compaction: {compacted} skips older than {args.retention_days} days in {elapsed:.2f}s, "
+        f"WAL {wal / max(compacted, 1):.0f} B/row"
+    )
+
+async def bench_interactions_layout(args):
+    """
+    Interactions до и после секционирования: скорость и WAL пачечной записи свайпов
+    на строку, размер с индексами, задержки запросов фильтра «уже видел» и «кто меня
+    лайкнул» и сворачивание старых пропусков. Свайпы идут вперемешку по зрителям,
+    возраст свайпов равномерно распределён на --max-age-days дней.
+    """
+    rng = random.Random(42)
+    swipes = []
+    for viewer in range(1, args.viewers + 1):
+        for target in rng.sample(range(1, args.profiles + 1), args.swipes_per_viewer):
+            action = "like" if rng.random() < args.like_ratio else "skip"
+            swipes.append((viewer, target, action, rng.randrange(args.max_age_days)))
+    rng.shuffle(swipes)
+    viewers = rng.sample(range(1, args.viewers + 1), min(args.probes, args.viewers))
+
+    conn = await connect()
+    try:
+        # Профили нужны триггеру счётчиков лайков: он обновляет обе анкеты каждого лайка
+        await create_bench_schema(conn, ["Profiles", "SkipRollups"])
+        await seed_profiles(conn, args.profiles)
+        print(f"legacy layout (id, unique pair, to_profile_id and action indexes), {len(swipes)} swipes:")
+        for statement in LEGACY_INTERACTIONS_DDL:
+            await conn.execute(statement)
+        await measure_interactions_layout(conn, swipes, viewers, args)
+
+        await conn.execute("DROP TABLE Interactions")
+        await conn.execute("TRUNCATE SkipRollups")
+        partitions = await conn.fetchval(
+            "SELECT count(*) FROM pg_inherits WHERE inhparent = 'public.interactions'::regclass"
+        )
+        print(f"init_db.sql layout ({partitions} hash partitions, pair key, to_profile_id index, like counters):")
+        await copy_table(conn, "Interactions")
+        await measure_interactions_layout(conn, swipes, viewers, args)
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+    return 0
+
+class FakeTelegram:
+    """
+    Имитация лимитов Bot API: 429 с retry_after, если за последнюю секунду отправлено
+    больше global_limit сообщений или в чат писали меньше chat_interval секунд назад.
+    """
+
+    def __init__(self, global_limit, chat_interval, latency):
+        self.global_limit = global_limit
+        self.chat_interval = chat_interval
+        self.latency = latency
+        self.sent_at = []
+        self.chat_last = {}
+        self.rejected = 0
+
+    async def send(self, chat_id):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        recent = [t for t in self.sent_at[-self.global_limit:] if now - t < 1.0]
+        if len(recent) >= self.global_limit or now - self.chat_last.get(chat_id, -60.0) < self.chat_interval:
+            self.rejected += 1
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=""), "Too Many Requests", retry_after=1)
+        self.sent_at.append(now)
+        self.chat_last[chat_id] = now
+
+async def bench_send_scheduler(args):
+    """
+    Отправка пачки уведомлений в имитацию Telegram: без планировщика (всё сразу)
+    и через SendScheduler. Для планировщика печатаются темп, число 429 и средняя
+    задержка по приоритетам; мэтчи должны уходить раньше фоновых сообщений.
+    """
+    chats = [(i % args.chats) + 1 for i in range(args.messages)]
+    priorities = [PRIORITY_LOW if i % 2 else PRIORITY_MATCH for i in range(args.messages)]
+
+    telegram = FakeTelegram(args.global_limit, args.chat_interval, args.latency_ms / 1000)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(telegram.send(chat_id) for chat_id in chats), return_exceptions=True)
+    delivered = sum(1 for result in results if not isinstance(result, Exception))
+    print(
+        f"unscheduled: {delivered}/{len(chats)} delivered, {telegram.rejected} x 429 "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+    telegram = FakeTelegram(args.global_limit, args.chat_interval, args.latency_ms / 1000)
+    scheduler = SendScheduler(
+        rate=args.rate, burst=args.burst, chat_interval=args.chat_interval, max_retries=5
+    )
+    waits = {PRIORITY_MATCH: [], PRIORITY_LOW: []}
+
+    async def notify(chat_id, priority):
+        enqueued = time.perf_counter()
+        await scheduler.submit(chat_id, lambda: telegram.send(chat_id), priority=priority)
+        waits[priority].append(time.perf_counter() - enqueued)
+
+    scheduler.start()
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(notify(chat_id, priority) for chat_id, priority in zip(chats, priorities)), return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    print(
+        f"scheduled (rate {args.rate}/s, burst {args.burst}, chat interval {args.chat_interval}s): "
+        f"{len(chats) - failed}/{len(chats)} delivered, {telegram.rejected} x 429, "
+        f"{(len(chats) - failed) / elapsed:.1f} msg/sec"
+    )
+    for name, priority in (("match", PRIORITY_MATCH), ("low", PRIORITY_LOW)):
+        if waits[priority]:
+            print(
+                f"  {name}: wait p50 {percentile(waits[priority], 0.5):.2f}s, "
+                f"p95 {percentile(waits[priority], 0.95):.2f}s"
+            )
+    ok = failed == 0 and percentile(waits[PRIORITY_MATCH], 0.5) <= percentile(waits[PRIORITY_LOW], 0.5)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочные проверки запросов дейтинг-бота")
+    parser.add_argument("--keep", action="store_true", help="не удалять схему bench после прогона")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    explain_parser = subparsers.add_parser("explain-candidates", help="проверить план запроса выдачи кандидатов")
+    explain_parser.add_argument("--profiles", type=int, default=1_000_000)
+    explain_parser.set_defaults(func=explain_candidates)
+
+    latency_parser = subparsers.add_parser("candidate-latency", help="p95 страницы кандидатов с фильтром по возрасту")
+    latency_parser.add_argument("--profiles", type=int, default=1_000_000)
+    latency_parser.add_argument("--cities", type=int, default=100)
+    latency_parser.add_argument("--viewers", type=int, default=500)
+    latency_parser.add_argument("--limit", type=int, default=50)
+    latency_parser.add_argument("--p95-budget-ms", type=float, default=20.0)
+    latency_parser.set_defaults(func=bench_candidate_latency)
+
+    scoring_parser = subparsers.add_parser("interest-scoring", help="кандидатов в секунду при ранжировании по интересам")
+    scoring_parser.add_argument("--pools", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    scoring_parser.add_argument("--vocabulary", type=int, default=300)
+    scoring_parser.add_argument("--per-profile", type=int, default=5)
+    scoring_parser.add_argument("--repeat", type=int, default=5)
+    scoring_parser.set_defaults(func=bench_interest_scoring)
+
+    swipes_parser = subparsers.add_parser("swipes", help="измерить свайпы/сек под конкурентной нагрузкой")
+    swipes_parser.add_argument("--profiles", type=int, default=10_000)
+    swipes_parser.add_argument("--swipes", type=int, default=100_000)
+    swipes_parser.add_argument("--concurrency", type=int, default=32)
+    swipes_parser.add_argument("--like-ratio", type=float, default=0.5)
+    swipes_parser.set_defaults(func=bench_swipes)
+
+    ingest_parser = subparsers.add_parser("ingest", help="сравнить запись пропусков построчно и через буфер в Redis")
+    ingest_parser.add_argument("--skips", type=int, default=100_000)
+    ingest_parser.add_argument("--concurrency", type=int, default=32)
+    ingest_parser.add_argument("--batch-size", type=int, default=500)
+    ingest_parser.add_argument("--interval-ms", type=int, default=200)
+    ingest_parser.add_argument("--redis-db", type=int, default=15, help="логическая БД Redis для потока пропусков")
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    send_parser = subparsers.add_parser("send-scheduler", help="проверить отправку уведомлений в пределах лимитов Telegram")
+    send_parser.add_argument("--messages", type=int, default=600)
+    send_parser.add_argument("--chats", type=int, default=200)
+    send_parser.add_argument("--rate", type=float, default=25.0)
+    send_parser.add_argument("--burst", type=int, default=5)
+    send_parser.add_argument("--chat-interval", type=float, default=1.0)
+    send_parser.add_argument("--global-limit", type=int, default=30, help="лимит имитации Telegram, сообщений в секунду")
+    send_parser.add_argument("--latency-ms", type=float, default=50)
+    send_parser.set_defaults(func=bench_send_scheduler)
+
+    layout_parser = subparsers.add_parser("interactions-layout", help="сравнить Interactions до и после секционирования")
+    layout_parser.add_argument("--profiles", type=int, default=100_000)
+    layout_parser.add_argument("--viewers", type=int, default=10_000)
+    layout_parser.add_argument("--swipes-per-viewer", type=int, default=100)
+    layout_parser.add_argument("--like-ratio", type=float, default=0.3)
+    layout_parser.add_argument("--max-age-days", type=int, default=180)
+    layout_parser.add_argument("--retention-days", type=int, default=90)
+    layout_parser.add_argument("--batch-size", type=int, default=500, help="строк в одном INSERT, как у SkipFlusher")
+    layout_parser.add_argument("--compaction-batch-size", type=int, default=10000)
+    layout_parser.add_argument("--probes", type=int, default=500)
+    layout_parser.set_defaults(func=bench_interactions_layout)
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(args.func(args)))
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+from config import MatchmakingSettings
+from seen import filter_unseen
+from cities import nearest_cities
+from interests import rank_by_interests
+from inbound_likes import take_likers, mix_in
+
+# Создаём экземпляры настроек
+matchmaking_settings = MatchmakingSettings()
+
+logger = logging.getLogger(__name__)
+
+# Ссылки на фоновые задачи дозаполнения, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+OPPOSITE_GENDER = {"м": "ж", "ж": "м"}
+
+# Противоположный пол, возраст в диапазоне предпочтений зрителя ($9..$10), причём зритель ($11)
+# сам попадает в диапазон кандидата, без мэтчей. Уже просмотренные анкеты отсекаются после запроса
+# фильтром Блума из seen.py, а не анти-джойном с Interactions, который дорожает с ростом числа свайпов.
+# Кандидаты идут по убыванию combined_rating с keyset-пагинацией по (combined_rating, id).
+# Город задаётся одним city_id ($2 — int), и тогда запрос читает idx_profiles_gender_city_rating
+# ровно на LIMIT строк вперёд от курсора, либо массивом уже пройденных городов ($2 — int[])
+# для последней фазы по idx_profiles_gender_rating. Кандидаты, уже лежащие в очереди, исключаются через $5.
+CANDIDATES_SQL = """
+    SELECT p.id, p.combined_rating, p.interest_vector
+    FROM Profiles p
+    WHERE p.gender = $1
+    AND {city_filter}
+    AND (p.combined_rating, p.id) < ($3, $4)
+    AND p.age BETWEEN $9 AND $10
+    AND $11 BETWEEN p.pref_age_min AND p.pref_age_max
+    AND p.id != ALL($5::int[])
+    AND p.user_id != $6
+    AND NOT EXISTS (
+        SELECT 1 FROM MatchEdges e
+        WHERE e.profile_id = $7 AND e.other_profile_id = p.id
+    )
+    ORDER BY p.combined_rating DESC, p.id DESC
+    LIMIT $8
+"""
+
+# Перепроверка кандидатов из очереди перед показом: пока очередь живёт (candidate_queue_ttl),
+# анкета могла сменить пол или возраст, а с кем-то из кандидатов мог случиться мэтч. Условия те же,
+# что в CANDIDATES_SQL, плюс заполненность анкеты, как у самого зрителя в /find. Город не проверяется:
+# он задаёт только порядок выдачи, последняя фаза берёт все города
+ELIGIBLE_CANDIDATES_SQL = """
+    SELECT p.id
+    FROM Profiles p
+    WHERE p.id = ANY($1::int[])
+    AND p.gender = $2
+    AND p.age BETWEEN $3 AND $4
+    AND $5 BETWEEN p.pref_age_min AND p.pref_age_max
+    AND p.user_id != $6
+    AND p.profile_completeness >= 80
+    AND NOT EXISTS (
+        SELECT 1 FROM MatchEdges e
+        WHERE e.profile_id = $7 AND e.other_profile_id = p.id
+    )
+"""
+
+CITY_FILTERS = {
+    "same": "p.city_id = $2",
+    "near": "p.city_id = $2",
+    "other": "p.city_id != ALL($2::int[])",
+}
+
+# Начальный курсор: выше любого рейтинга и любого id
+CURSOR_START = (float("inf"), 2 ** 31 - 1)
+
+def queue_key(profile_id):
+    return f"candidates:{profile_id}"
+
+def refill_lock_key(profile_id):
+    return f"candidates:{profile_id}:refill"
+
+def cursor_key(profile_id):
+    return f"candidates:{profile_id}:cursor"
+
+async def fetch_page(conn, profile, phase, city, cursor, exclude_ids, limit):
+    """
+    Одна страница кандидатов фазы phase после курсора (rating, id). city — city_id
+    для фаз same/near, список пройденных city_id для other. Возвращает (строки, новый курсор).
+    """
+    rows = await conn.fetch(
+        CANDIDATES_SQL.format(city_filter=CITY_FILTERS[phase]),
+        OPPOSITE_GENDER[profile['gender']], city, cursor[0], cursor[1],
+        list(exclude_ids), profile['user_id'], profile['id'], limit,
+        profile['pref_age_min'], profile['pref_age_max'], profile['age']
+    )
+    if rows:
+        cursor = (rows[-1]['combined_rating'], rows[-1]['id'])
+    return rows, cursor
+
+async def build_candidates(conn, redis_client, profile, state, exclude_ids, limit):
+    """
+    Возвращает до limit id кандидатов: сначала из того же города, затем из
+    city_fallback_cities ближайших городов по одному в порядке расстояния, затем из всех остальных.
+    state — словарь {"phase", "ring", "rating", "id"} с позицией пагинации, где ring —
+    номер ближайшего города в фазе near; обновляется на месте.
+    """
+    near = None
+    candidate_ids = []
+    while len(candidate_ids) < limit and state["phase"] != "done":
+        if state["phase"] == "same":
+            city = profile['city_id']
+        else:
+            if near is None:
+                near = await nearest_cities(conn, profile['city_id'], matchmaking_settings.city_fallback_cities)
+            if state["phase"] == "near" and state["ring"] >= len(near):
+                state["phase"] = "other"
+            city = near[state["ring"]] if state["phase"] == "near" else [profile['city_id'], *near]
+        requested = limit - len(candidate_ids)
+        rows, (state["rating"], state["id"]) = await fetch_page(
+            conn, profile, state["phase"], city, (state["rating"], state["id"]),
+            exclude_ids, requested
+        )
+        unseen = set(await filter_unseen(conn, redis_client, profile['id'], [row['id'] for row in rows]))
+        # Внутри страницы (один город или фаза) порядок задаёт смесь рейтинга и сходства интересов
+        candidate_ids.extend(rank_by_interests(
+            profile['interest_vector'], [row for row in rows if row['id'] in unseen],
+            matchmaking_settings.interest_weight
+        ))
+        if len(rows) < requested:
+            # Страница неполная: город или фаза исчерпаны, переходим к следующему
+            if state["phase"] == "same":
+                state["phase"], state["ring"] = "near", 0
+            elif state["phase"] == "near":
+                state["ring"] += 1
+            else:
+                state["phase"] = "done"
+            state["rating"], state["id"] = CURSOR_START
+    return candidate_ids
+
+async def load_cursor(redis_client, profile_id):
+    cursor = await redis_client.hgetall(cursor_key(profile_id))
+    if not cursor:
+        return {"phase": "same", "ring": 0, "rating": CURSOR_START[0], "id": CURSOR_START[1]}
+    return {
+        "phase": cursor["phase"], "ring": int(cursor.get("ring", 0)),
+        "rating": float(cursor["rating"]), "id": int(cursor["id"])
+    }
+
+async def refill_candidates(pool, redis_client, profile):
+    """Дозаполняет очередь кандидатов профиля. Возвращает число добавленных id."""
+    profile_id = profile['id']
+    # Не даём нескольким процессам бота одновременно дозаполнять одну и ту же очередь
+    if not await redis_client.set(refill_lock_key(profile_id), 1, nx=True, ex=30):
+        return 0
+    exhausted = False
+    try:
+        key = queue_key(profile_id)
+        queued = [int(candidate_id) for candidate_id in await redis_client.lrange(key, 0, -1)]
+        state = await load_cursor(redis_client, profile_id)
+        batch_size = matchmaking_settings.candidate_batch_size
+        async with pool.acquire() as conn:
+            candidate_ids = await build_candidates(conn, redis_client, profile, state, queued, batch_size)
+            # Анкеты тех, кто уже лайкнул зрителя, дают мэтч с первого лайка, поэтому подмешиваются в каждую пачку
+            likers = await take_likers(
+                conn, redis_client, profile, OPPOSITE_GENDER[profile['gender']], queued + candidate_ids,
+                round(batch_size * matchmaking_settings.inbound_likes_ratio)
+            )
+        exhausted = len(candidate_ids) < batch_size
+        candidate_ids = mix_in(candidate_ids, likers, matchmaking_settings.inbound_likes_ratio)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if candidate_ids:
+                pipe.rpush(key, *candidate_ids)
+                pipe.expire(key, matchmaking_settings.candidate_queue_ttl)
+            pipe.hset(cursor_key(profile_id), mapping=state)
+            if state["phase"] == "done":
+                # Все анкеты просмотрены. Курсор «done» держим candidate_rescan_interval: до тех пор
+                # дозаполнение добавляет только новых лайкнувших, а не проходит заново уже
+                # просмотренные анкеты; после истечения проход начнётся сначала
+                pipe.expire(cursor_key(profile_id), matchmaking_settings.candidate_rescan_interval)
+            else:
+                pipe.expire(cursor_key(profile_id), matchmaking_settings.candidate_queue_ttl)
+            await pipe.execute()
+        logger.info(
+            f"Refilled candidate queue for profile {profile_id} with {len(candidate_ids)} candidates "
+            f"({len(likers)} who liked them)"
+        )
+        return len(candidate_ids)
+    finally:
+        # Если подходящие анкеты закончились, блокировка живёт до истечения TTL
+        # и служит паузой, чтобы каждый /find не повторял тяжёлый запрос впустую
+        if not exhausted:
+            await redis_client.delete(refill_lock_key(profile_id))
+
+def schedule_refill(pool, redis_client, profile):
+    task = asyncio.create_task(refill_candidates(pool, redis_client, profile))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _pop(redis_client, key, count):
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lpop(key, count)
+        pipe.llen(key)
+        return await pipe.execute()
+
+async def pop_candidates(pool, redis_client, profile, count):
+    """Достаёт до count следующих кандидатов из очереди профиля, при необходимости дозаполняя её."""
+    key = queue_key(profile['id'])
+    candidate_ids, remaining = await _pop(redis_client, key, count)
+    if not candidate_ids:
+        # Очередь пуста: заполняем её синхронно, иначе показать нечего
+        await refill_candidates(pool, redis_client, profile)
+        candidate_ids, remaining = await _pop(redis_client, key, count)
+        if not candidate_ids:
+            return []
+
+    if remaining < matchmaking_settings.candidate_refill_threshold:
+        schedule_refill(pool, redis_client, profile)
+    return [int(candidate_id) for candidate_id in candidate_ids]
+
+async def return_candidates(redis_client, profile_id, candidate_ids):
+    """Возвращает снятых, но не показанных кандидатов в начало очереди в прежнем порядке."""
+    if not candidate_ids:
+        return
+    key = queue_key(profile_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lpush(key, *reversed(candidate_ids))
+        pipe.expire(key, matchmaking_settings.candidate_queue_ttl)
+        await pipe.execute()
+
+async def eligible_candidates(conn, profile, candidate_ids):
+    """Оставляет из candidate_ids тех, кто всё ещё подходит профилю, в исходном порядке."""
+    if not candidate_ids:
+        return []
+    rows = await conn.fetch(
+        ELIGIBLE_CANDIDATES_SQL, candidate_ids, OPPOSITE_GENDER[profile['gender']],
+        profile['pref_age_min'], profile['pref_age_max'], profile['age'], profile['user_id'], profile['id']
+    )
+    eligible = {row['id'] for row in rows}
+    return [candidate_id for candidate_id in candidate_ids if candidate_id in eligible]
+
+async def invalidate_candidates(redis_client, profile_id):
+    """Сбрасывает очередь кандидатов, например после смены пола или города в профиле."""
+    await redis_client.delete(queue_key(profile_id), refill_lock_key(profile_id), cursor_key(profile_id))
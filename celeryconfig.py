@@ -3,6 +3,18 @@ from celery.schedules import crontab
 beat_schedule = {
     'recalculate-ratings-every-10-minutes': {
         'task': 'tasks.recalculate_ratings',
-        'schedule': crontab(minute='*/1'),  # Каждую 1 минуту
+        'schedule': crontab(minute='*/1'),  # Каждую 1 минуту, только изменённые профили
+    },
+    'reconcile-counters-nightly': {
+        'task': 'tasks.reconcile_all_counters',
+        'schedule': crontab(hour=2, minute=30),  # Сверка счётчиков Profiles до полного пересчёта рейтингов
+    },
+    'recalculate-all-ratings-nightly': {
+        'task': 'tasks.recalculate_all_ratings',
+        'schedule': crontab(hour=3, minute=0),  # Полный пересчёт раз в сутки на случай потерянных пометок
+    },
+    'compact-skips-nightly': {
+        'task': 'tasks.compact_old_skips',
+        'schedule': crontab(hour=4, minute=0),  # Сворачивание старых пропусков после пересчёта рейтингов
     },
 }
\ No newline at end of file
@@ -0,0 +1,62 @@
+import re
+
+# Распространённые сокращения и разговорные названия -> нормализованное название
+CITY_ALIASES = {
+    "мск": "москва",
+    "спб": "санкт-петербург",
+    "питер": "санкт-петербург",
+    "санкт петербург": "санкт-петербург",
+    "екб": "екатеринбург",
+    "нск": "новосибирск",
+    "нн": "нижний новгород",
+    "нижний": "нижний новгород",
+    "ростов": "ростов-на-дону",
+    "ростов на дону": "ростов-на-дону",
+    "челны": "набережные челны",
+}
+
+# Город по нормализованному названию; неизвестный город добавляется без координат.
+# Вставленная строка не видна SELECT из снимка этого же запроса, поэтому берём её из RETURNING
+RESOLVE_CITY_SQL = """
+    WITH inserted AS (
+        INSERT INTO Cities (name, normalized_name) VALUES ($1, $2)
+        ON CONFLICT (normalized_name) DO NOTHING
+        RETURNING id, name
+    )
+    SELECT id, name FROM inserted
+    UNION ALL
+    SELECT id, name FROM Cities WHERE normalized_name = $2
+    LIMIT 1
+"""
+
+# Ближайшие города с координатами по GiST-индексу idx_cities_location (KNN-сортировка <->)
+NEAREST_CITIES_SQL = """
+    SELECT id FROM Cities
+    WHERE location IS NOT NULL AND id != $1
+    AND (SELECT location FROM Cities WHERE id = $1) IS NOT NULL
+    ORDER BY location <-> (SELECT location FROM Cities WHERE id = $1)
+    LIMIT $2
+"""
+
+def normalize_city(text):
+    """Приводит название к виду, по которому ищется город: регистр, ё, «г.», пробелы и дефисы."""
+    name = " ".join(text.lower().replace("ё", "е").split())
+    name = re.sub(r"^(г\.|г |город )\s*", "", name)
+    name = re.sub(r"\s*-\s*", "-", name)
+    return CITY_ALIASES.get(name, name)
+
+async def resolve_city(conn, text):
+    """Возвращает (city_id, name) города из Cities, при необходимости добавляя новый."""
+    normalized = normalize_city(text)
+    display = " ".join(text.split())
+    display = display[:1].upper() + display[1:]
+    row = await conn.fetchrow(RESOLVE_CITY_SQL, display, normalized)
+    if row is None:
+        # Параллельная вставка того же города ещё не была видна нашему снимку
+        row = await conn.fetchrow("SELECT id, name FROM Cities WHERE normalized_name = $1", normalized)
+    return row['id'], row['name']
+
+async def nearest_cities(conn, city_id, limit):
+    """id до limit ближайших к city_id городов по возрастанию расстояния; пусто, если координат нет."""
+    rows = await conn.fetch(NEAREST_CITIES_SQL, city_id, limit)
+    return [row['id'] for row in rows]
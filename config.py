@@ -7,27 +7,78 @@ class BaseSettingsWithEnv(BaseSettings):
 
 class TelegramSettings(BaseSettingsWithEnv):
     bot_token: str
+    fsm_state_ttl: int = 24 * 60 * 60  # сколько живёт брошенная анкета-в-процессе в Redis, секунд
+    # Webhook-режим включается, если задан публичный адрес; иначе бот работает через long polling
+    webhook_url: str = ""  # например https://bot.example.com, без пути
+    webhook_path: str = "/webhook"
+    webhook_secret: str = ""  # сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_workers: int = 1  # процессов на контейнер, слушают один порт через SO_REUSEPORT
+    webhook_register: bool = True  # False — не вызывать setWebhook при старте, апдейты присылаются вручную
+    identity_cache_ttl: float = 10.0  # сколько секунд процесс доверяет закэшированным user/profile
+    identity_cache_size: int = 10000
+    profile_cache_ttl: int = 3600  # время жизни карточки анкеты в Redis, секунд
+    metrics_log_interval: int = 60  # как часто бот пишет в лог счётчики кэша анкет и событий, секунд
+    # Лимиты отправки уведомлений: Telegram допускает около 30 сообщений в секунду всего и ~1 в секунду в один чат
+    send_rate: float = 25.0  # сообщений в секунду на процесс notification_service
+    send_burst: int = 5  # запас сверх темпа после простоя: burst + rate не должно превышать ~30 за секунду
+    send_chat_interval: float = 1.0  # минимальный интервал между отправками в один чат, секунд
+    send_max_retries: int = 5  # сколько раз повторять отправку после 429 Too Many Requests
+    send_stats_interval: int = 60  # как часто писать в лог статистику отправок, секунд
+    notification_delivered_ttl: int = 24 * 60 * 60  # сколько помнить отправленные части уведомления при повторной доставке, секунд
 
 class MinIOSettings(BaseSettingsWithEnv):
     minio_root_user: str
     minio_root_password: str
+    photo_cache_max_bytes: int = 64 * 1024 * 1024  # объём LRU-кэша байтов фото в памяти процесса
+    photo_fetch_workers: int = 8  # потоков для параллельной работы с MinIO
 
 class PostgresSettings(BaseSettingsWithEnv):
     postgres_user: str
     postgres_password: str
     postgres_db: str
     postgres_host: str
+    postgres_pool_min_size: int = 1  # минимальное число соединений в пуле asyncpg
+    postgres_pool_max_size: int = 10  # максимальное число соединений в пуле asyncpg
 
 class RabbitMQSettings(BaseSettingsWithEnv):
     rabbitmq_user: str
     rabbitmq_password: str
     rabbitmq_host: str
+    rabbitmq_publisher_confirms: bool = True  # ждать подтверждения брокера на каждую публикацию
+    rabbitmq_prefetch_count: int = 64  # сколько неподтверждённых сообщений брокер выдаёт одному потребителю
+    rabbitmq_consumer_concurrency: int = 16  # сколько сообщений потребитель обрабатывает одновременно
 
 class RedisSettings(BaseSettingsWithEnv):
     redis_host: str
     redis_port: int
     redis_url: str
 
+class MatchmakingSettings(BaseSettingsWithEnv):
+    candidate_batch_size: int = 50  # сколько кандидатов кладём в очередь за одно дозаполнение
+    candidate_refill_threshold: int = 10  # при каком остатке очереди запускаем фоновое дозаполнение
+    candidate_queue_ttl: int = 3600  # время жизни очереди кандидатов в секундах
+    candidate_check_batch: int = 5  # сколько кандидатов /find снимает с очереди и перепроверяет одним запросом
+    candidate_rescan_interval: int = 6 * 3600  # через сколько секунд после того, как анкеты кончились, проходим их заново в поисках новых
+    city_fallback_cities: int = 10  # сколько ближайших городов перебираем по одному, прежде чем брать анкеты из всех остальных
+    interest_vector_bits: int = 512  # длина битового вектора интересов анкеты, кратна 64
+    interest_weight: float = 0.3  # доля сходства интересов в балле кандидата, остальное — combined_rating
+    inbound_likes_ratio: float = 0.2  # доля анкет «кто меня лайкнул» в каждом дозаполнении очереди кандидатов
+    inbound_likes_ttl: int = 7 * 24 * 3600  # индексы лайков неактивных пользователей удаляются и при возврате строятся заново
+    rating_chunk_size: int = 5000  # размер диапазона id профилей при массовом пересчёте рейтингов
+    rating_dirty_batch_size: int = 1000  # сколько изменённых профилей пересчитываем одним запросом
+    skip_flush_batch_size: int = 500  # сколько пропусков из потока записываем в Interactions одним INSERT
+    skip_flush_interval_ms: int = 200  # как долго копим пачку пропусков перед записью
+    skip_claim_idle_ms: int = 60000  # через сколько неподтверждённые записи упавшей реплики забирает другая
+    skip_retention_days: int = 90  # пропуски старше этого сворачиваются в SkipRollups, и анкета снова может попасть в выдачу
+    skip_compaction_batch_size: int = 10000  # сколько пропусков удаляем из секции Interactions одной транзакцией
+    seen_filter_bits: int = 2 ** 17  # размер фильтра «уже видел» на пользователя: 16 КБ, ~0.5% ложных срабатываний на 10 тыс. свайпов
+    seen_filter_hashes: int = 4
+    seen_filter_ttl: int = 7 * 24 * 3600  # фильтры неактивных пользователей удаляются и при возврате строятся заново
+    event_window_ms: int = 2000  # события matchmaking одного пользователя за это окно сливаются в одну задачу пересчёта
+    event_prefetch_count: int = 500  # сколько событий matchmaking_service держит неподтверждёнными, пока идут окна
+
 '''
 # Создаём экземпляры настроек
 telegram_settings = TelegramSettings()
@@ -35,4 +86,5 @@ minio_settings = MinIOSettings()
 postgres_settings = PostgresSettings()
 rabbitmq_settings = RabbitMQSettings()
 redis_settings = RedisSettings()
+matchmaking_settings = MatchmakingSettings()
 '''
\ No newline at end of file
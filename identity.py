@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+# Пользователь и его анкета одним запросом. Строки возвращаются составными значениями,
+# asyncpg раскрывает их во вложенные Record с теми же полями, что и SELECT *.
+# Рейтинг берётся из денормализованного Profiles.combined_rating
+IDENTITY_SQL = """
+    SELECT u AS "user", p AS profile
+    FROM Users u
+    LEFT JOIN Profiles p ON p.user_id = u.id
+    WHERE u.telegram_id = $1
+"""
+
+# То же, но с регистрацией: новый пользователь создаётся в том же запросе.
+# Вставленная строка не видна SELECT из снимка этого же запроса, поэтому берём её из RETURNING
+ENSURE_IDENTITY_SQL = """
+    WITH inserted AS (
+        INSERT INTO Users (telegram_id, username) VALUES ($1, $2)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING *
+    ), found AS (
+        SELECT * FROM inserted
+        UNION ALL
+        SELECT * FROM Users WHERE telegram_id = $1
+    )
+    SELECT ROW(u.*)::Users AS "user", p AS profile
+    FROM found u
+    LEFT JOIN Profiles p ON p.user_id = u.id
+    LIMIT 1
+"""
+
+class IdentityStore:
+    """
+    Разрешает telegram_id в пару (user, profile) за один запрос и держит результат
+    в небольшом LRU-кэше процесса с коротким TTL. Любая запись в Users/Profiles
+    должна вызывать invalidate: другие реплики бота увидят изменение не позже чем через TTL.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def _cached(self, telegram_id):
+        entry = self.cache.get(telegram_id)
+        if entry is None:
+            return None
+        expires_at, identity = entry
+        if expires_at < time.monotonic():
+            del self.cache[telegram_id]
+            return None
+        self.cache.move_to_end(telegram_id)
+        return identity
+
+    def _remember(self, telegram_id, identity):
+        self.cache[telegram_id] = (time.monotonic() + self.ttl, identity)
+        self.cache.move_to_end(telegram_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def get(self, pool, telegram_id):
+        """Возвращает (user, profile); (None, None), если пользователь не зарегистрирован."""
+        identity = self._cached(telegram_id)
+        if identity is not None:
+            return identity
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(IDENTITY_SQL, telegram_id)
+        if row is None:
+            # Незарегистрированных не кэшируем: /start создаст их в любой реплике
+            return None, None
+        identity = (row['user'], row['profile'])
+        self._remember(telegram_id, identity)
+        return identity
+
+    async def ensure(self, pool, telegram_id, username):
+        """Как get, но при необходимости регистрирует пользователя. Возвращает (user, profile)."""
+        identity = self._cached(telegram_id)
+        if identity is not None:
+            return identity
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(ENSURE_IDENTITY_SQL, telegram_id, username)
+            if row is None:
+                # Параллельная вставка того же пользователя ещё не была видна нашему снимку
+                row = await conn.fetchrow(IDENTITY_SQL, telegram_id)
+        identity = (row['user'], row['profile'])
+        self._remember(telegram_id, identity)
+        return identity
+
+    def invalidate(self, telegram_id):
+        self.cache.pop(telegram_id, None)
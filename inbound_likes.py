@@ -0,0 +1,116 @@
+import time
+from config import MatchmakingSettings
+from seen import filter_unseen
+
+# Создаём экземпляры настроек
+matchmaking_settings = MatchmakingSettings()
+
+# «Кто меня лайкнул»: для каждой анкеты отсортированное множество Redis likes:{profile_id}
+# с id лайкнувших и временем лайка в качестве балла. Лайк добавляется при свайпе, любой
+# ответный свайп владельца убирает лайкнувшего. Ключ likes:{profile_id}:built означает,
+# что множество достроено по Interactions; без него множество сначала перестраивается
+LIKERS_SQL = """
+    SELECT i.from_profile_id, extract(epoch FROM i.created_at) AS liked_at
+    FROM Interactions i
+    WHERE i.to_profile_id = $1 AND i.action = 'like'
+    AND NOT EXISTS (
+        SELECT 1 FROM Interactions r
+        WHERE r.from_profile_id = $1 AND r.to_profile_id = i.from_profile_id
+    )
+"""
+
+# Те же условия, что и в CANDIDATES_SQL, кроме города: лайк важнее расстояния
+ELIGIBLE_LIKERS_SQL = """
+    SELECT p.id
+    FROM Profiles p
+    WHERE p.id = ANY($1::int[])
+    AND p.gender = $2
+    AND p.age BETWEEN $3 AND $4
+    AND $5 BETWEEN p.pref_age_min AND p.pref_age_max
+    AND NOT EXISTS (
+        SELECT 1 FROM MatchEdges e
+        WHERE e.profile_id = $6 AND e.other_profile_id = p.id
+    )
+"""
+
+def likes_key(profile_id):
+    return f"likes:{profile_id}"
+
+def built_key(profile_id):
+    return f"likes:{profile_id}:built"
+
+async def record_like(redis_client, from_profile_id, to_profile_id):
+    """Добавляет лайк в индекс получателя. Вызывается после записи лайка, не создавшего мэтч."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zadd(likes_key(to_profile_id), {from_profile_id: time.time()})
+        pipe.expire(likes_key(to_profile_id), matchmaking_settings.inbound_likes_ttl)
+        await pipe.execute()
+
+async def forget_liker(redis_client, viewer_id, profile_id):
+    """Зритель ответил на анкету (лайком или пропуском) — она больше не ждёт в его «кто меня лайкнул»."""
+    await redis_client.zrem(likes_key(viewer_id), profile_id)
+
+async def rebuild_likes(conn, redis_client, profile_id, reset=False):
+    """Достраивает индекс по Interactions и ставит признак готовности; reset=True строит с нуля."""
+    rows = await conn.fetch(LIKERS_SQL, profile_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if reset:
+            pipe.delete(likes_key(profile_id))
+        if rows:
+            pipe.zadd(likes_key(profile_id), {row['from_profile_id']: float(row['liked_at']) for row in rows})
+            pipe.expire(likes_key(profile_id), matchmaking_settings.inbound_likes_ttl)
+        pipe.set(built_key(profile_id), 1, ex=matchmaking_settings.inbound_likes_ttl)
+        await pipe.execute()
+    return len(rows)
+
+async def take_likers(conn, redis_client, profile, gender, exclude_ids, count):
+    """
+    Забирает из индекса до count самых свежих лайкнувших, которые подходят зрителю,
+    ещё не просмотрены и не лежат в exclude_ids. Из индекса удаляются только
+    просмотренные и неподходящие: выданные остаются в нём до свайпа (forget_liker),
+    чтобы пережить сброс очереди кандидатов, а от повторной выдачи их бережёт exclude_ids.
+    """
+    if count <= 0:
+        return []
+    profile_id = profile['id']
+    if not await redis_client.exists(built_key(profile_id)):
+        await rebuild_likes(conn, redis_client, profile_id)
+
+    # Берём с запасом: часть лайкнувших отсеется фильтрами, а уже выданные лежат в exclude_ids
+    excluded = set(exclude_ids)
+    liker_ids = [
+        int(liker_id)
+        for liker_id in await redis_client.zrevrange(likes_key(profile_id), 0, count * 3 + len(excluded) - 1)
+    ]
+    if not liker_ids:
+        return []
+    unseen = await filter_unseen(
+        conn, redis_client, profile_id, [liker_id for liker_id in liker_ids if liker_id not in excluded]
+    )
+    eligible = {row['id'] for row in await conn.fetch(
+        ELIGIBLE_LIKERS_SQL, unseen, gender, profile['pref_age_min'], profile['pref_age_max'],
+        profile['age'], profile_id
+    )}
+    taken = [liker_id for liker_id in unseen if liker_id in eligible][:count]
+
+    # Убираем просмотренных и неподходящих; выданные и не влезшие в count остаются
+    dropped = [liker_id for liker_id in liker_ids if liker_id not in eligible and liker_id not in excluded]
+    if dropped:
+        await redis_client.zrem(likes_key(profile_id), *dropped)
+    return taken
+
+def mix_in(regular_ids, boosted_ids, ratio):
+    """
+    Вставляет boosted_ids в regular_ids примерно по одному на каждые 1/ratio позиций,
+    начиная с первой. Если обычные кандидаты кончились, оставшиеся boosted идут в конец.
+    """
+    if not boosted_ids:
+        return list(regular_ids)
+    every = max(1, round(1 / ratio))
+    boosted = list(boosted_ids)
+    mixed = []
+    for i, candidate_id in enumerate(regular_ids):
+        if i % every == 0 and boosted:
+            mixed.append(boosted.pop(0))
+        mixed.append(candidate_id)
+    return mixed + boosted
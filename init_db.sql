@@ -1,10 +1,88 @@
 DROP TABLE IF EXISTS Messages;
+DROP TABLE IF EXISTS MatchEdges;
 DROP TABLE IF EXISTS Matches;
 DROP TABLE IF EXISTS Interactions;
+DROP TABLE IF EXISTS SkipRollups;
 DROP TABLE IF EXISTS Photos;
 DROP TABLE IF EXISTS Ratings;
 DROP TABLE IF EXISTS Profiles;
 DROP TABLE IF EXISTS Users;
+DROP TABLE IF EXISTS Cities;
+DROP TABLE IF EXISTS Interests;
+
+-- Справочник городов. Координаты есть у городов из начального списка; города, которые
+-- пользователи вводят впервые, добавляются ботом без координат (cities.resolve_city)
+CREATE TABLE Cities (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    normalized_name TEXT NOT NULL UNIQUE, -- cities.normalize_city: нижний регистр, ё -> е, без «г.»
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    -- Точка для KNN-поиска ближайших городов (равнопромежуточная проекция с параллелью 55°):
+    -- долгота сжата на cos(55°), чтобы градус по обеим осям был примерно одной длины
+    -- и порядок по <-> совпадал с порядком по расстоянию между соседними городами
+    location POINT GENERATED ALWAYS AS (point(longitude * cos(radians(55)), latitude)) STORED
+);
+
+CREATE INDEX idx_cities_location ON Cities USING GIST (location);
+
+INSERT INTO Cities (name, normalized_name, latitude, longitude) VALUES
+    ('Москва', 'москва', 55.7558, 37.6173),
+    ('Санкт-Петербург', 'санкт-петербург', 59.9343, 30.3351),
+    ('Новосибирск', 'новосибирск', 55.0084, 82.9357),
+    ('Екатеринбург', 'екатеринбург', 56.8389, 60.6057),
+    ('Казань', 'казань', 55.7963, 49.1088),
+    ('Нижний Новгород', 'нижний новгород', 56.2965, 43.9361),
+    ('Челябинск', 'челябинск', 55.1644, 61.4368),
+    ('Красноярск', 'красноярск', 56.0153, 92.8932),
+    ('Самара', 'самара', 53.1959, 50.1002),
+    ('Уфа', 'уфа', 54.7388, 55.9721),
+    ('Ростов-на-Дону', 'ростов-на-дону', 47.2357, 39.7015),
+    ('Омск', 'омск', 54.9885, 73.3242),
+    ('Краснодар', 'краснодар', 45.0355, 38.9753),
+    ('Воронеж', 'воронеж', 51.672, 39.1843),
+    ('Пермь', 'пермь', 58.0105, 56.2502),
+    ('Волгоград', 'волгоград', 48.708, 44.5133),
+    ('Саратов', 'саратов', 51.5331, 46.0342),
+    ('Тюмень', 'тюмень', 57.1522, 65.5272),
+    ('Тольятти', 'тольятти', 53.5078, 49.4204),
+    ('Ижевск', 'ижевск', 56.8526, 53.2045),
+    ('Барнаул', 'барнаул', 53.3548, 83.7698),
+    ('Ульяновск', 'ульяновск', 54.3142, 48.4031),
+    ('Иркутск', 'иркутск', 52.287, 104.305),
+    ('Хабаровск', 'хабаровск', 48.4802, 135.0719),
+    ('Ярославль', 'ярославль', 57.6261, 39.8845),
+    ('Владивосток', 'владивосток', 43.1155, 131.8855),
+    ('Махачкала', 'махачкала', 42.9849, 47.5047),
+    ('Томск', 'томск', 56.4846, 84.9476),
+    ('Оренбург', 'оренбург', 51.7682, 55.0969),
+    ('Кемерово', 'кемерово', 55.3547, 86.0873),
+    ('Новокузнецк', 'новокузнецк', 53.7557, 87.1099),
+    ('Рязань', 'рязань', 54.6269, 39.6916),
+    ('Набережные Челны', 'набережные челны', 55.7436, 52.3958),
+    ('Астрахань', 'астрахань', 46.3479, 48.0336),
+    ('Пенза', 'пенза', 53.1959, 45.0183),
+    ('Киров', 'киров', 58.6035, 49.668),
+    ('Липецк', 'липецк', 52.6031, 39.5708),
+    ('Чебоксары', 'чебоксары', 56.1439, 47.2489),
+    ('Калининград', 'калининград', 54.7104, 20.4522),
+    ('Тула', 'тула', 54.1931, 37.6173),
+    ('Курск', 'курск', 51.7373, 36.1874),
+    ('Ставрополь', 'ставрополь', 45.0428, 41.9734),
+    ('Сочи', 'сочи', 43.5855, 39.7231),
+    ('Тверь', 'тверь', 56.8587, 35.9176),
+    ('Калуга', 'калуга', 54.5293, 36.2754),
+    ('Владимир', 'владимир', 56.1291, 40.4066),
+    ('Смоленск', 'смоленск', 54.7826, 32.0453),
+    ('Мурманск', 'мурманск', 68.9585, 33.0827),
+    ('Архангельск', 'архангельск', 64.5399, 40.5152),
+    ('Петрозаводск', 'петрозаводск', 61.7849, 34.3469);
+
+-- Словарь интересов: id задаёт бит интереса в Profiles.interest_vector (interests.pack_interests)
+CREATE TABLE Interests (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE -- interests.normalize_interests: нижний регистр, ё -> е, одиночные пробелы
+);
 
 -- Создаём таблицу Users
 CREATE TABLE Users (
@@ -20,34 +98,71 @@ CREATE INDEX idx_users_telegram_id ON Users(telegram_id);
 -- Создаём таблицу Profiles
 CREATE TABLE Profiles (
     id SERIAL PRIMARY KEY,
-    user_id INTEGER NOT NULL REFERENCES Users(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL UNIQUE REFERENCES Users(id) ON DELETE CASCADE, -- Одна анкета на пользователя; индекс ограничения служит и для поиска по user_id
     nickname VARCHAR(255) NOT NULL,
     age INTEGER NOT NULL,
     gender TEXT NOT NULL CHECK (gender IN ('м', 'ж')),
     interests TEXT,
-    city TEXT NOT NULL,
+    interest_vector BYTEA NOT NULL DEFAULT '', -- Битовый вектор интересов по словарю Interests для ранжирования кандидатов
+    city TEXT NOT NULL, -- Название из Cities.name, для показа в анкете
+    city_id INTEGER NOT NULL REFERENCES Cities(id),
+    -- Какой возраст партнёра интересен; фильтр двусторонний: кандидат должен подходить зрителю и наоборот
+    pref_age_min INTEGER NOT NULL DEFAULT 18,
+    pref_age_max INTEGER NOT NULL DEFAULT 100,
     bio TEXT,
-    profile_completeness INTEGER NOT NULL CHECK (profile_completeness >= 0 AND profile_completeness <= 100),
+    -- Счётчики ведут триггеры на Photos, Matches и Interactions; расхождения исправляет
+    -- задача tasks.reconcile_counters. Из них без соединений считаются рейтинг и заполненность
+    photo_count INTEGER NOT NULL DEFAULT 0,
+    match_count INTEGER NOT NULL DEFAULT 0,
+    likes_given INTEGER NOT NULL DEFAULT 0,
+    likes_received INTEGER NOT NULL DEFAULT 0,
+    -- Все обязательные поля анкеты дают 80%, каждое из первых двух фото — ещё по 10%
+    profile_completeness INTEGER GENERATED ALWAYS AS (80 + 10 * LEAST(photo_count, 2)) STORED
+        CHECK (profile_completeness >= 0 AND profile_completeness <= 100),
+    combined_rating FLOAT NOT NULL DEFAULT 0.0, -- Денормализованная копия Ratings.combined_rating для сортировки кандидатов
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Индексы для быстрого поиска по user_id, gender и city
-CREATE INDEX idx_profiles_user_id ON Profiles(user_id);
-CREATE INDEX idx_profiles_gender ON Profiles(gender);
-CREATE INDEX idx_profiles_city ON Profiles(city);
-CREATE INDEX idx_profiles_gender_city ON Profiles(gender, city); -- Композитный индекс для поиска по gender и city одновременно
+-- Композитные индексы для выдачи кандидатов по рейтингу с keyset-пагинацией:
+-- сначала анкеты из того же города, затем из ближайших городов по одному, затем из всех остальных.
+-- Возраст и предпочтения по возрасту — хвостовые ключи: фильтр по ним проверяется на записях
+-- индекса, и в таблицу читаются только подходящие анкеты, а порядок по рейтингу сохраняется
+CREATE INDEX idx_profiles_gender_city_rating
+    ON Profiles(gender, city_id, combined_rating DESC, id DESC, age, pref_age_min, pref_age_max);
+CREATE INDEX idx_profiles_gender_rating
+    ON Profiles(gender, combined_rating DESC, id DESC, age, pref_age_min, pref_age_max);
 
 -- Создаём таблицу Photos
 CREATE TABLE Photos (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL REFERENCES Users(id) ON DELETE CASCADE,
     object_key VARCHAR(255) NOT NULL,
+    file_id TEXT, -- Telegram file_id после первой загрузки фото, позволяет не загружать байты повторно
     uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Индекс для быстрого поиска фотографий по user_id и сортировки по uploaded_at
 CREATE INDEX idx_photos_user_id ON Photos(user_id);
 CREATE INDEX idx_photos_uploaded_at ON Photos(uploaded_at);
+CREATE INDEX idx_photos_object_key ON Photos(object_key); -- Для записи file_id по object_key после загрузки в Telegram
+
+-- Profiles.photo_count меняется в той же транзакции, что и Photos
+CREATE OR REPLACE FUNCTION sync_photo_count()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE Profiles SET photo_count = photo_count + 1 WHERE user_id = NEW.user_id;
+        RETURN NEW;
+    END IF;
+
+    UPDATE Profiles SET photo_count = photo_count - 1 WHERE user_id = OLD.user_id;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_photos_sync_count
+AFTER INSERT OR DELETE ON Photos
+FOR EACH ROW EXECUTE FUNCTION sync_photo_count();
 
 -- Создаём таблицу Ratings
 CREATE TABLE Ratings (
@@ -62,19 +177,72 @@ CREATE TABLE Ratings (
 -- Индекс для быстрого поиска рейтингов по profile_id
 CREATE INDEX idx_ratings_profile_id ON Ratings(profile_id);
 
--- Создаём таблицу Interactions
+-- Создаём таблицу Interactions. Таблица разбита на 16 hash-секций по from_profile_id:
+-- все запросы свайпа и фильтра «уже видел» идут по зрителю и попадают в одну секцию,
+-- а индексы секций в разы меньше общего. Ключ секционирования обязан входить в первичный
+-- ключ, поэтому суррогатного id нет — пара (from_profile_id, to_profile_id) сама является ключом
 CREATE TABLE Interactions (
-    id SERIAL PRIMARY KEY,
     from_profile_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
     to_profile_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
     action TEXT NOT NULL CHECK (action IN ('like', 'skip')),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT interactions_pkey PRIMARY KEY (from_profile_id, to_profile_id) -- Один свайп на пару, индекс покрывает и поиск по from_profile_id
+) PARTITION BY HASH (from_profile_id);
+
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE interactions_p%s PARTITION OF Interactions FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i
+        );
+    END LOOP;
+END $$;
 
--- Индексы для быстрого поиска взаимодействий
-CREATE INDEX idx_interactions_from_profile_id ON Interactions(from_profile_id);
+-- Поиск по получателю: «кто меня лайкнул» и каскадное удаление анкеты. Отдельного индекса
+-- по action нет: у поля два значения, планировщик его не выбирал, а каждая вставка его обновляла
 CREATE INDEX idx_interactions_to_profile_id ON Interactions(to_profile_id);
-CREATE INDEX idx_interactions_action ON Interactions(action);
+
+-- Profiles.likes_given и likes_received для лайков. Обе анкеты обновляются одним запросом
+-- по возрастанию id, как и в sync_match_edges, поэтому свайпы разных пар не дают взаимоблокировок.
+-- Пропуски, основная часть записей, триггер не вызывают вовсе
+CREATE OR REPLACE FUNCTION sync_like_counts()
+RETURNS TRIGGER AS $$
+DECLARE
+    swipe Interactions%ROWTYPE;
+    delta INTEGER;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        swipe := NEW;
+        delta := 1;
+    ELSE
+        swipe := OLD;
+        delta := -1;
+    END IF;
+
+    UPDATE Profiles
+    SET likes_given = likes_given + CASE WHEN id = swipe.from_profile_id THEN delta ELSE 0 END,
+        likes_received = likes_received + CASE WHEN id = swipe.to_profile_id THEN delta ELSE 0 END
+    WHERE id IN (swipe.from_profile_id, swipe.to_profile_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_interactions_like_insert
+AFTER INSERT ON Interactions
+FOR EACH ROW WHEN (NEW.action = 'like') EXECUTE FUNCTION sync_like_counts();
+
+CREATE TRIGGER trg_interactions_like_delete
+AFTER DELETE ON Interactions
+FOR EACH ROW WHEN (OLD.action = 'like') EXECUTE FUNCTION sync_like_counts();
+
+-- Пропуски старше SKIP_RETENTION_DAYS задача tasks.compact_skips удаляет из Interactions
+-- и прибавляет к счётчикам анкеты. После этого пропущенная анкета снова может попасть в выдачу
+CREATE TABLE SkipRollups (
+    profile_id INTEGER PRIMARY KEY REFERENCES Profiles(id) ON DELETE CASCADE,
+    skips_given INTEGER NOT NULL DEFAULT 0, -- сколько анкет пропустил сам
+    skips_received INTEGER NOT NULL DEFAULT 0, -- сколько раз пропустили его анкету
+    compacted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
 
 -- Создаём таблицу Matches
 CREATE TABLE Matches (
@@ -82,13 +250,76 @@ CREATE TABLE Matches (
     profile1_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
     profile2_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    CONSTRAINT unique_match UNIQUE (profile1_id, profile2_id)
+    CONSTRAINT unique_match UNIQUE (profile1_id, profile2_id),
+    CONSTRAINT canonical_match CHECK (profile1_id < profile2_id) -- Пара хранится в одном порядке, поэтому unique_match исключает и зеркальный дубль
 );
 
 -- Индексы для быстрого поиска мэтчей
 CREATE INDEX idx_matches_profile1_id ON Matches(profile1_id);
 CREATE INDEX idx_matches_profile2_id ON Matches(profile2_id);
 
+-- Зеркало Matches: по строке на каждую сторону мэтча. «Есть ли мэтч у пары» и «мэтчи анкеты»
+-- читаются одним поиском по первичному ключу (index-only), без OR по profile1_id и profile2_id
+CREATE TABLE MatchEdges (
+    profile_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
+    other_profile_id INTEGER NOT NULL REFERENCES Profiles(id) ON DELETE CASCADE,
+    match_id INTEGER NOT NULL,
+    PRIMARY KEY (profile_id, other_profile_id)
+);
+
+-- MatchEdges и Profiles.match_count меняются в той же транзакции, что и Matches.
+-- Обе анкеты обновляются по возрастанию id, поэтому встречные мэтчи не дают взаимоблокировок
+CREATE OR REPLACE FUNCTION sync_match_edges()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO MatchEdges (profile_id, other_profile_id, match_id)
+        VALUES (NEW.profile1_id, NEW.profile2_id, NEW.id), (NEW.profile2_id, NEW.profile1_id, NEW.id);
+        UPDATE Profiles SET match_count = match_count + 1 WHERE id IN (NEW.profile1_id, NEW.profile2_id);
+        RETURN NEW;
+    END IF;
+
+    DELETE FROM MatchEdges
+    WHERE (profile_id, other_profile_id) IN ((OLD.profile1_id, OLD.profile2_id), (OLD.profile2_id, OLD.profile1_id));
+    UPDATE Profiles SET match_count = match_count - 1 WHERE id IN (OLD.profile1_id, OLD.profile2_id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_matches_sync_edges
+AFTER INSERT OR DELETE ON Matches
+FOR EACH ROW EXECUTE FUNCTION sync_match_edges();
+
+-- Свайп одной операцией: идемпотентно записывает взаимодействие, проверяет встречный лайк
+-- и создаёт мэтч. Advisory-блокировка на пару сериализует встречные свайпы, иначе два
+-- одновременных лайка не видят незакоммиченные строки друг друга и мэтч теряется
+CREATE OR REPLACE FUNCTION record_swipe(p_from_profile_id INTEGER, p_to_profile_id INTEGER, p_action TEXT)
+RETURNS TABLE (recorded BOOLEAN, matched BOOLEAN, match_id INTEGER) AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(LEAST(p_from_profile_id, p_to_profile_id), GREATEST(p_from_profile_id, p_to_profile_id));
+
+    INSERT INTO Interactions (from_profile_id, to_profile_id, action)
+    VALUES (p_from_profile_id, p_to_profile_id, p_action)
+    ON CONFLICT (from_profile_id, to_profile_id) DO NOTHING;
+    recorded := FOUND;
+    matched := FALSE;
+    match_id := NULL;
+
+    IF recorded AND p_action = 'like' AND EXISTS (
+        SELECT 1 FROM Interactions
+        WHERE from_profile_id = p_to_profile_id AND to_profile_id = p_from_profile_id AND action = 'like'
+    ) THEN
+        INSERT INTO Matches (profile1_id, profile2_id)
+        VALUES (LEAST(p_from_profile_id, p_to_profile_id), GREATEST(p_from_profile_id, p_to_profile_id))
+        ON CONFLICT (profile1_id, profile2_id) DO NOTHING
+        RETURNING id INTO match_id;
+        matched := match_id IS NOT NULL;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Создаём таблицу Messages (для будущей функциональности чата)
 CREATE TABLE Messages (
     id SERIAL PRIMARY KEY,
@@ -0,0 +1,83 @@
+import numpy as np
+from config import MatchmakingSettings
+
+# Создаём экземпляры настроек
+matchmaking_settings = MatchmakingSettings()
+
+# Интересы анкеты хранятся битовым вектором фиксированной длины в Profiles.interest_vector:
+# бит (id - 1) % INTEREST_BITS для каждого интереса из словаря Interests. Пока словарь
+# меньше INTEREST_BITS, коллизий нет; дальше биты редких интересов начинают совпадать
+INTEREST_BITS = matchmaking_settings.interest_vector_bits
+INTEREST_BYTES = INTEREST_BITS // 8
+
+# Добавляет новые интересы в словарь и возвращает id всех переданных
+RESOLVE_INTERESTS_SQL = """
+    WITH inserted AS (
+        INSERT INTO Interests (name) SELECT unnest($1::text[])
+        ON CONFLICT (name) DO NOTHING
+        RETURNING id
+    )
+    SELECT id FROM inserted
+    UNION ALL
+    SELECT id FROM Interests WHERE name = ANY($1::text[])
+"""
+
+def normalize_interests(text):
+    """«Музыка, кино,  музыка» -> ["музыка", "кино"]: регистр, ё, пробелы, без повторов и пустых."""
+    names = []
+    for item in (text or "").split(","):
+        name = " ".join(item.lower().replace("ё", "е").split())
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def pack_interests(interest_ids):
+    bits = 0
+    for interest_id in interest_ids:
+        bits |= 1 << ((interest_id - 1) % INTEREST_BITS)
+    return bits.to_bytes(INTEREST_BYTES, "little")
+
+async def interest_vector(conn, text):
+    """Битовый вектор интересов из текста анкеты; новые интересы попадают в словарь."""
+    names = normalize_interests(text)
+    if not names:
+        return pack_interests([])
+    rows = await conn.fetch(RESOLVE_INTERESTS_SQL, names)
+    return pack_interests({row['id'] for row in rows})
+
+def to_matrix(vectors):
+    """Векторы (bytes) -> матрица uint64 размером (len(vectors), INTEREST_BITS / 64)."""
+    packed = b"".join(vector.ljust(INTEREST_BYTES, b"\0")[:INTEREST_BYTES] for vector in vectors)
+    return np.frombuffer(packed, dtype=np.uint64).reshape(len(vectors), INTEREST_BYTES // 8)
+
+def jaccard(viewer, candidates):
+    """Сходство Жаккара строки viewer с каждой строкой матрицы candidates; 0, если у обоих нет интересов."""
+    common = np.bitwise_count(candidates & viewer).sum(axis=1, dtype=np.uint32)
+    union = np.bitwise_count(candidates | viewer).sum(axis=1, dtype=np.uint32)
+    return np.divide(common, union, out=np.zeros(len(candidates)), where=union > 0)
+
+def blended_scores(viewer, candidates, ratings, weight):
+    """
+    Итоговый балл кандидатов: (1 - weight) * рейтинг, нормированный на максимум пачки,
+    плюс weight * сходство интересов. ratings — массив combined_rating той же длины.
+    """
+    ratings = np.asarray(ratings, dtype=np.float64)
+    top = ratings.max(initial=0.0)
+    normalized = ratings / top if top > 0 else np.zeros_like(ratings)
+    return (1 - weight) * normalized + weight * jaccard(viewer, candidates)
+
+def rank_by_interests(viewer_vector, rows, weight):
+    """
+    Переупорядочивает строки кандидатов (id, combined_rating, interest_vector) по убыванию
+    смешанного балла. При равных баллах сохраняется исходный порядок по рейтингу.
+    """
+    if len(rows) < 2 or weight <= 0:
+        return [row['id'] for row in rows]
+    scores = blended_scores(
+        to_matrix([viewer_vector])[0],
+        to_matrix([row['interest_vector'] for row in rows]),
+        [row['combined_rating'] for row in rows],
+        weight
+    )
+    order = np.argsort(-scores, kind="stable")
+    return [rows[i]['id'] for i in order]
@@ -1,17 +1,15 @@
-import pika
-import json
+import signal
 import asyncio
-import asyncpg
 import logging
-import threading
 import redis.asyncio as redis
-from config import RedisSettings, PostgresSettings, RabbitMQSettings # нужные переменные из config.py и .env
+from config import RedisSettings, RabbitMQSettings, MatchmakingSettings # нужные переменные из config.py и .env
 from celery import Celery
+from messaging import EventConsumer, EventCoalescer, MATCHMAKING_STATS_KEY
 
 # Создаём экземпляры настроек
-postgres_settings = PostgresSettings()
 rabbitmq_settings = RabbitMQSettings()
 redis_settings = RedisSettings()
+matchmaking_settings = MatchmakingSettings()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,106 +22,42 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Celery('tasks', broker=redis_settings.redis_url)
-
 redis_client = redis.Redis(host=redis_settings.redis_host, port=redis_settings.redis_port, decode_responses=True)
 
-async def init_db():
-    logger.info("Initializing database pool")
-    pool = await asyncpg.create_pool(
-        user=postgres_settings.postgres_user,
-        password=postgres_settings.postgres_password,
-        database=postgres_settings.postgres_db,
-        host=postgres_settings.postgres_host
-    )
-    logger.info("Database pool initialized successfully")
-    return pool
-
-
-def get_rabbitmq_connection():
-    credentials = pika.PlainCredentials(rabbitmq_settings.rabbitmq_user, rabbitmq_settings.rabbitmq_password)
-    return pika.BlockingConnection(pika.ConnectionParameters(
-        host=rabbitmq_settings.rabbitmq_host,
-        credentials=credentials
-    ))
-
-async def cache_profiles(pool):
-    async with pool.acquire() as conn:
-        profiles = await conn.fetch(
-            """
-            SELECT p.id, p.age, p.gender, p.city, p.interests, r.combined_rating
-            FROM Profiles p
-            JOIN Ratings r ON p.id = r.profile_id
-            ORDER BY r.combined_rating DESC
-            LIMIT 10
-            """
-        )
-    for profile in profiles:
-        await redis_client.setex(
-            f"profile:{profile['id']}",
-            3600,
-            json.dumps(dict(profile))
-        )
-
-async def calculate_ratings(pool, user_id):
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
-            return
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user['id'])
-        if not profile:
-            return
-
-        photo_count = await conn.fetchval(
-            "SELECT COUNT(*) FROM Photos WHERE user_id = $1", user['id']
-        )
-
-        match_count = await conn.fetchval(
-            """
-            SELECT COUNT(*)
-            FROM Matches
-            WHERE profile1_id = $1 OR profile2_id = $1
-            """,
-            profile['id']
-        )
-
-        primary = 0
-        if profile["age"]: primary += 1
-        if profile["gender"]: primary += 1
-        if profile["interests"]: primary += 1
-        if profile["city"]: primary += 1
-        primary += photo_count
-
-        behavior = match_count * 2
-        combined = primary + behavior
+async def dispatch_ratings(user_id):
+    # send_task блокирует на время записи в брокер Celery, поэтому уходит в поток
+    await asyncio.to_thread(app.send_task, 'tasks.calculate_ratings', args=[user_id]) # вызываем пересчет рейтинга через celery
+    logger.info(f"Sent task to recalculate ratings for user {user_id}")
 
-        await conn.execute(
-            """
-            UPDATE Ratings
-            SET primary_rating = $1, behavioral_rating = $2, combined_rating = $3, updated_at = NOW()
-            WHERE profile_id = $4
-            """,
-            primary, behavior, combined, profile['id']
-        )
+# Несколько сохранений анкеты подряд и мэтчи дают одну задачу пересчёта на пользователя за окно
+coalescer = EventCoalescer(
+    dispatch_ratings, matchmaking_settings.event_window_ms, redis_client, MATCHMAKING_STATS_KEY
+)
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
+async def handle_event(data):
     user_id = data["user_id"]
     logger.info(f"Processing user {user_id}")
-    asyncio.run_coroutine_threadsafe(cache_profiles(pool), loop)
-    app.send_task('tasks.calculate_ratings', args=[user_id]) # вызываем пересчет рейтинга через celery
-    logger.info(f"Sent task to recalculate ratings for user {user_id}")
+    await coalescer.submit(user_id)
+
+async def main():
+    # Обработчик почти всё время ждёт закрытия окна, поэтому параллельность равна prefetch:
+    # число удерживаемых событий ограничивает сам брокер
+    consumer = EventConsumer(
+        rabbitmq_settings, "matchmaking", handle_event,
+        prefetch_count=matchmaking_settings.event_prefetch_count,
+        concurrency=matchmaking_settings.event_prefetch_count
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
 
-def run_asyncio_loop(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
+    await consumer.start()
+    logger.info("Matchmaking Service started...")
+    await stop_event.wait()
+    logger.info("Stopping Matchmaking Service")
+    await consumer.stop()
+    await redis_client.aclose()
 
 if __name__ == "__main__":
-    connection = get_rabbitmq_connection()
-    channel = connection.channel()
-    channel.queue_declare(queue="matchmaking")
-    loop = asyncio.get_event_loop()
-    pool = loop.run_until_complete(init_db())
-    threading.Thread(target=run_asyncio_loop, args=(loop,), daemon=True).start()
-    channel.basic_consume(queue="matchmaking", on_message_callback=callback, auto_ack=True)
-    logger.info("Matchmaking Service started...")
-    channel.start_consuming()
\ No newline at end of file
+    asyncio.run(main())
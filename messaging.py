@@ -0,0 +1,193 @@
+import json
+import asyncio
+import logging
+import aio_pika
+
+logger = logging.getLogger(__name__)
+
+class EventPublisher:
+    """
+    Долгоживущий издатель RabbitMQ: одно robust-соединение и один канал на процесс.
+    Очереди объявляются один раз при подключении, после обрыва aio-pika
+    переподключается и восстанавливает канал сам.
+    """
+
+    def __init__(self, rabbitmq_settings, queues):
+        self.settings = rabbitmq_settings
+        self.queues = queues
+        self.connection = None
+        self.channel = None
+
+    async def connect(self):
+        self.connection = await aio_pika.connect_robust(
+            host=self.settings.rabbitmq_host,
+            login=self.settings.rabbitmq_user,
+            password=self.settings.rabbitmq_password
+        )
+        self.channel = await self.connection.channel(
+            publisher_confirms=self.settings.rabbitmq_publisher_confirms
+        )
+        for queue in self.queues:
+            await self.channel.declare_queue(queue)
+        logger.info(f"RabbitMQ publisher connected, queues declared: {', '.join(self.queues)}")
+
+    async def publish(self, queue, payload):
+        # С включёнными подтверждениями ждём ack брокера, иначе только запись в сокет
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(body=json.dumps(payload).encode(), content_type="application/json"),
+            routing_key=queue
+        )
+
+    async def publish_many(self, messages):
+        """Публикует пары (queue, payload) разом, ожидая подтверждения всей пачки, а не каждого по очереди."""
+        await asyncio.gather(*(self.publish(queue, payload) for queue, payload in messages))
+
+    async def close(self):
+        if self.connection:
+            await self.connection.close()
+
+class EventConsumer:
+    """
+    Потребитель очереди RabbitMQ на aio-pika с ручным подтверждением. Брокер выдаёт
+    не больше prefetch_count неподтверждённых сообщений, обработчик выполняется не
+    больше чем в concurrency задачах одновременно. Сообщение подтверждается только
+    после успешной обработки, поэтому при падении процесса брокер отдаст его заново.
+    Упавшее сообщение возвращается в очередь один раз, при повторной ошибке отбрасывается.
+    """
+
+    def __init__(self, rabbitmq_settings, queue, handler, prefetch_count, concurrency):
+        self.settings = rabbitmq_settings
+        self.queue_name = queue
+        self.handler = handler
+        self.prefetch_count = prefetch_count
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.connection = None
+        self.queue = None
+        self.consumer_tag = None
+        self.in_flight = set()
+
+    async def start(self):
+        self.connection = await aio_pika.connect_robust(
+            host=self.settings.rabbitmq_host,
+            login=self.settings.rabbitmq_user,
+            password=self.settings.rabbitmq_password
+        )
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        self.queue = await channel.declare_queue(self.queue_name)
+        self.consumer_tag = await self.queue.consume(self._on_message)
+        logger.info(
+            f"Consuming {self.queue_name}: prefetch {self.prefetch_count}, "
+            f"concurrency {self.concurrency}"
+        )
+
+    async def _on_message(self, message):
+        task = asyncio.current_task()
+        self.in_flight.add(task)
+        try:
+            async with self.semaphore:
+                try:
+                    await self.handler(json.loads(message.body))
+                except Exception as e:
+                    requeue = not message.redelivered
+                    logger.error(
+                        f"Failed to handle message from {self.queue_name} "
+                        f"({'requeued' if requeue else 'dropped'}): {str(e)}"
+                    )
+                    await message.nack(requeue=requeue)
+                else:
+                    await message.ack()
+        finally:
+            self.in_flight.discard(task)
+
+    async def stop(self):
+        """Перестаёт брать новые сообщения и дожидается обработки уже взятых."""
+        if self.queue and self.consumer_tag:
+            await self.queue.cancel(self.consumer_tag)
+        if self.in_flight:
+            await asyncio.gather(*self.in_flight, return_exceptions=True)
+        if self.connection:
+            await self.connection.close()
+
+# Счётчики слияния событий matchmaking_service, читаются эндпоинтом /metrics бота
+MATCHMAKING_STATS_KEY = "matchmaking:stats"
+
+class EventCoalescer:
+    """
+    Сливает события с одинаковым ключом: первое событие открывает окно в window_ms,
+    все события ключа, пришедшие до его закрытия, ждут одного вызова dispatch(key).
+    submit возвращается только после dispatch, поэтому сообщения RabbitMQ, которые
+    ждут окно, остаются неподтверждёнными и при падении процесса не теряются.
+    Число событий, вызовов dispatch и неудачных окон (с их событиями) накапливается
+    в хеше Redis stats_key.
+    """
+
+    def __init__(self, dispatch, window_ms, redis_client, stats_key):
+        self.dispatch = dispatch
+        self.window = window_ms / 1000
+        self.redis_client = redis_client
+        self.stats_key = stats_key
+        self.windows = {}
+        self.window_events = {}
+        self.tasks = set()
+        self.pending = {"events": 0, "dispatched": 0, "failed": 0, "failed_events": 0}
+
+    async def submit(self, key):
+        self.pending["events"] += 1
+        future = self.windows.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.windows[key] = future
+            task = asyncio.create_task(self._close(key, future))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self.window_events[key] = self.window_events.get(key, 0) + 1
+        # shield: отмена одного ожидающего не должна отменять общее окно
+        await asyncio.shield(future)
+
+    async def _close(self, key, future):
+        await asyncio.sleep(self.window)
+        # События, пришедшие во время dispatch, открывают уже новое окно
+        del self.windows[key]
+        events = self.window_events.pop(key)
+        try:
+            await self.dispatch(key)
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение заберут ожидающие; если их уже нет, не пишем предупреждение в лог
+            future.exception()
+            # События неудачного окна вернутся в очередь и придут снова, слиянием они не считаются
+            self.pending["failed"] += 1
+            self.pending["failed_events"] += events
+        else:
+            future.set_result(None)
+            self.pending["dispatched"] += 1
+        await self._flush_stats()
+
+    async def _flush_stats(self):
+        counters, self.pending = self.pending, dict.fromkeys(self.pending, 0)
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for field, value in counters.items():
+                    pipe.hincrby(self.stats_key, field, value)
+                await pipe.execute()
+        except Exception as e:
+            for field, value in counters.items():
+                self.pending[field] += value
+            logger.warning(f"Failed to flush coalescing stats: {str(e)}")
+
+async def coalescing_stats(redis_client, stats_key):
+    """Доля слитых событий считается только по окнам, для которых dispatch прошёл успешно."""
+    stats = await redis_client.hgetall(stats_key)
+    events, dispatched = int(stats.get("events", 0)), int(stats.get("dispatched", 0))
+    failed, failed_events = int(stats.get("failed", 0)), int(stats.get("failed_events", 0))
+    delivered = events - failed_events
+    return {
+        "events": events,
+        "dispatched": dispatched,
+        "failed": failed,
+        "failed_events": failed_events,
+        "coalesced": delivered - dispatched,
+        "coalesce_ratio": round(1 - dispatched / delivered, 4) if delivered > 0 else None
+    }
@@ -1,18 +1,22 @@
-import pika
 import json
+import signal
+import hashlib
 import logging
 import asyncio
-import threading
-from config import TelegramSettings, MinIOSettings, RabbitMQSettings  # нужные переменные из config.py и .env
+import redis.asyncio as redis
+from config import TelegramSettings, MinIOSettings, RabbitMQSettings, RedisSettings  # нужные переменные из config.py и .env
 from minio import Minio
-from minio.error import S3Error
-from aiogram.types import BufferedInputFile, InputMediaPhoto
 from aiogram import Bot
+from photo_store import PhotoStore
+from messaging import EventConsumer
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from send_scheduler import SendScheduler, PRIORITY_MATCH, PRIORITY_LOW
 
 # Создаём экземпляры настроек
 telegram_settings = TelegramSettings()
 minio_settings = MinIOSettings()
 rabbitmq_settings = RabbitMQSettings()
+redis_settings = RedisSettings()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,6 +29,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=telegram_settings.bot_token)
+redis_client = redis.Redis(host=redis_settings.redis_host, port=redis_settings.redis_port, decode_responses=True)
 minio_client = Minio(
     "minio:9000",
     access_key=minio_settings.minio_root_user,
@@ -37,15 +42,45 @@ if not minio_client:
     raise ValueError("MinIO credentials not provided")
 
 bucket_name = "photos"
+photo_store = PhotoStore(
+    minio_client, bucket_name,
+    cache_max_bytes=minio_settings.photo_cache_max_bytes,
+    workers=minio_settings.photo_fetch_workers,
+    redis_client=redis_client
+)
+
+# Все вызовы Bot API идут через планировщик: общий лимит, интервал на чат и повтор после 429
+scheduler = SendScheduler(
+    rate=telegram_settings.send_rate,
+    burst=telegram_settings.send_burst,
+    chat_interval=telegram_settings.send_chat_interval,
+    max_retries=telegram_settings.send_max_retries
+)
+
+PRIORITIES = {"match": PRIORITY_MATCH, "low": PRIORITY_LOW}
+
+def delivery_key(data):
+    # Повторно доставленное брокером сообщение имеет то же тело, а значит и тот же ключ
+    digest = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    return f"notify:delivered:{digest}"
 
-def get_rabbitmq_connection():
-    credentials = pika.PlainCredentials(rabbitmq_settings.rabbitmq_user, rabbitmq_settings.rabbitmq_password)
-    return pika.BlockingConnection(pika.ConnectionParameters(
-        host=rabbitmq_settings.rabbitmq_host,
-        credentials=credentials
-    ))
+async def mark_delivered(delivered_key, part):
+    if not delivered_key:
+        return
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(delivered_key, part, 1)
+        pipe.expire(delivered_key, telegram_settings.notification_delivered_ttl)
+        await pipe.execute()
 
-async def send_telegram_notification(user_info, object_keys=None):
+async def send_telegram_notification(user_info, object_keys=None, file_ids=None, priority=PRIORITY_MATCH, delivered_key=None):
+    """
+    Отправляет уведомление о мэтче. Постоянные ошибки (бот заблокирован, чат не найден)
+    только логируются, остальные пробрасываются, чтобы EventConsumer вернул событие
+    в очередь. Уже отправленные части отмечаются в хеше delivered_key и при повторной
+    обработке не дублируются.
+    """
+    chat_id = user_info['to_user_id']
+    delivered = await redis_client.hgetall(delivered_key) if delivered_key else {}
     try:
         candidate_text = (
             f"У тебя новый мэтч!\n"
@@ -55,48 +90,57 @@ async def send_telegram_notification(user_info, object_keys=None):
             f"Интересы: {user_info['interests']}\n"
             f"Город: {user_info['city']}."
         )
-        if object_keys:
-            # Создаём список медиа для отправки
-            media = []
-            for photo in object_keys:
-                response = minio_client.get_object(bucket_name, photo)
-                photo_data = response.read()
-                response.close()
-                response.release_conn()
-                photo_file = BufferedInputFile(
-                    file=photo_data,
-                    filename="profile_photo.jpg"
-                )
-                media.append(InputMediaPhoto(media=photo_file)) # photo_file может быть file_id, URL или BufferedInputFile)
-            # Отправляем все фото с текстом анкеты
-            await bot.send_media_group(user_info['to_user_id'], media=media)
-            await bot.send_message(user_info['to_user_id'], text=candidate_text)
-        else:
-            await bot.send_message(user_info['to_user_id'], text=candidate_text)
-    except S3Error as e:
-        logger.error(f"Error retrieving photo from MinIO: {str(e)}")
-        await bot.send_message(user_info['to_user_id'], text=candidate_text)
-    except Exception as e:
-        logger.error(f"Failed to send notification to {user_info['to_user_id']}: {str(e)}")
-        await bot.send_message(user_info['to_user_id'], text="Произошла ошибка при отправке уведомления.")
+        # Отправляем все фото с текстом анкеты: по file_id, если Telegram его уже выдал,
+        # иначе байтами из MinIO
+        if object_keys and "photos" not in delivered:
+            await scheduler.submit(
+                chat_id, lambda: photo_store.send_photos(bot, chat_id, object_keys, file_ids),
+                priority=priority, cost=len(object_keys)
+            )
+            await mark_delivered(delivered_key, "photos")
+        if "text" not in delivered:
+            await scheduler.submit(chat_id, lambda: bot.send_message(chat_id, text=candidate_text), priority=priority)
+            await mark_delivered(delivered_key, "text")
+    except TelegramForbiddenError:
+        logger.info(f"User {chat_id} blocked the bot, notification dropped")
+    except TelegramBadRequest as e:
+        logger.error(f"Telegram rejected notification to {chat_id}, dropped: {str(e)}")
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
+async def handle_event(data):
     user_info = data["user_info"]
-    object_keys = data.get("object_keys")
     logger.info(f"Processing notification for user {user_info['to_user_id']}")
-    asyncio.run_coroutine_threadsafe(send_telegram_notification(user_info, object_keys), loop)
+    priority = PRIORITIES.get(data.get("priority", "match"), PRIORITY_LOW)
+    await send_telegram_notification(
+        user_info, data.get("object_keys"), data.get("file_ids"), priority, delivered_key=delivery_key(data)
+    )
 
-def run_asyncio_loop(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
+async def log_send_stats():
+    while True:
+        await asyncio.sleep(telegram_settings.send_stats_interval)
+        logger.info(f"Send scheduler stats: {scheduler.stats()}")
 
-if __name__ == "__main__":
-    connection = get_rabbitmq_connection()
-    channel = connection.channel()
-    channel.queue_declare(queue="notifications")
-    loop = asyncio.get_event_loop()
-    threading.Thread(target=run_asyncio_loop, args=(loop,), daemon=True).start()
-    channel.basic_consume(queue="notifications", on_message_callback=callback, auto_ack=True)
+async def main():
+    consumer = EventConsumer(
+        rabbitmq_settings, "notifications", handle_event,
+        prefetch_count=rabbitmq_settings.rabbitmq_prefetch_count,
+        concurrency=rabbitmq_settings.rabbitmq_consumer_concurrency
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    scheduler.start()
+    stats_task = asyncio.create_task(log_send_stats())
+    await consumer.start()
     logger.info("Notification Service started...")
-    channel.start_consuming()
\ No newline at end of file
+    await stop_event.wait()
+    logger.info("Stopping Notification Service")
+    await consumer.stop()
+    await scheduler.stop()
+    stats_task.cancel()
+    logger.info(f"Send scheduler stats: {scheduler.stats()}")
+    await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
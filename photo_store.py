@@ -0,0 +1,155 @@
+import io
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from minio.error import S3Error
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, InputMediaPhoto
+
+logger = logging.getLogger(__name__)
+
+def file_id_key(object_key):
+    return f"photo_file_id:{object_key}"
+
+class PhotoStore:
+    """
+    Асинхронная обёртка над MinIO: синхронный клиент minio выполняется в пуле потоков,
+    фото одной анкеты скачиваются параллельно, а недавно показанные фото
+    хранятся в LRU-кэше, ограниченном суммарным размером в байтах.
+    Telegram file_id уже загруженных фото зеркалируются в Redis по object_key,
+    чтобы повторные показы не скачивали и не загружали байты заново.
+    """
+
+    def __init__(self, minio_client, bucket_name, cache_max_bytes, workers, redis_client=None):
+        self.minio_client = minio_client
+        self.bucket_name = bucket_name
+        self.redis_client = redis_client
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="minio")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _download(self, object_key):
+        response = self.minio_client.get_object(self.bucket_name, object_key)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _cache_put(self, object_key, data):
+        if len(data) > self.cache_max_bytes:
+            return
+        if object_key in self.cache:
+            self.cache_bytes -= len(self.cache.pop(object_key))
+        self.cache[object_key] = data
+        self.cache_bytes += len(data)
+        while self.cache_bytes > self.cache_max_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
+
+    def _cache_evict(self, object_key):
+        data = self.cache.pop(object_key, None)
+        if data is not None:
+            self.cache_bytes -= len(data)
+
+    async def get(self, object_key):
+        data = self.cache.get(object_key)
+        if data is not None:
+            self.cache.move_to_end(object_key)
+            return data
+        data = await self._run(self._download, object_key)
+        self._cache_put(object_key, data)
+        return data
+
+    async def get_many(self, object_keys):
+        """Скачивает фото параллельно. Вместо фото, которые не удалось получить, возвращает None."""
+        results = await asyncio.gather(*(self.get(key) for key in object_keys), return_exceptions=True)
+        photos = []
+        for object_key, result in zip(object_keys, results):
+            if isinstance(result, S3Error):
+                logger.error(f"Error retrieving photo {object_key} from MinIO: {str(result)}")
+                result = None
+            elif isinstance(result, BaseException):
+                raise result
+            photos.append(result)
+        return photos
+
+    async def put(self, object_key, data, content_type="image/jpeg"):
+        await self._run(
+            lambda: self.minio_client.put_object(
+                self.bucket_name, object_key, io.BytesIO(data), length=len(data), content_type=content_type
+            )
+        )
+        self._cache_put(object_key, data)
+
+    async def remove(self, object_key):
+        self._cache_evict(object_key)
+        await self._run(self.minio_client.remove_object, self.bucket_name, object_key)
+
+    async def get_file_ids(self, object_keys):
+        if not self.redis_client or not object_keys:
+            return [None] * len(object_keys)
+        return await self.redis_client.mget([file_id_key(key) for key in object_keys])
+
+    async def remember_file_ids(self, file_ids):
+        """Сохраняет в Redis соответствие object_key -> Telegram file_id."""
+        if self.redis_client and file_ids:
+            await self.redis_client.mset({file_id_key(key): file_id for key, file_id in file_ids.items()})
+
+    async def forget_file_ids(self, object_keys):
+        if self.redis_client and object_keys:
+            await self.redis_client.delete(*[file_id_key(key) for key in object_keys])
+
+    async def send_photos(self, bot, chat_id, object_keys, file_ids=None):
+        """
+        Отправляет фото анкеты медиагруппой. Фото с известным file_id отправляются без загрузки
+        байтов; остальные скачиваются из MinIO. Если Telegram отверг file_id, вся группа
+        отправляется заново байтами. Возвращает {object_key: file_id} для фото, загруженных байтами.
+        """
+        if not object_keys:
+            return {}
+        if file_ids is None:
+            file_ids = await self.get_file_ids(object_keys)
+        else:
+            # file_id, которых нет в переданном списке, пробуем найти в Redis
+            missing = [key for key, file_id in zip(object_keys, file_ids) if not file_id]
+            cached = dict(zip(missing, await self.get_file_ids(missing)))
+            file_ids = [file_id or cached.get(key) for key, file_id in zip(object_keys, file_ids)]
+
+        if any(file_ids):
+            try:
+                return await self._send(bot, chat_id, object_keys, file_ids)
+            except TelegramBadRequest as e:
+                logger.warning(f"Telegram rejected cached file_id for chat {chat_id}, re-uploading: {str(e)}")
+                await self.forget_file_ids([key for key, file_id in zip(object_keys, file_ids) if file_id])
+        return await self._send(bot, chat_id, object_keys, [None] * len(object_keys))
+
+    async def _send(self, bot, chat_id, object_keys, file_ids):
+        upload_keys = [key for key, file_id in zip(object_keys, file_ids) if not file_id]
+        downloaded = dict(zip(upload_keys, await self.get_many(upload_keys)))
+
+        sent_keys, media = [], []
+        for key, file_id in zip(object_keys, file_ids):
+            if file_id:
+                media.append(InputMediaPhoto(media=file_id))
+            elif downloaded[key] is not None:
+                media.append(InputMediaPhoto(media=BufferedInputFile(file=downloaded[key], filename="profile_photo.jpg")))
+            else:
+                continue
+            sent_keys.append(key)
+        if not media:
+            return {}
+
+        messages = await bot.send_media_group(chat_id, media=media)
+        new_file_ids = {
+            key: sent.photo[-1].file_id
+            for key, sent in zip(sent_keys, messages)
+            if key in downloaded and sent.photo
+        }
+        await self.remember_file_ids(new_file_ids)
+        return new_file_ids
@@ -0,0 +1,148 @@
+import json
+from redis.exceptions import WatchError
+
+# Карточка анкеты — всё, что нужно для показа в /find, /view и в уведомлении о мэтче:
+# поля анкеты, telegram_id владельца и три последних фото
+PROFILE_CARDS_SQL = """
+    SELECT p.id AS profile_id, p.user_id, u.telegram_id, p.nickname, p.age, p.gender, p.interests, p.city,
+           p.profile_completeness,
+           COALESCE(ph.object_keys, '{}') AS object_keys, COALESCE(ph.file_ids, '{}') AS file_ids
+    FROM Profiles p
+    JOIN Users u ON u.id = p.user_id
+    LEFT JOIN LATERAL (
+        SELECT array_agg(recent.object_key ORDER BY recent.uploaded_at DESC) AS object_keys,
+               array_agg(recent.file_id ORDER BY recent.uploaded_at DESC) AS file_ids
+        FROM (
+            SELECT object_key, file_id, uploaded_at FROM Photos
+            WHERE user_id = p.user_id
+            ORDER BY uploaded_at DESC
+            LIMIT 3
+        ) recent
+    ) ph ON TRUE
+    WHERE p.id = ANY($1::int[])
+"""
+
+CARD_FIELDS = (
+    "profile_id", "user_id", "telegram_id", "nickname", "age", "gender", "interests", "city",
+    "profile_completeness", "object_keys", "file_ids"
+)
+INT_FIELDS = ("profile_id", "user_id", "telegram_id", "age", "profile_completeness")
+LIST_FIELDS = ("object_keys", "file_ids")
+
+STATS_KEY = "profile_cache:stats"
+
+def profile_key(profile_id):
+    return f"profile:{profile_id}"
+
+def generation_key(profile_id):
+    return f"profile:{profile_id}:gen"
+
+def _encode(row):
+    card = dict(row)
+    for field in LIST_FIELDS:
+        card[field] = json.dumps(list(card[field]))
+    # В хеше нет NULL, поэтому пустые поля не пишем вовсе и при чтении восстанавливаем как None
+    return {field: value for field, value in card.items() if value is not None}
+
+def _decode(fields):
+    card = {field: fields.get(field) for field in CARD_FIELDS}
+    for field in INT_FIELDS:
+        if card[field] is not None:
+            card[field] = int(card[field])
+    for field in LIST_FIELDS:
+        card[field] = json.loads(card[field])
+    return card
+
+class ProfileCache:
+    """
+    Read-through кэш карточек анкет в Redis: хеш profile:{id} на анкету. Промахи читаются
+    из БД одним запросом на всю пачку и записываются одним конвейером. Запись анкеты
+    или её фото должна вызывать invalidate. invalidate увеличивает поколение анкеты
+    profile:{id}:gen, и карточка, прочитанная из БД до сброса, в кэш уже не попадёт.
+    Счётчики попаданий копятся в процессе и уходят в общий хеш profile_cache:stats
+    вместе со следующим чтением.
+    """
+
+    def __init__(self, redis_client, ttl):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.pending_hits = 0
+        self.pending_misses = 0
+
+    async def get_many(self, pool, profile_ids):
+        """Возвращает {profile_id: карточка}; анкет, которых нет в БД, в ответе нет."""
+        if not profile_ids:
+            return {}
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for profile_id in profile_ids:
+                pipe.hgetall(profile_key(profile_id))
+            if self.pending_hits or self.pending_misses:
+                pipe.hincrby(STATS_KEY, "hits", self.pending_hits)
+                pipe.hincrby(STATS_KEY, "misses", self.pending_misses)
+                self.pending_hits = self.pending_misses = 0
+            results = await pipe.execute()
+
+        cards = {
+            profile_id: _decode(fields)
+            for profile_id, fields in zip(profile_ids, results) if fields
+        }
+        missing = [profile_id for profile_id in profile_ids if profile_id not in cards]
+        self.pending_hits += len(cards)
+        self.pending_misses += len(missing)
+        if not missing:
+            return cards
+
+        # Поколения запоминаем до чтения из БД: если между чтением и записью в кэш
+        # анкету сбросят, поколение сменится и устаревшая карточка не запишется
+        generations = dict(zip(missing, await self.redis_client.mget(
+            [generation_key(profile_id) for profile_id in missing]
+        )))
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(PROFILE_CARDS_SQL, missing)
+        if rows:
+            await self._store(rows, generations)
+        for row in rows:
+            card = dict(row)
+            for field in LIST_FIELDS:
+                card[field] = list(card[field])
+            cards[row['profile_id']] = card
+        return cards
+
+    async def _store(self, rows, generations):
+        keys = [generation_key(row['profile_id']) for row in rows]
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            try:
+                # WATCH закрывает окно между сверкой поколений и записью
+                await pipe.watch(*keys)
+                current = await pipe.mget(keys)
+                pipe.multi()
+                for row, generation in zip(rows, current):
+                    if generation == generations[row['profile_id']]:
+                        pipe.hset(profile_key(row['profile_id']), mapping=_encode(row))
+                        pipe.expire(profile_key(row['profile_id']), self.ttl)
+                await pipe.execute()
+            except WatchError:
+                # Анкету сбросили прямо сейчас: в кэш ничего не пишем, следующее чтение возьмёт из БД
+                pass
+
+    async def get(self, pool, profile_id):
+        return (await self.get_many(pool, [profile_id])).get(profile_id)
+
+    async def invalidate(self, *profile_ids):
+        profile_ids = [profile_id for profile_id in profile_ids if profile_id is not None]
+        if not profile_ids:
+            return
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(*[profile_key(profile_id) for profile_id in profile_ids])
+            for profile_id in profile_ids:
+                pipe.incr(generation_key(profile_id))
+                # Поколение нужно, только пока идут чтения, начатые до сброса
+                pipe.expire(generation_key(profile_id), self.ttl)
+            await pipe.execute()
+
+    async def stats(self):
+        """Счётчики попаданий всех процессов бота (без ещё не отправленных локальных)."""
+        stats = await self.redis_client.hgetall(STATS_KEY)
+        hits, misses = int(stats.get("hits", 0)), int(stats.get("misses", 0))
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_ratio": round(hits / total, 4) if total else None}
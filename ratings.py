@@ -0,0 +1,13 @@
+# Множество id профилей, рейтинг которых нужно пересчитать: анкету отредактировали,
+# добавили или удалили фото, по ней был свайп или мэтч
+DIRTY_RATINGS_KEY = "ratings:dirty"
+
+async def mark_dirty(redis_client, *profile_ids):
+    """Помечает профили для пересчёта рейтинга на ближайшем тике celery beat."""
+    profile_ids = [profile_id for profile_id in profile_ids if profile_id is not None]
+    if profile_ids:
+        await redis_client.sadd(DIRTY_RATINGS_KEY, *profile_ids)
+
+async def pop_dirty(redis_client, count):
+    """Забирает из множества до count профилей. Возвращает список id."""
+    return [int(profile_id) for profile_id in await redis_client.spop(DIRTY_RATINGS_KEY, count)]
@@ -1,17 +1,23 @@
 -- Удаляем все данные из таблиц (сохраняем структуру)
 DELETE FROM Messages;
+DELETE FROM MatchEdges;
 DELETE FROM Matches;
 DELETE FROM Interactions;
+DELETE FROM SkipRollups;
 DELETE FROM Photos;
 DELETE FROM Ratings;
 DELETE FROM Profiles;
 DELETE FROM Users;
+DELETE FROM Interests;
+-- Города из начального списка (с координатами) оставляем, добавленные пользователями удаляем
+DELETE FROM Cities WHERE location IS NULL;
 
 -- Сбрасываем последовательност
 ALTER SEQUENCE Users_id_seq RESTART WITH 1;
 ALTER SEQUENCE Profiles_id_seq RESTART WITH 1;
 ALTER SEQUENCE Photos_id_seq RESTART WITH 1;
 ALTER SEQUENCE Ratings_id_seq RESTART WITH 1;
-ALTER SEQUENCE Interactions_id_seq RESTART WITH 1;
 ALTER SEQUENCE Matches_id_seq RESTART WITH 1;
-ALTER SEQUENCE Messages_id_seq RESTART WITH 1;
\ No newline at end of file
+ALTER SEQUENCE Messages_id_seq RESTART WITH 1;
+ALTER SEQUENCE Interests_id_seq RESTART WITH 1;
+SELECT setval('Cities_id_seq', (SELECT MAX(id) FROM Cities));
@@ -0,0 +1,104 @@
+import hashlib
+from config import MatchmakingSettings
+
+# Создаём экземпляры настроек
+matchmaking_settings = MatchmakingSettings()
+
+# Фильтр Блума «уже видел» для каждого зрителя: битовая строка Redis фиксированного размера
+# seen_filter_bits бит, так что память на пользователя ограничена независимо от числа свайпов.
+# Бит сразу за фильтром — признак того, что фильтр достроен по Interactions: без него
+# отрицательный ответ ничего не гарантирует и фильтр сначала перестраивается
+FILTER_BITS = matchmaking_settings.seen_filter_bits
+FILTER_HASHES = matchmaking_settings.seen_filter_hashes
+READY_BIT = FILTER_BITS
+
+# Точная проверка для положительных ответов фильтра
+SEEN_SQL = """
+    SELECT to_profile_id FROM Interactions
+    WHERE from_profile_id = $1 AND to_profile_id = ANY($2::int[])
+"""
+
+def seen_key(profile_id):
+    return f"seen:{profile_id}"
+
+def pending_skips_key(profile_id):
+    """
+    Множество анкет, пропущенных зрителем, но ещё лежащих в буфере swipes:skips: точная
+    проверка по Interactions их пока не видит. Запись в буфер добавляет анкету сюда,
+    SkipFlusher убирает после коммита.
+    """
+    return f"skips:pending:{profile_id}"
+
+def offsets(profile_id):
+    """Позиции битов анкеты в фильтре (двойное хеширование одного blake2b)."""
+    digest = hashlib.blake2b(str(profile_id).encode(), digest_size=8).digest()
+    h1 = int.from_bytes(digest[:4], "little")
+    h2 = int.from_bytes(digest[4:], "little") | 1
+    return [(h1 + i * h2) % FILTER_BITS for i in range(FILTER_HASHES)]
+
+async def mark_seen(redis_client, viewer_id, *profile_ids):
+    """Добавляет анкеты в фильтр зрителя. Вызывается при каждом свайпе, до записи в БД."""
+    bitfield = redis_client.bitfield(seen_key(viewer_id))
+    for profile_id in profile_ids:
+        for offset in offsets(profile_id):
+            bitfield.set("u1", offset, 1)
+    await bitfield.execute()
+    await redis_client.expire(seen_key(viewer_id), matchmaking_settings.seen_filter_ttl)
+
+async def rebuild_seen(conn, redis_client, viewer_id, reset=False):
+    """
+    Достраивает фильтр по Interactions и ставит признак готовности. Биты, выставленные
+    свайпами, не сбрасываются; reset=True строит фильтр с нуля.
+    """
+    seen_ids = [row['to_profile_id'] for row in await conn.fetch(
+        "SELECT to_profile_id FROM Interactions WHERE from_profile_id = $1", viewer_id
+    )]
+    key = seen_key(viewer_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if reset:
+            pipe.delete(key)
+        bitfield = pipe.bitfield(key)
+        for profile_id in seen_ids:
+            for offset in offsets(profile_id):
+                bitfield.set("u1", offset, 1)
+        bitfield.set("u1", READY_BIT, 1)
+        bitfield.execute()
+        pipe.expire(key, matchmaking_settings.seen_filter_ttl)
+        await pipe.execute()
+    return len(seen_ids)
+
+async def _probe(redis_client, viewer_id, candidate_ids):
+    bitfield = redis_client.bitfield(seen_key(viewer_id))
+    bitfield.get("u1", READY_BIT)
+    for candidate_id in candidate_ids:
+        for offset in offsets(candidate_id):
+            bitfield.get("u1", offset)
+    bits = await bitfield.execute()
+    ready, bits = bits[0], bits[1:]
+    maybe_seen = [
+        candidate_id for i, candidate_id in enumerate(candidate_ids)
+        if all(bits[i * FILTER_HASHES:(i + 1) * FILTER_HASHES])
+    ]
+    return ready, maybe_seen
+
+async def filter_unseen(conn, redis_client, viewer_id, candidate_ids):
+    """
+    Убирает из candidate_ids анкеты, по которым зритель уже свайпал. Тех, на кого фильтр
+    ответил «возможно, видел», проверяем по буферу пропусков, а оставшихся — точно в БД.
+    conn может быть и пулом: тогда соединение берётся, только если запрос в БД действительно нужен.
+    """
+    if not candidate_ids:
+        return []
+    ready, maybe_seen = await _probe(redis_client, viewer_id, candidate_ids)
+    if not ready:
+        await rebuild_seen(conn, redis_client, viewer_id)
+        ready, maybe_seen = await _probe(redis_client, viewer_id, candidate_ids)
+    if not maybe_seen:
+        return candidate_ids
+    # Пропуски из буфера ещё не в Interactions, поэтому сначала проверяем их
+    pending = await redis_client.smismember(pending_skips_key(viewer_id), maybe_seen)
+    seen = {candidate_id for candidate_id, is_pending in zip(maybe_seen, pending) if is_pending}
+    unconfirmed = [candidate_id for candidate_id in maybe_seen if candidate_id not in seen]
+    if unconfirmed:
+        seen |= {row['to_profile_id'] for row in await conn.fetch(SEEN_SQL, viewer_id, unconfirmed)}
+    return [candidate_id for candidate_id in candidate_ids if candidate_id not in seen]
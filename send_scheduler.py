@@ -0,0 +1,171 @@
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше число, тем раньше уходит отправка: уведомления о мэтчах идут впереди остального
+PRIORITY_MATCH = 0
+PRIORITY_LOW = 1
+
+class SendJob:
+    """Один вызов Bot API в очереди: send — корутинная функция без аргументов."""
+
+    def __init__(self, chat_id, send, priority, cost, seq, future):
+        self.chat_id = chat_id
+        self.send = send
+        self.priority = priority
+        self.cost = cost
+        self.seq = seq
+        self.future = future
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+class SendScheduler:
+    """
+    Планировщик вызовов Bot API с учётом лимитов Telegram. Общий темп задаёт
+    token bucket (rate отправок в секунду, запас burst), в один чат отправки
+    идут не чаще раза в chat_interval секунд. Из готовых к отправке первой уходит
+    задача с меньшим priority, при равном — более ранняя. На TelegramRetryAfter
+    чат ставится на паузу на retry_after секунд, а задача возвращается в очередь;
+    после max_retries таких ответов ошибка отдаётся вызывающему.
+    """
+
+    def __init__(self, rate, burst, chat_interval, max_retries):
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.pending = []
+        self.chat_ready_at = {}
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.dispatching = None  # задача, снятая с очереди и ждущая токенов
+        self.in_flight = set()
+        self.started_at = time.monotonic()
+        self.counters = {"sent": 0, "retry_after": 0, "failed": 0}
+        self.wait_total = 0.0
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дожидается отправки всего, что уже в очереди."""
+        while self.pending or self.dispatching or self.in_flight:
+            if self.in_flight:
+                await asyncio.gather(*self.in_flight, return_exceptions=True)
+            else:
+                await asyncio.sleep(0.05)
+        if self.task:
+            self.task.cancel()
+
+    async def submit(self, chat_id, send, priority=PRIORITY_MATCH, cost=1):
+        """
+        Ставит вызов в очередь и ждёт его выполнения; возвращает результат send().
+        cost — сколько сообщений вызов расходует из общего лимита (медиагруппа — по фото).
+        """
+        self.seq += 1
+        job = SendJob(
+            chat_id=chat_id, send=send, priority=priority, cost=min(max(cost, 1), self.burst),
+            seq=self.seq, future=asyncio.get_running_loop().create_future()
+        )
+        self.pending.append(job)
+        self.wakeup.set()
+        return await job.future
+
+    def _pick(self, now):
+        """Самая приоритетная задача из тех, чей чат уже можно беспокоить, и время до ближайшей."""
+        best, next_at = None, None
+        for job in self.pending:
+            ready_at = self.chat_ready_at.get(job.chat_id, 0.0)
+            if ready_at > now:
+                next_at = ready_at if next_at is None else min(next_at, ready_at)
+            elif best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                best = job
+        return best, next_at
+
+    async def _take_tokens(self, cost):
+        # Списываем сразу и, если ушли в минус, ждём, пока ведро снова наполнится до нуля
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        self.tokens -= cost
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            job, next_at = self._pick(now)
+            if job is None:
+                timeout = None if next_at is None else next_at - now
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.pending.remove(job)
+            self.dispatching = job
+            await self._take_tokens(job.cost)
+            # Интервал чата отсчитываем от фактической отправки, а не от выбора задачи:
+            # ожидание токенов иначе съедало бы его
+            now = time.monotonic()
+            self.chat_ready_at[job.chat_id] = now + self.chat_interval
+            task = asyncio.create_task(self._send(job))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+            self.dispatching = None
+            self._forget_idle_chats(now)
+
+    async def _send(self, job):
+        try:
+            result = await job.send()
+        except TelegramRetryAfter as e:
+            self.counters["retry_after"] += 1
+            now = time.monotonic()
+            self.chat_ready_at[job.chat_id] = now + e.retry_after
+            # 429 может означать и превышение общего лимита: сжигаем запас ведра
+            self.tokens = min(self.tokens, 0.0)
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self.counters["failed"] += 1
+                job.future.set_exception(e)
+                return
+            logger.warning(f"Telegram asked to retry chat {job.chat_id} after {e.retry_after}s, requeued")
+            self.pending.append(job)
+            self.wakeup.set()
+        except Exception as e:
+            self.counters["failed"] += 1
+            job.future.set_exception(e)
+        else:
+            self.counters["sent"] += 1
+            self.wait_total += time.monotonic() - job.enqueued_at
+            job.future.set_result(result)
+
+    def _forget_idle_chats(self, now):
+        if len(self.chat_ready_at) > 10000:
+            self.chat_ready_at = {
+                chat_id: ready_at for chat_id, ready_at in self.chat_ready_at.items() if ready_at > now
+            }
+
+    def stats(self):
+        """Счётчики с момента старта, глубина очереди по приоритетам и средняя задержка отправки."""
+        queued = {}
+        for job in self.pending:
+            queued[job.priority] = queued.get(job.priority, 0) + 1
+        elapsed = time.monotonic() - self.started_at
+        sent = self.counters["sent"]
+        return {
+            **self.counters,
+            "queued": queued,
+            "in_flight": len(self.in_flight),
+            "sent_per_sec": round(sent / elapsed, 2) if elapsed else 0.0,
+            "avg_wait_sec": round(self.wait_total / sent, 3) if sent else None,
+        }
@@ -0,0 +1,257 @@
+import time
+import asyncio
+import logging
+import asyncpg
+from redis.exceptions import ResponseError
+from ratings import mark_dirty
+from seen import pending_skips_key
+from config import MatchmakingSettings
+
+# Создаём экземпляры настроек
+matchmaking_settings = MatchmakingSettings()
+
+logger = logging.getLogger(__name__)
+
+# Вся логика свайпа живёт в функции record_swipe из init_db.sql: один запрос вместо
+# проверки, вставки взаимодействия, поиска встречного лайка и вставки мэтча
+SWIPE_SQL = "SELECT recorded, matched, match_id FROM record_swipe($1, $2, $3)"
+
+async def record_swipe(conn, from_profile_id, to_profile_id, action):
+    """
+    Атомарно записывает свайп. Возвращает запись (recorded, matched, match_id):
+    recorded = False, если этот свайп уже был; matched = True, если свайп создал мэтч.
+    """
+    return await conn.fetchrow(SWIPE_SQL, from_profile_id, to_profile_id, action)
+
+# Пропуски не влияют на мэтчи, поэтому пишутся не сразу, а через поток Redis:
+# обработчик подтверждает свайп после XADD, а SkipFlusher пачками переносит записи в Interactions
+SKIP_STREAM_KEY = "swipes:skips"
+SKIP_GROUP = "interactions-writer"
+# Записи, которые Postgres так и не принял, переносятся сюда с текстом ошибки, чтобы не блокировать поток
+SKIP_DEAD_STREAM_KEY = "swipes:skips:dead"
+SKIP_DEAD_MAXLEN = 10000
+
+# Пропуски анкет, удалённых после свайпа, отбрасываются соединением с Profiles, а не падают на внешнем ключе
+INSERT_SKIPS_SQL = """
+    INSERT INTO Interactions (from_profile_id, to_profile_id, action, created_at)
+    SELECT data.from_profile_id, data.to_profile_id, 'skip', to_timestamp(data.created_ms / 1000.0)::timestamp
+    FROM unnest($1::int[], $2::int[], $3::bigint[]) AS data(from_profile_id, to_profile_id, created_ms)
+    JOIN Profiles viewer ON viewer.id = data.from_profile_id
+    JOIN Profiles candidate ON candidate.id = data.to_profile_id
+    ON CONFLICT (from_profile_id, to_profile_id) DO NOTHING
+"""
+
+# Ошибки из-за содержимого записей: повтор той же пачки их не исправит
+REJECTED_ROW_ERRORS = (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError)
+
+async def enqueue_skip(redis_client, from_profile_id, to_profile_id):
+    """Кладёт пропуск в буфер; до записи в Interactions filter_unseen находит его в pending_skips_key."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.xadd(SKIP_STREAM_KEY, {"from": from_profile_id, "to": to_profile_id})
+        pipe.sadd(pending_skips_key(from_profile_id), to_profile_id)
+        pipe.expire(pending_skips_key(from_profile_id), matchmaking_settings.seen_filter_ttl)
+        await pipe.execute()
+
+class SkipFlusher:
+    """
+    Фоновая запись пропусков из потока Redis в Interactions многострочными INSERT.
+    Пачка закрывается по batch_size записей или по истечении interval_ms. Записи
+    подтверждаются (XACK) только после коммита, поэтому при падении процесса они
+    остаются в потоке: свои неподтверждённые записи реплика перечитывает при старте,
+    чужие забирает через XAUTOCLAIM после claim_idle_ms простоя. Если Postgres
+    отвергает пачку, она пишется построчно, а непринятые и нечитаемые записи
+    уходят в SKIP_DEAD_STREAM_KEY и тоже подтверждаются.
+    """
+
+    def __init__(self, pool, redis_client, consumer, batch_size, interval_ms, claim_idle_ms):
+        self.pool = pool
+        self.redis_client = redis_client
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.claim_idle_ms = claim_idle_ms
+        self.task = None
+        self.stopping = False
+        self.read_pending = True  # сначала дочитываем то, что не успели записать в прошлый раз
+        self.last_claim = 0.0
+
+    async def start(self):
+        try:
+            await self.redis_client.xgroup_create(SKIP_STREAM_KEY, SKIP_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает цикл и записывает всё, что уже лежит в потоке."""
+        self.stopping = True
+        if self.task:
+            await self.task
+        try:
+            while await self.flush_once(block_ms=None):
+                pass
+            # Все записи этого потребителя подтверждены, его имя в группе больше не нужно
+            await self.redis_client.xgroup_delconsumer(SKIP_STREAM_KEY, SKIP_GROUP, self.consumer)
+        except Exception as e:
+            # Незаписанное остаётся в потоке, его заберёт другая реплика; остановку бота не прерываем
+            logger.error(f"Failed to flush skips on shutdown: {str(e)}")
+
+    async def _read(self, count, block_ms):
+        if self.read_pending:
+            entries = await self.redis_client.xreadgroup(
+                SKIP_GROUP, self.consumer, {SKIP_STREAM_KEY: "0"}, count=count
+            )
+            entries = entries[0][1] if entries else []
+            if entries:
+                return entries
+            self.read_pending = False
+
+        loop = asyncio.get_running_loop()
+        if loop.time() - self.last_claim >= self.claim_idle_ms / 1000:
+            self.last_claim = loop.time()
+            claimed = (await self.redis_client.xautoclaim(
+                SKIP_STREAM_KEY, SKIP_GROUP, self.consumer, self.claim_idle_ms, count=count
+            ))[1]
+            if claimed:
+                return claimed
+
+        entries = await self.redis_client.xreadgroup(
+            SKIP_GROUP, self.consumer, {SKIP_STREAM_KEY: ">"}, count=count, block=block_ms
+        )
+        return entries[0][1] if entries else []
+
+    async def flush_once(self, block_ms):
+        """Читает и записывает одну пачку. Возвращает число обработанных записей."""
+        batch = await self._read(self.batch_size, block_ms)
+        if batch and len(batch) < self.batch_size and block_ms is not None:
+            # Пачка неполная: ждём до конца интервала, чтобы писать реже и крупнее
+            await asyncio.sleep(self.interval)
+            batch += await self._read(self.batch_size - len(batch), None)
+        if not batch:
+            return 0
+
+        rows, dead = [], []
+        for entry_id, fields in batch:
+            try:
+                rows.append((entry_id, int(fields["from"]), int(fields["to"]), int(entry_id.split("-")[0])))
+            except (KeyError, ValueError) as e:
+                dead.append((entry_id, fields, f"malformed entry: {e!r}"))
+        try:
+            async with self.pool.acquire() as conn:
+                dead += await self._insert(conn, rows)
+        except Exception:
+            # Записи остаются неподтверждёнными и будут перечитаны следующей итерацией
+            self.read_pending = True
+            raise
+
+        entry_ids = [entry_id for entry_id, _ in batch]
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for entry_id, fields, error in dead:
+                pipe.xadd(
+                    SKIP_DEAD_STREAM_KEY, {**fields, "entry_id": entry_id, "error": error},
+                    maxlen=SKIP_DEAD_MAXLEN, approximate=True
+                )
+            pipe.xack(SKIP_STREAM_KEY, SKIP_GROUP, *entry_ids)
+            pipe.xdel(SKIP_STREAM_KEY, *entry_ids)
+            # Пропуски уже видны в Interactions, буфер для проверки «уже видел» больше не нужен
+            for _, from_id, to_id, _ in rows:
+                pipe.srem(pending_skips_key(from_id), to_id)
+            await pipe.execute()
+        if dead:
+            logger.warning(f"{len(dead)} skips moved to {SKIP_DEAD_STREAM_KEY}")
+        dead_ids = {entry_id for entry_id, _, _ in dead}
+        written = [row for row in rows if row[0] not in dead_ids]
+        if written:
+            await mark_dirty(self.redis_client, *{profile_id for row in written for profile_id in row[1:3]})
+        return len(batch)
+
+    async def _insert(self, conn, rows):
+        """
+        Пишет пачку одним INSERT. Если Postgres отверг пачку из-за её содержимого,
+        пишет строки по одной и возвращает непринятые как (entry_id, fields, error).
+        """
+        if not rows:
+            return []
+        try:
+            await conn.execute(INSERT_SKIPS_SQL, *([row[i] for row in rows] for i in (1, 2, 3)))
+            return []
+        except REJECTED_ROW_ERRORS as e:
+            logger.warning(f"Batch of {len(rows)} skips rejected, retrying row by row: {str(e)}")
+        dead = []
+        for entry_id, from_id, to_id, created_ms in rows:
+            try:
+                await conn.execute(INSERT_SKIPS_SQL, [from_id], [to_id], [created_ms])
+            except REJECTED_ROW_ERRORS as e:
+                dead.append((entry_id, {"from": from_id, "to": to_id}, str(e)))
+        return dead
+
+    async def _run(self):
+        while not self.stopping:
+            try:
+                await self.flush_once(block_ms=int(self.interval * 1000))
+            except Exception as e:
+                logger.error(f"Error flushing skips to Interactions: {str(e)}")
+                await asyncio.sleep(self.interval)
+
+# Сворачивание старых пропусков одной секции Interactions: до $2 пропусков старше $1 удаляются,
+# а их число прибавляется к счётчикам обеих анкет в SkipRollups. {partition} — имя секции;
+# ctid однозначен только внутри одной таблицы, поэтому запрос идёт в секцию, а не в родителя
+COMPACT_SKIPS_SQL = """
+    WITH compacted AS (
+        DELETE FROM {partition}
+        WHERE ctid IN (
+            SELECT ctid FROM {partition}
+            WHERE action = 'skip' AND created_at < $1
+            LIMIT $2
+        )
+        RETURNING from_profile_id, to_profile_id
+    ),
+    counts AS (
+        SELECT from_profile_id AS profile_id, 1 AS given, 0 AS received FROM compacted
+        UNION ALL
+        SELECT to_profile_id, 0, 1 FROM compacted
+    ),
+    rolled_up AS (
+        INSERT INTO SkipRollups (profile_id, skips_given, skips_received)
+        SELECT profile_id, SUM(given), SUM(received) FROM counts GROUP BY profile_id
+        ON CONFLICT (profile_id) DO UPDATE
+        SET skips_given = SkipRollups.skips_given + EXCLUDED.skips_given,
+            skips_received = SkipRollups.skips_received + EXCLUDED.skips_received,
+            compacted_at = NOW()
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM compacted) AS compacted,
+           (SELECT COUNT(*) FROM rolled_up) AS profiles
+"""
+
+INTERACTION_PARTITIONS_SQL = """
+    SELECT inhrelid::regclass::text AS partition FROM pg_inherits
+    WHERE inhparent = 'interactions'::regclass
+    ORDER BY inhrelid
+"""
+
+async def compact_skips(pool, retention_days, batch_size):
+    """
+    Сворачивает пропуски старше retention_days в SkipRollups, секция за секцией пачками
+    по batch_size, каждая пачка — отдельная транзакция. Возвращает число удалённых строк.
+    """
+    started = time.monotonic()
+    cutoff = await pool.fetchval("SELECT LOCALTIMESTAMP - make_interval(days => $1)", retention_days)
+    # Несекционированная таблица (старая схема) сворачивается так же, целиком
+    partitions = [row['partition'] for row in await pool.fetch(INTERACTION_PARTITIONS_SQL)] or ["Interactions"]
+    compacted = 0
+    for partition in partitions:
+        sql = COMPACT_SKIPS_SQL.format(partition=partition)
+        while True:
+            result = await pool.fetchrow(sql, cutoff, batch_size)
+            compacted += result['compacted']
+            if result['compacted'] < batch_size:
+                break
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Skips older than {retention_days} days compacted: {compacted} rows from {len(partitions)} partitions "
+        f"in {elapsed:.2f}s"
+    )
+    return compacted
@@ -1,12 +1,20 @@
+import time
 import asyncio
 import asyncpg
 import logging
-from config import RedisSettings, PostgresSettings
+import redis.asyncio as redis
+from config import RedisSettings, PostgresSettings, MatchmakingSettings
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
+from ratings import pop_dirty, mark_dirty
+from seen import rebuild_seen
+from inbound_likes import rebuild_likes
+from swipes import compact_skips
 
 # Создаём экземпляры настроек
 postgres_settings = PostgresSettings()
 redis_settings = RedisSettings()
+matchmaking_settings = MatchmakingSettings()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,70 +36,260 @@ app.conf.update(
 )
 app.config_from_object('celeryconfig')
 
+# Общие на весь процесс воркера цикл событий и подключения; создаются в worker_process_init
+loop = None
+pool = None
+redis_client = None
+
+# Единственная формула рейтинга: пересчёт набора профилей одним запросом. {profile_filter} — условие на p,
+# выбирающее профили для пересчёта. Рейтинг — выражение над строкой Profiles без соединений:
+# primary — заполненные поля анкеты плюс наличие фото (photo_count), behavioral — удвоенный match_count.
+# Строки, рейтинг которых не изменился, не перезаписываются.
+RATINGS_SQL = """
+    WITH scores AS (
+        SELECT p.id AS profile_id,
+               (CASE WHEN p.age <> 0 THEN 1 ELSE 0 END
+                + CASE WHEN p.gender <> '' THEN 1 ELSE 0 END
+                + CASE WHEN COALESCE(p.interests, '') <> '' THEN 1 ELSE 0 END
+                + CASE WHEN p.city <> '' THEN 1 ELSE 0 END
+                + LEAST(1, p.photo_count)) AS primary_rating,
+               p.match_count * 2 AS behavioral_rating
+        FROM Profiles p
+        WHERE {profile_filter}
+    ),
+    updated_profiles AS (
+        UPDATE Profiles p
+        SET combined_rating = s.primary_rating + s.behavioral_rating
+        FROM scores s
+        WHERE p.id = s.profile_id
+        AND p.combined_rating IS DISTINCT FROM s.primary_rating + s.behavioral_rating
+        RETURNING 1
+    ),
+    updated_ratings AS (
+        UPDATE Ratings r
+        SET primary_rating = s.primary_rating,
+            behavioral_rating = s.behavioral_rating,
+            combined_rating = s.primary_rating + s.behavioral_rating,
+            updated_at = NOW()
+        FROM scores s
+        WHERE r.profile_id = s.profile_id
+        AND (r.primary_rating, r.behavioral_rating) IS DISTINCT FROM (s.primary_rating, s.behavioral_rating)
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM scores) AS processed,
+           (SELECT COUNT(*) FROM updated_ratings) AS updated
+"""
+
+# Сверка счётчиков Profiles с исходными таблицами для диапазона id ($1..$2). Поправка
+# прибавляется к текущему значению, а не записывается поверх: изменения триггеров,
+# закоммиченные после снимка запроса, при этом не теряются
+RECONCILE_COUNTERS_SQL = """
+    WITH actual AS (
+        SELECT p.id, p.photo_count, p.match_count, p.likes_given, p.likes_received,
+               (SELECT COUNT(*) FROM Photos ph WHERE ph.user_id = p.user_id) AS actual_photo_count,
+               (SELECT COUNT(*) FROM Matches m WHERE m.profile1_id = p.id)
+               + (SELECT COUNT(*) FROM Matches m WHERE m.profile2_id = p.id) AS actual_match_count,
+               (SELECT COUNT(*) FROM Interactions i
+                WHERE i.from_profile_id = p.id AND i.action = 'like') AS actual_likes_given,
+               (SELECT COUNT(*) FROM Interactions i
+                WHERE i.to_profile_id = p.id AND i.action = 'like') AS actual_likes_received
+        FROM Profiles p
+        WHERE p.id BETWEEN $1 AND $2
+    ),
+    fixed AS (
+        UPDATE Profiles p
+        SET photo_count = p.photo_count + (a.actual_photo_count - a.photo_count),
+            match_count = p.match_count + (a.actual_match_count - a.match_count),
+            likes_given = p.likes_given + (a.actual_likes_given - a.likes_given),
+            likes_received = p.likes_received + (a.actual_likes_received - a.likes_received)
+        FROM actual a
+        WHERE p.id = a.id
+        AND (a.photo_count, a.match_count, a.likes_given, a.likes_received)
+            IS DISTINCT FROM (a.actual_photo_count, a.actual_match_count, a.actual_likes_given, a.actual_likes_received)
+        RETURNING p.id
+    )
+    SELECT (SELECT COUNT(*) FROM actual) AS processed,
+           COALESCE((SELECT array_agg(id) FROM fixed), '{}') AS fixed_ids
+"""
+
 async def init_db():
     return await asyncpg.create_pool(
         user=postgres_settings.postgres_user,
         password=postgres_settings.postgres_password,
         database=postgres_settings.postgres_db,
-        host=postgres_settings.postgres_host
+        host=postgres_settings.postgres_host,
+        min_size=postgres_settings.postgres_pool_min_size,
+        max_size=postgres_settings.postgres_pool_max_size
+    )
+
+@worker_process_init.connect
+def init_worker_runtime(**kwargs):
+    global loop, pool, redis_client
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = loop.run_until_complete(init_db())
+    redis_client = redis.Redis(host=redis_settings.redis_host, port=redis_settings.redis_port, decode_responses=True)
+    logger.info("Worker runtime initialized with database pool")
+
+@worker_process_shutdown.connect
+def shutdown_worker_runtime(**kwargs):
+    if loop is None:
+        return
+    loop.run_until_complete(pool.close())
+    loop.run_until_complete(redis_client.aclose())
+    loop.close()
+
+def run(make_coro):
+    """
+    Выполняет корутину задачи на общем цикле событий процесса воркера.
+    make_coro вызывается уже после инициализации, поэтому может обращаться к pool и redis_client.
+    """
+    if loop is None:
+        # worker_process_init не вызывается для --pool=solo и при вызове задач напрямую
+        init_worker_runtime()
+    return loop.run_until_complete(make_coro())
+
+async def calculate_user_ratings(pool, user_id):
+    result = await pool.fetchrow(
+        RATINGS_SQL.format(profile_filter="p.user_id = (SELECT id FROM Users WHERE telegram_id = $1)"),
+        user_id
     )
+    if not result['processed']:
+        logger.warning(f"Profile for user {user_id} not found")
+        return
+    logger.info(f"Ratings updated for user {user_id}")
 
 @app.task
-async def calculate_ratings(user_id):
-    pool = await init_db()
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
-            logger.warning(f"User with telegram_id {user_id} not found")
-            return
-
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user['id'])
-        if not profile:
-            logger.warning(f"Profile for user {user_id} not found")
-            return
-
-        photo_count = await conn.fetchval(
-            "SELECT COUNT(*) FROM Photos WHERE user_id = $1", user['id']
-        )
+def calculate_ratings(user_id):
+    run(lambda: calculate_user_ratings(pool, user_id))
 
-        match_count = await conn.fetchval(
-            """
-            SELECT COUNT(*)
-            FROM Matches
-            WHERE profile1_id = $1 OR profile2_id = $1
-            """,
-            profile['id']
-        )
+async def recalculate_ratings_bulk(pool, chunk_size):
+    """Пересчитывает рейтинги всех профилей диапазонами id по chunk_size. Возвращает число профилей."""
+    bounds = await pool.fetchrow("SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM Profiles")
+    if bounds['min_id'] is None:
+        return 0
+
+    started = time.monotonic()
+    processed = updated = 0
+    sql = RATINGS_SQL.format(profile_filter="p.id BETWEEN $1 AND $2")
+    for start in range(bounds['min_id'], bounds['max_id'] + 1, chunk_size):
+        # Каждый диапазон — отдельная короткая транзакция, чтобы не держать блокировки на всю таблицу
+        result = await pool.fetchrow(sql, start, start + chunk_size - 1)
+        processed += result['processed']
+        updated += result['updated']
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Bulk ratings recalculated: {processed} profiles ({updated} changed) in {elapsed:.2f}s, "
+        f"{processed / elapsed if elapsed else processed:.0f} rows/sec"
+    )
+    return processed
+
+async def reconcile_counters(pool, redis_client, chunk_size):
+    """
+    Сверяет счётчики всех профилей диапазонами id по chunk_size и исправляет расхождения.
+    Исправленные профили помечаются для пересчёта рейтинга. Возвращает число исправленных.
+    """
+    bounds = await pool.fetchrow("SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM Profiles")
+    if bounds['min_id'] is None:
+        return 0
+
+    started = time.monotonic()
+    processed = fixed = 0
+    for start in range(bounds['min_id'], bounds['max_id'] + 1, chunk_size):
+        result = await pool.fetchrow(RECONCILE_COUNTERS_SQL, start, start + chunk_size - 1)
+        processed += result['processed']
+        if result['fixed_ids']:
+            fixed += len(result['fixed_ids'])
+            await mark_dirty(redis_client, *result['fixed_ids'])
+
+    elapsed = time.monotonic() - started
+    log = logger.warning if fixed else logger.info
+    log(f"Profile counters reconciled: {processed} profiles, {fixed} drifted, in {elapsed:.2f}s")
+    return fixed
 
-        primary = 0
-        if profile["age"]: primary += 1
-        if profile["gender"]: primary += 1
-        if profile["interests"]: primary += 1
-        if profile["city"]: primary += 1
-        primary += min(1, photo_count)
-
-        behavior = match_count * 2
-        combined = primary + behavior
-
-        await conn.execute(
-            """
-            UPDATE Ratings
-            SET primary_rating = $1, behavioral_rating = $2, combined_rating = $3, updated_at = NOW()
-            WHERE profile_id = $4
-            """,
-            primary, behavior, combined, profile['id']
+async def recalculate_dirty_ratings(pool, redis_client, batch_size):
+    """Пересчитывает рейтинги только помеченных профилей пачками по batch_size. Возвращает число профилей."""
+    started = time.monotonic()
+    processed = 0
+    sql = RATINGS_SQL.format(profile_filter="p.id = ANY($1::int[])")
+    while True:
+        profile_ids = await pop_dirty(redis_client, batch_size)
+        if not profile_ids:
+            break
+        try:
+            await pool.fetchrow(sql, profile_ids)
+        except Exception:
+            # Возвращаем пачку в множество, чтобы её подобрал следующий тик
+            await mark_dirty(redis_client, *profile_ids)
+            raise
+        processed += len(profile_ids)
+
+    if processed:
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Dirty ratings recalculated: {processed} profiles in {elapsed:.2f}s, "
+            f"{processed / elapsed if elapsed else processed:.0f} rows/sec"
         )
-        logger.info(f"Ratings updated for user {user_id}: primary={primary}, behavior={behavior}, combined={combined}")
-    await pool.close()
+    return processed
 
 @app.task
 def recalculate_ratings():
-    loop = asyncio.get_event_loop()
-    pool = loop.run_until_complete(init_db())
-    async def run():
-        users = await pool.fetch("SELECT telegram_id FROM Users")
-        for user in users:
-            await calculate_ratings(user["telegram_id"])
-        await pool.close()
-    loop.run_until_complete(run())
-    logger.info("Ratings recalculated")
\ No newline at end of file
+    run(lambda: recalculate_dirty_ratings(pool, redis_client, matchmaking_settings.rating_dirty_batch_size))
+
+@app.task
+def recalculate_all_ratings():
+    run(lambda: recalculate_ratings_bulk(pool, matchmaking_settings.rating_chunk_size))
+    logger.info("Ratings recalculated")
+
+@app.task
+def reconcile_all_counters():
+    run(lambda: reconcile_counters(pool, redis_client, matchmaking_settings.rating_chunk_size))
+
+async def rebuild_seen_filters(pool, redis_client, profile_ids=None):
+    """
+    Строит фильтры «уже видел» с нуля по Interactions. Без profile_ids перестраивает
+    все существующие фильтры; отсутствующие бот построит сам при следующем /find.
+    """
+    if profile_ids is None:
+        profile_ids = [int(key.split(":")[1]) async for key in redis_client.scan_iter(match="seen:*")]
+    async with pool.acquire() as conn:
+        for profile_id in profile_ids:
+            await rebuild_seen(conn, redis_client, profile_id, reset=True)
+    logger.info(f"Seen filters rebuilt for {len(profile_ids)} profiles")
+    return len(profile_ids)
+
+@app.task
+def rebuild_seen_filter(profile_id):
+    run(lambda: rebuild_seen_filters(pool, redis_client, [profile_id]))
+
+@app.task
+def rebuild_all_seen_filters():
+    run(lambda: rebuild_seen_filters(pool, redis_client))
+
+async def rebuild_inbound_likes(pool, redis_client, profile_ids=None):
+    """
+    Строит индексы «кто меня лайкнул» с нуля по Interactions. Без profile_ids перестраивает
+    все существующие индексы; отсутствующие бот построит сам при следующем дозаполнении очереди.
+    """
+    if profile_ids is None:
+        profile_ids = [int(key.split(":")[1]) async for key in redis_client.scan_iter(match="likes:*:built")]
+    async with pool.acquire() as conn:
+        for profile_id in profile_ids:
+            await rebuild_likes(conn, redis_client, profile_id, reset=True)
+    logger.info(f"Inbound likes rebuilt for {len(profile_ids)} profiles")
+    return len(profile_ids)
+
+@app.task
+def rebuild_inbound_likes_index(profile_id):
+    run(lambda: rebuild_inbound_likes(pool, redis_client, [profile_id]))
+
+@app.task
+def rebuild_all_inbound_likes():
+    run(lambda: rebuild_inbound_likes(pool, redis_client))
+
+@app.task
+def compact_old_skips():
+    run(lambda: compact_skips(
+        pool, matchmaking_settings.skip_retention_days, matchmaking_settings.skip_compaction_batch_size
+    ))
@@ -1,21 +1,44 @@
-import io
-import json
-import pika
+import os
+import re
+import signal
+import socket
+import asyncio
 import logging
+import multiprocessing
+import multiprocessing.connection
 import asyncpg
-from config import TelegramSettings, MinIOSettings, PostgresSettings, RabbitMQSettings
+import redis.asyncio as redis
+from config import TelegramSettings, MinIOSettings, PostgresSettings, RabbitMQSettings, RedisSettings, MatchmakingSettings
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from minio import Minio
 from minio.error import S3Error
 from keyboards import main_menu_keyboard, edit_profile_keyboard, remove_keyboard
+from candidates import pop_candidates, return_candidates, eligible_candidates, invalidate_candidates
+from ratings import mark_dirty
+from messaging import EventPublisher, coalescing_stats, MATCHMAKING_STATS_KEY
+from photo_store import PhotoStore
+from identity import IdentityStore
+from swipes import record_swipe, enqueue_skip, SkipFlusher
+from seen import mark_seen, filter_unseen
+from profile_cache import ProfileCache
+from cities import resolve_city
+from interests import interest_vector
+from inbound_likes import record_like, forget_liker
 
 # Создаём экземпляры настроек
 telegram_settings = TelegramSettings()
 minio_settings = MinIOSettings()
 postgres_settings = PostgresSettings()
 rabbitmq_settings = RabbitMQSettings()
+redis_settings = RedisSettings()
+matchmaking_settings = MatchmakingSettings()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,11 +50,37 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+redis_client = redis.Redis(host=redis_settings.redis_host, port=redis_settings.redis_port, decode_responses=True)
+
+# Состояние диалогов хранится в Redis, а не в памяти процесса: оно переживает рестарт
+# и общее для всех реплик бота. Брошенные анкеты удаляются сами по TTL
 bot = Bot(token=telegram_settings.bot_token)
-dp = Dispatcher()
+dp = Dispatcher(storage=RedisStorage(
+    redis_client,
+    state_ttl=telegram_settings.fsm_state_ttl,
+    data_ttl=telegram_settings.fsm_state_ttl
+))
 
 pool = None
-user_state = {}
+skip_flusher = None
+metrics_task = None
+
+# Допустимые границы диапазона возраста партнёра; совпадают с DEFAULT pref_age_min/pref_age_max в init_db.sql
+AGE_RANGE_LIMITS = (18, 100)
+
+class ProfileForm(StatesGroup):
+    profile_menu = State()
+    nickname = State()
+    age = State()
+    age_range = State()
+    gender = State()
+    interests = State()
+    city = State()
+    manage_photos = State()
+    add_photo = State()
+
+class FindForm(StatesGroup):
+    match_response = State()
 
 # Инициализация MinIO клиента
 minio_client = Minio(
@@ -53,416 +102,392 @@ try:
 except S3Error as e:
     logger.error(f"Error creating bucket: {str(e)}")
 
+photo_store = PhotoStore(
+    minio_client, bucket_name,
+    cache_max_bytes=minio_settings.photo_cache_max_bytes,
+    workers=minio_settings.photo_fetch_workers,
+    redis_client=redis_client
+)
+
+profile_cache = ProfileCache(redis_client, ttl=telegram_settings.profile_cache_ttl)
+
 async def init_db():
     return await asyncpg.create_pool(
         user=postgres_settings.postgres_user,
         password=postgres_settings.postgres_password,
         database=postgres_settings.postgres_db,
-        host=postgres_settings.postgres_host
+        host=postgres_settings.postgres_host,
+        min_size=postgres_settings.postgres_pool_min_size,
+        max_size=postgres_settings.postgres_pool_max_size
     )
 
-def get_rabbitmq_connection():
-    credentials = pika.PlainCredentials(rabbitmq_settings.rabbitmq_user, rabbitmq_settings.rabbitmq_password)
-    return pika.BlockingConnection(pika.ConnectionParameters(
-        host=rabbitmq_settings.rabbitmq_host,
-        credentials=credentials
-    ))
+identities = IdentityStore(
+    ttl=telegram_settings.identity_cache_ttl,
+    max_size=telegram_settings.identity_cache_size
+)
 
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    user_id = message.from_user.id
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
+# Одно соединение с RabbitMQ на весь процесс бота, подключается в on_startup
+publisher = EventPublisher(rabbitmq_settings, queues=("matchmaking", "notifications"))
+
+async def send_profile_photos(chat_id, object_keys, file_ids):
+    """Отправляет фото анкеты, запоминая новые file_id в БД."""
+    new_file_ids = await photo_store.send_photos(bot, chat_id, object_keys, file_ids)
+    if new_file_ids:
+        async with pool.acquire() as conn:
             await conn.execute(
-                "INSERT INTO Users (telegram_id, username) VALUES ($1, $2)",
-                user_id, message.from_user.username
+                """
+                UPDATE Photos
+                SET file_id = data.file_id
+                FROM unnest($1::text[], $2::text[]) AS data(object_key, file_id)
+                WHERE Photos.object_key = data.object_key
+                """,
+                list(new_file_ids.keys()), list(new_file_ids.values())
             )
+
+@dp.message(Command("start"))
+async def cmd_start(message: types.Message):
+    await identities.ensure(pool, message.from_user.id, message.from_user.username)
     await message.answer(
         "Привет! Я бот для знакомств. Используй кнопки ниже для навигации.",
         reply_markup=main_menu_keyboard
     )
 
 @dp.message(lambda message: message.text == "Поиск анкет 🔍")
-async def handle_find_button(message: types.Message):
-    await cmd_find(message)
+async def handle_find_button(message: types.Message, state: FSMContext):
+    await cmd_find(message, state)
 
 @dp.message(lambda message: message.text == "Мой профиль 📝")
 async def handle_view_button(message: types.Message):
     await cmd_view(message)
 
 @dp.message(lambda message: message.text == "Редактировать ✏️")
-async def handle_profile_button(message: types.Message):
-    await cmd_profile(message)
+async def handle_profile_button(message: types.Message, state: FSMContext):
+    await cmd_profile(message, state)
 
 @dp.message(Command("profile"))
-async def cmd_profile(message: types.Message):
-    user_id = message.from_user.id
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
-            await conn.execute(
-                "INSERT INTO Users (telegram_id, username) VALUES ($1, $2)",
-                user_id, message.from_user.username
-            )
-            user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user['id'])
-        if not profile:
-            await message.answer("Давай создадим профиль! Введи свой ник:", reply_markup=remove_keyboard)
-            user_state[user_id] = {"step": "nickname", "user_db_id": user['id'], "mode": "create"}
-        else:
-            await message.answer("Твой профиль уже существует. Что хочешь сделать?", reply_markup=edit_profile_keyboard)
-            user_state[user_id] = {"step": "profile_menu", "user_db_id": user['id']}
+async def cmd_profile(message: types.Message, state: FSMContext):
+    user, profile = await identities.ensure(pool, message.from_user.id, message.from_user.username)
+    if not profile:
+        await message.answer("Давай создадим профиль! Введи свой ник:", reply_markup=remove_keyboard)
+        await state.set_state(ProfileForm.nickname)
+        await state.set_data({"user_db_id": user['id'], "mode": "create"})
+    else:
+        await message.answer("Твой профиль уже существует. Что хочешь сделать?", reply_markup=edit_profile_keyboard)
+        await state.set_state(ProfileForm.profile_menu)
+        await state.set_data({"user_db_id": user['id']})
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "profile_menu")
-async def process_profile_menu(message: types.Message):
-    user_id = message.from_user.id
+@dp.message(ProfileForm.profile_menu)
+async def process_profile_menu(message: types.Message, state: FSMContext):
     choice = message.text.lower()
     if choice == "отредактировать ✏️":
-        async with pool.acquire() as conn:
-            profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user_state[user_id]["user_db_id"])
-            user_state[user_id] = {
-                "step": "nickname",
-                "user_db_id": user_state[user_id]["user_db_id"],
-                "mode": "edit",
-                "current_nickname": profile['nickname'],
-                "current_age": profile['age'],
-                "current_gender": profile['gender'],
-                "current_interests": profile['interests'],
-                "current_city": profile['city']
-            }
-            skip_button = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_nickname")]
-            ])
-            await message.answer(
-                f"Текущий ник: {profile['nickname']}\nВведи новый ник:",
-                reply_markup=skip_button
-            )
+        user, profile = await identities.get(pool, message.from_user.id)
+        await state.set_state(ProfileForm.nickname)
+        await state.set_data({
+            "user_db_id": user['id'],
+            "mode": "edit",
+            "current_nickname": profile['nickname'],
+            "current_age": profile['age'],
+            "current_age_min": profile['pref_age_min'],
+            "current_age_max": profile['pref_age_max'],
+            "current_gender": profile['gender'],
+            "current_interests": profile['interests'],
+            "current_city": profile['city']
+        })
+        skip_button = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_nickname")]
+        ])
+        await message.answer(
+            f"Текущий ник: {profile['nickname']}\nВведи новый ник:",
+            reply_markup=skip_button
+        )
     elif choice == "назад ⬅️":
         await message.answer("Возвращаемся в главное меню.", reply_markup=main_menu_keyboard)
-        del user_state[user_id]
+        await state.clear()
     else:
         await message.answer("Пожалуйста, выбери 'Отредактировать ✏️' или 'Назад ⬅️'.")
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "nickname")
-async def process_nickname(message: types.Message):
-    user_id = message.from_user.id
-    # Дополнительная проверка: если шаг изменился, игнорируем текстовый ввод
-    if user_state.get(user_id, {}).get("step") != "nickname":
-        return
-
+@dp.message(ProfileForm.nickname)
+async def process_nickname(message: types.Message, state: FSMContext):
     nickname = message.text.strip()
     if not nickname:
         await message.answer("Ник не может быть пустым! Введи свой ник:")
         return
 
-    user_state[user_id]["nickname"] = nickname
-    mode = user_state[user_id]["mode"]
-    if mode == "edit":
+    data = await state.update_data(nickname=nickname)
+    if data["mode"] == "edit":
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_age")]
         ])
         await message.answer(
-            f"Текущий возраст: {user_state[user_id]['current_age']}\nВведи новый возраст:",
+            f"Текущий возраст: {data['current_age']}\nВведи новый возраст:",
             reply_markup=skip_button
         )
     else:
         await message.answer("Теперь введи свой возраст:", reply_markup=remove_keyboard)
-    user_state[user_id]["step"] = "age"
+    await state.set_state(ProfileForm.age)
 
 @dp.callback_query(lambda c: c.data.startswith("skip_"))
-async def process_skip_callback(callback_query: types.CallbackQuery):
+async def process_skip_callback(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
-    logger.info(f"process_skip_callback: user_id={user_id}, user_state={user_state.get(user_id, 'Not found')}")
-    
-    if user_id not in user_state:
+    data = await state.get_data()
+    logger.info(f"process_skip_callback: user_id={user_id}, state={await state.get_state()}, data={data}")
+
+    if await state.get_state() is None:
         await callback_query.answer("Сессия истекла. Начни заново.")
         return
 
     step = callback_query.data.split("_")[1]
     if step == "nickname":
-        user_state[user_id]["nickname"] = user_state[user_id]["current_nickname"]
+        await state.update_data(nickname=data["current_nickname"])
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_age")]
         ])
         await callback_query.message.answer(
-            f"Текущий возраст: {user_state[user_id]['current_age']}\nВведи новый возраст:",
+            f"Текущий возраст: {data['current_age']}\nВведи новый возраст:",
             reply_markup=skip_button
         )
-        user_state[user_id]["step"] = "age"  # Обновляем шаг
+        await state.set_state(ProfileForm.age)  # Обновляем шаг
     elif step == "age":
-        user_state[user_id]["age"] = user_state[user_id]["current_age"]
+        await state.update_data(age=data["current_age"])
+        skip_button = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_agerange")]
+        ])
+        await callback_query.message.answer(
+            f"Сейчас ищешь возраст: {data['current_age_min']}-{data['current_age_max']}\n"
+            f"Укажи новый диапазон возраста партнёра (например, 20-30):",
+            reply_markup=skip_button
+        )
+        await state.set_state(ProfileForm.age_range)  # Обновляем шаг
+    elif step == "agerange":
+        await state.update_data(age_min=data["current_age_min"], age_max=data["current_age_max"])
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_gender")]
         ])
         await callback_query.message.answer(
-            f"Текущий пол: {user_state[user_id]['current_gender']}\nУкажи новый пол (м/ж):",
+            f"Текущий пол: {data['current_gender']}\nУкажи новый пол (м/ж):",
             reply_markup=skip_button
         )
-        user_state[user_id]["step"] = "gender"  # Обновляем шаг
+        await state.set_state(ProfileForm.gender)  # Обновляем шаг
     elif step == "gender":
-        user_state[user_id]["gender"] = user_state[user_id]["current_gender"]
+        await state.update_data(gender=data["current_gender"])
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_interests")]
         ])
         await callback_query.message.answer(
-            f"Текущие интересы: {user_state[user_id]['current_interests']}\nУкажи новые интересы (через запятую):",
+            f"Текущие интересы: {data['current_interests']}\nУкажи новые интересы (через запятую):",
             reply_markup=skip_button
         )
-        user_state[user_id]["step"] = "interests"  # Обновляем шаг
+        await state.set_state(ProfileForm.interests)  # Обновляем шаг
     elif step == "interests":
-        user_state[user_id]["interests"] = user_state[user_id]["current_interests"]
+        await state.update_data(interests=data["current_interests"])
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_city")]
         ])
         await callback_query.message.answer(
-            f"Текущий город: {user_state[user_id]['current_city']}\nУкажи новый город:",
+            f"Текущий город: {data['current_city']}\nУкажи новый город:",
             reply_markup=skip_button
         )
-        user_state[user_id]["step"] = "city"  # Обновляем шаг
+        await state.set_state(ProfileForm.city)  # Обновляем шаг
     elif step == "city":
-        user_state[user_id]["city"] = user_state[user_id]["current_city"]
-        logger.info(f"Before process_city_after_skip: user_id={user_id}, user_state={user_state[user_id]}")
-        user_state[user_id]["step"] = "manage_photos"  # Обновляем шаг
-        await process_city_after_skip(callback_query.message, user_id)
+        data = await state.update_data(city=data["current_city"])
+        logger.info(f"Before process_city_after_skip: user_id={user_id}, data={data}")
+        await state.set_state(ProfileForm.manage_photos)  # Обновляем шаг
+        await process_city_after_skip(callback_query.message, state, user_id)
     elif step == "photos":
-        user_state[user_id]["step"] = "manage_photos"  # Обновляем шаг
-        await manage_photos(callback_query.message, user_id)
+        await state.set_state(ProfileForm.manage_photos)  # Обновляем шаг
+        await manage_photos(callback_query.message, state, user_id)
 
     await callback_query.answer()
 
-async def process_city_after_skip(message: types.Message, user_id: int):  # Добавляем параметр user_id
-    logger.info(f"process_city_after_skip: user_id={user_id}, user_state={user_state.get(user_id, 'Not found')}")
-    
-    # Проверяем, есть ли user_db_id в user_state
-    if user_id not in user_state or "user_db_id" not in user_state[user_id]:
-        # Если нет, запрашиваем user_db_id из базы данных
-        async with pool.acquire() as connection:
-            user_db_id = await connection.fetchval(
-                "SELECT id FROM Users WHERE telegram_id = $1", user_id
-            )
-            if user_db_id is None:
-                logger.error(f"User not found in database: telegram_id={user_id}")
-                await message.answer("Ошибка: Пользователь не найден в базе данных. Пожалуйста, начни регистрацию заново.")
-                return
-            # Сохраняем user_db_id в user_state
-            if user_id not in user_state:
-                user_state[user_id] = {}
-            user_state[user_id]["user_db_id"] = user_db_id
-            logger.info(f"Restored user_db_id={user_db_id} for user_id={user_id}")
-    else:
-        user_db_id = user_state[user_id]["user_db_id"]
-
-    mode = user_state[user_id]["mode"]
-    city = user_state[user_id].get("city", user_state[user_id]["current_city"])
-    async with pool.acquire() as conn:
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user_db_id)
-        if profile:
-            await conn.execute(
-                """
-                UPDATE Profiles
-                SET nickname = $1, age = $2, gender = $3, interests = $4, city = $5
-                WHERE user_id = $6
-                """,
-                user_state[user_id]["nickname"], user_state[user_id]["age"], user_state[user_id]["gender"],
-                user_state[user_id]["interests"], city, user_db_id
-            )
-            await message.answer("Профиль обновлён! Теперь давай управим твоими фото:", reply_markup=remove_keyboard)
-        else:
-            await conn.execute(
-                """
-                INSERT INTO Profiles (user_id, nickname, age, gender, interests, city, profile_completeness)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                """,
-                user_db_id, user_state[user_id]["nickname"], user_state[user_id]["age"], user_state[user_id]["gender"],
-                user_state[user_id]["interests"], city, 80
+async def get_user_db_id(message: types.Message, state: FSMContext, user_id: int):
+    """Возвращает user_db_id из состояния, а если его там нет — восстанавливает из базы данных."""
+    data = await state.get_data()
+    if "user_db_id" in data:
+        return data["user_db_id"]
+
+    user, _ = await identities.get(pool, user_id)
+    if user is None:
+        logger.error(f"User not found in database: telegram_id={user_id}")
+        await message.answer("Ошибка: Пользователь не найден в базе данных. Пожалуйста, начни регистрацию заново.")
+        return None
+    user_db_id = user['id']
+    await state.update_data(user_db_id=user_db_id)
+    logger.info(f"Restored user_db_id={user_db_id} for user_id={user_id}")
+    return user_db_id
+
+async def process_city_after_skip(message: types.Message, state: FSMContext, user_id: int):  # Добавляем параметр user_id
+    logger.info(f"process_city_after_skip: user_id={user_id}, data={await state.get_data()}")
+
+    user_db_id = await get_user_db_id(message, state, user_id)
+    if user_db_id is None:
+        return
+    await save_profile(message, state, user_id, user_db_id)
+
+async def save_profile(message: types.Message, state: FSMContext, user_id: int, user_db_id: int):
+    data = await state.get_data()
+    city = data.get("city", data.get("current_city"))
+    async with pool.acquire() as conn, conn.transaction():
+        # Свободный текст сводим к городу из справочника: «спб», «Питер» и «Санкт-Петербург» — один город
+        city_id, city = await resolve_city(conn, city)
+        interests_bits = await interest_vector(conn, data["interests"])
+        # Создать или обновить решает ограничение UNIQUE(user_id), а не закэшированная анкета:
+        # кэш другого процесса мог ещё не знать о только что созданной анкете.
+        # xmax = 0 только у вставленной строки
+        row = await conn.fetchrow(
+            """
+            INSERT INTO Profiles (
+                user_id, nickname, age, gender, interests, city, city_id, pref_age_min, pref_age_max,
+                interest_vector
             )
-            profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user_db_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            ON CONFLICT (user_id) DO UPDATE
+            SET nickname = EXCLUDED.nickname, age = EXCLUDED.age, gender = EXCLUDED.gender,
+                interests = EXCLUDED.interests, city = EXCLUDED.city, city_id = EXCLUDED.city_id,
+                pref_age_min = EXCLUDED.pref_age_min, pref_age_max = EXCLUDED.pref_age_max,
+                interest_vector = EXCLUDED.interest_vector
+            RETURNING id, xmax = 0 AS created
+            """,
+            user_db_id, data["nickname"], data["age"], data["gender"],
+            data["interests"], city, city_id, data["age_min"], data["age_max"], interests_bits
+        )
+        profile_id = row['id']
+        if row['created']:
             await conn.execute(
-                "INSERT INTO Ratings (profile_id) VALUES ($1)", profile['id']
+                "INSERT INTO Ratings (profile_id) VALUES ($1)", profile_id
             )
-            await message.answer("Профиль создан! Теперь давай добавим фото:", reply_markup=remove_keyboard)
-
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        channel.queue_declare(queue="matchmaking")
-        channel.basic_publish(
-            exchange="",
-            routing_key="matchmaking",
-            body=json.dumps({"user_id": user_id})
-        )
-        connection.close()
-        logger.info(f"Sent matchmaking message for user {user_id}")
 
-        user_state[user_id]["step"] = "manage_photos"
-        await manage_photos(message, user_id)
+    if row['created']:
+        await message.answer("Профиль создан! Теперь давай добавим фото:", reply_markup=remove_keyboard)
+    else:
+        await message.answer("Профиль обновлён! Теперь давай управим твоими фото:", reply_markup=remove_keyboard)
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "age")
-async def process_age(message: types.Message):
-    user_id = message.from_user.id
-    if user_state.get(user_id, {}).get("step") != "age":
-        return
+    # Пол, город или предпочтения по возрасту могли измениться, поэтому очередь кандидатов строим заново
+    identities.invalidate(user_id)
+    await profile_cache.invalidate(profile_id)
+    await invalidate_candidates(redis_client, profile_id)
+    await mark_dirty(redis_client, profile_id)
+
+    await publisher.publish("matchmaking", {"user_id": user_id})
+    logger.info(f"Sent matchmaking message for user {user_id}")
+
+    await state.set_state(ProfileForm.manage_photos)
+    await manage_photos(message, state, user_id)
 
-    mode = user_state[user_id]["mode"]
+@dp.message(ProfileForm.age)
+async def process_age(message: types.Message, state: FSMContext):
     try:
         age = int(message.text)
-        user_state[user_id]["age"] = age
-        if mode == "edit":
+        data = await state.update_data(age=age)
+        if data["mode"] == "edit":
             skip_button = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_gender")]
+                [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_agerange")]
             ])
             await message.answer(
-                f"Текущий пол: {user_state[user_id]['current_gender']}\nУкажи новый пол (м/ж):",
+                f"Сейчас ищешь возраст: {data['current_age_min']}-{data['current_age_max']}\n"
+                f"Укажи новый диапазон возраста партнёра (например, 20-30):",
                 reply_markup=skip_button
             )
         else:
-            await message.answer("Теперь укажи свой пол (м/ж):", reply_markup=remove_keyboard)
-        user_state[user_id]["step"] = "gender"
+            await message.answer(
+                "Какой возраст партнёра тебе интересен? Укажи диапазон, например 20-30, или напиши «любой»:",
+                reply_markup=remove_keyboard
+            )
+        await state.set_state(ProfileForm.age_range)
     except ValueError:
         await message.answer("Пожалуйста, введи число для возраста!")
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "gender")
-async def process_gender(message: types.Message):
-    user_id = message.from_user.id
-    if user_state.get(user_id, {}).get("step") != "gender":
+def parse_age_range(text):
+    """«20-30» -> (20, 30); «любой» -> весь допустимый диапазон; None, если ввод некорректен."""
+    text = text.strip().lower()
+    if text == "любой":
+        return AGE_RANGE_LIMITS
+    match = re.fullmatch(r"(\d+)\s*[-–—]\s*(\d+)", text)
+    if not match:
+        return None
+    age_min, age_max = int(match.group(1)), int(match.group(2))
+    if not AGE_RANGE_LIMITS[0] <= age_min <= age_max <= AGE_RANGE_LIMITS[1]:
+        return None
+    return age_min, age_max
+
+@dp.message(ProfileForm.age_range)
+async def process_age_range(message: types.Message, state: FSMContext):
+    age_range = parse_age_range(message.text)
+    if age_range is None:
+        await message.answer(
+            f"Укажи диапазон в виде «20-30», от {AGE_RANGE_LIMITS[0]} до {AGE_RANGE_LIMITS[1]}, или напиши «любой»!"
+        )
         return
+    data = await state.update_data(age_min=age_range[0], age_max=age_range[1])
+    if data["mode"] == "edit":
+        skip_button = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_gender")]
+        ])
+        await message.answer(
+            f"Текущий пол: {data['current_gender']}\nУкажи новый пол (м/ж):",
+            reply_markup=skip_button
+        )
+    else:
+        await message.answer("Теперь укажи свой пол (м/ж):", reply_markup=remove_keyboard)
+    await state.set_state(ProfileForm.gender)
 
-    mode = user_state[user_id]["mode"]
+@dp.message(ProfileForm.gender)
+async def process_gender(message: types.Message, state: FSMContext):
     gender = message.text.lower()
     if gender in ["м", "ж"]:
-        user_state[user_id]["gender"] = gender
-        if mode == "edit":
+        data = await state.update_data(gender=gender)
+        if data["mode"] == "edit":
             skip_button = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_interests")]
             ])
             await message.answer(
-                f"Текущие интересы: {user_state[user_id]['current_interests']}\nУкажи новые интересы (через запятую):",
+                f"Текущие интересы: {data['current_interests']}\nУкажи новые интересы (через запятую):",
                 reply_markup=skip_button
             )
         else:
             await message.answer("Укажи свои интересы (через запятую):", reply_markup=remove_keyboard)
-        user_state[user_id]["step"] = "interests"
+        await state.set_state(ProfileForm.interests)
     else:
         await message.answer("Пожалуйста, укажи пол как 'м' или 'ж'!")
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "interests")
-async def process_interests(message: types.Message):
-    user_id = message.from_user.id
-    if user_state.get(user_id, {}).get("step") != "interests":
-        return
-
-    mode = user_state[user_id]["mode"]
+@dp.message(ProfileForm.interests)
+async def process_interests(message: types.Message, state: FSMContext):
     interests = message.text
-    user_state[user_id]["interests"] = interests
-    if mode == "edit":
+    data = await state.update_data(interests=interests)
+    if data["mode"] == "edit":
         skip_button = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оставить текущее значение ⏭️", callback_data="skip_city")]
         ])
         await message.answer(
-            f"Текущий город: {user_state[user_id]['current_city']}\nУкажи новый город:",
+            f"Текущий город: {data['current_city']}\nУкажи новый город:",
             reply_markup=skip_button
         )
     else:
         await message.answer("Укажи свой город:", reply_markup=remove_keyboard)
-    user_state[user_id]["step"] = "city"
+    await state.set_state(ProfileForm.city)
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "city")
-async def process_city(message: types.Message):
+@dp.message(ProfileForm.city)
+async def process_city(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_state.get(user_id, {}).get("step") != "city":
-        return
-
-    user_db_id = user_state[user_id]["user_db_id"]
-    mode = user_state[user_id]["mode"]
-    city = message.text
-    user_state[user_id]["city"] = city
+    data = await state.update_data(city=message.text)
+    await save_profile(message, state, user_id, data["user_db_id"])
 
-    async with pool.acquire() as conn:
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user_db_id)
-        if profile:
-            await conn.execute(
-                """
-                UPDATE Profiles
-                SET nickname = $1, age = $2, gender = $3, interests = $4, city = $5
-                WHERE user_id = $6
-                """,
-                user_state[user_id]["nickname"], user_state[user_id]["age"], user_state[user_id]["gender"],
-                user_state[user_id]["interests"], city, user_db_id
-            )
-            await message.answer("Профиль обновлён! Теперь давай управим твоими фото:", reply_markup=remove_keyboard)
-        else:
-            await conn.execute(
-                """
-                INSERT INTO Profiles (user_id, nickname, age, gender, interests, city, profile_completeness)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                """,
-                user_db_id, user_state[user_id]["nickname"], user_state[user_id]["age"], user_state[user_id]["gender"],
-                user_state[user_id]["interests"], city, 80
-            )
-            profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user_db_id)
-            await conn.execute(
-                "INSERT INTO Ratings (profile_id) VALUES ($1)", profile['id']
-            )
-            await message.answer("Профиль создан! Теперь давай добавим фото:", reply_markup=remove_keyboard)
-
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        channel.queue_declare(queue="matchmaking")
-        channel.basic_publish(
-            exchange="",
-            routing_key="matchmaking",
-            body=json.dumps({"user_id": user_id})
-        )
-        connection.close()
-        logger.info(f"Sent matchmaking message for user {user_id}")
-
-        user_state[user_id]["step"] = "manage_photos"
-        await manage_photos(message, user_id)
-
-async def manage_photos(message: types.Message, user_id: int):
-    if user_id not in user_state or "user_db_id" not in user_state[user_id]:
-        # Если нет, запрашиваем user_db_id из базы данных
-        async with pool.acquire() as connection:
-            user_db_id = await connection.fetchval(
-                "SELECT id FROM Users WHERE telegram_id = $1", user_id
-            )
-            if user_db_id is None:
-                logger.error(f"User not found in database: telegram_id={user_id}")
-                await message.answer("Ошибка: Пользователь не найден в базе данных. Пожалуйста, начни регистрацию заново.")
-                return
-            # Сохраняем user_db_id в user_state
-            if user_id not in user_state:
-                user_state[user_id] = {}
-            user_state[user_id]["user_db_id"] = user_db_id
-            logger.info(f"Restored user_db_id={user_db_id} for user_id={user_id}")
-    else:
-        user_db_id = user_state[user_id]["user_db_id"]
+async def manage_photos(message: types.Message, state: FSMContext, user_id: int):
+    user_db_id = await get_user_db_id(message, state, user_id)
+    if user_db_id is None:
+        return
 
     async with pool.acquire() as conn:
         photos = await conn.fetch(
-            "SELECT id, object_key FROM Photos WHERE user_id = $1 ORDER BY uploaded_at DESC LIMIT 3",
+            "SELECT id, object_key, file_id FROM Photos WHERE user_id = $1 ORDER BY uploaded_at DESC LIMIT 3",
             user_db_id
         )
 
     if photos:
-        media = []
-        for photo in photos:
-            try:
-                response = minio_client.get_object(bucket_name, photo['object_key'])
-                photo_data = response.read()
-                response.close()
-                response.release_conn()
-                photo_file = BufferedInputFile(
-                    file=photo_data,
-                    filename="profile_photo.jpg"
-                )
-                media.append(InputMediaPhoto(media=photo_file))
-            except S3Error as e:
-                logger.error(f"Error retrieving photo from MinIO: {str(e)}")
-
-        if media:
-            await message.answer_media_group(media=media)
+        await send_profile_photos(
+            message.chat.id,
+            [photo['object_key'] for photo in photos],
+            [photo['file_id'] for photo in photos]
+        )
 
         photo_buttons = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"Удалить фото #{i+1} 🗑️", callback_data=f"delete_photo_{photo['id']}")]
@@ -479,52 +504,63 @@ async def manage_photos(message: types.Message, user_id: int):
         await message.answer("У тебя пока нет фото. Хочешь добавить?", reply_markup=photo_buttons)
 
 @dp.callback_query(lambda c: c.data.startswith("delete_photo_"))
-async def delete_photo(callback_query: types.CallbackQuery):
+async def delete_photo(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
-    if user_id not in user_state:
+    if await state.get_state() is None:
         await callback_query.answer("Сессия истекла. Начни заново.")
         return
 
     photo_id = int(callback_query.data.split("_")[2])
     async with pool.acquire() as conn:
-        photo = await conn.fetchrow("SELECT object_key FROM Photos WHERE id = $1", photo_id)
+        photo = await conn.fetchrow(
+            """
+            SELECT ph.object_key, p.id AS profile_id
+            FROM Photos ph
+            LEFT JOIN Profiles p ON p.user_id = ph.user_id
+            WHERE ph.id = $1
+            """,
+            photo_id
+        )
         if photo:
             try:
-                minio_client.remove_object(bucket_name, photo['object_key'])
+                await photo_store.remove(photo['object_key'])
+                await photo_store.forget_file_ids([photo['object_key']])
                 await conn.execute("DELETE FROM Photos WHERE id = $1", photo_id)
+                # Триггер на Photos уменьшил photo_count, а с ним и заполненность анкеты
+                identities.invalidate(user_id)
+                await profile_cache.invalidate(photo['profile_id'])
+                await mark_dirty(redis_client, photo['profile_id'])
                 await callback_query.answer("Фото удалено!")
             except S3Error as e:
                 logger.error(f"Error deleting photo from MinIO: {str(e)}")
                 await callback_query.answer("Ошибка при удалении фото.")
 
-    await manage_photos(callback_query.message, user_id)
+    await manage_photos(callback_query.message, state, user_id)
 
 @dp.callback_query(lambda c: c.data == "add_photo")
-async def add_photo(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-    if user_id not in user_state:
+async def add_photo(callback_query: types.CallbackQuery, state: FSMContext):
+    if await state.get_state() is None:
         await callback_query.answer("Сессия истекла. Начни заново.")
         return
 
-    user_state[user_id]["step"] = "add_photo"
+    await state.set_state(ProfileForm.add_photo)
     await callback_query.message.answer("Пожалуйста, отправь новое фото:")
     await callback_query.answer()
 
 @dp.callback_query(lambda c: c.data == "finish_editing")
-async def finish_editing(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-    if user_id not in user_state:
+async def finish_editing(callback_query: types.CallbackQuery, state: FSMContext):
+    if await state.get_state() is None:
         await callback_query.answer("Сессия истекла. Начни заново.")
         return
 
     await callback_query.message.answer("Редактирование завершено!", reply_markup=main_menu_keyboard)
-    del user_state[user_id]
+    await state.clear()
     await callback_query.answer()
 
-@dp.message(lambda message: user_state.get(message.from_user.id, {}).get("step") == "add_photo")
-async def process_photo(message: types.Message):
+@dp.message(ProfileForm.add_photo)
+async def process_photo(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_db_id = user_state[user_id]["user_db_id"]
+    user_db_id = (await state.get_data())["user_db_id"]
     if message.photo:
         file_id = message.photo[-1].file_id
         file_info = await bot.get_file(file_id)
@@ -535,344 +571,318 @@ async def process_photo(message: types.Message):
 
         object_key = f"user{user_db_id}/photo-{file_info.file_unique_id}.jpg"
         try:
-            minio_client.put_object(
-                bucket_name,
-                object_key,
-                io.BytesIO(file_bytes),
-                length=len(file_bytes),
-                content_type="image/jpeg"
-            )
+            await photo_store.put(object_key, file_bytes)
             logger.info(f"Photo uploaded to MinIO: {object_key}")
         except S3Error as e:
             logger.error(f"Error uploading photo to MinIO: {str(e)}")
             await message.answer("Ошибка при загрузке фото. Попробуй снова!")
-            user_state[user_id]["step"] = "manage_photos"
-            await manage_photos(message, user_id)
+            await state.set_state(ProfileForm.manage_photos)
+            await manage_photos(message, state, user_id)
             return
 
         async with pool.acquire() as conn:
             await conn.execute(
-                "INSERT INTO Photos (user_id, object_key) VALUES ($1, $2)", user_db_id, object_key
-            )
-            # Обновляем profile_completeness
-            await conn.execute(
-                """
-                UPDATE Profiles
-                SET profile_completeness = LEAST(100, profile_completeness + 10)
-                WHERE user_id = $1
-                """,
-                user_db_id
+                "INSERT INTO Photos (user_id, object_key, file_id) VALUES ($1, $2, $3)", user_db_id, object_key, file_id
             )
+            await photo_store.remember_file_ids({object_key: file_id})
+            # photo_count и profile_completeness обновил триггер на Photos
+            profile_id = await conn.fetchval("SELECT id FROM Profiles WHERE user_id = $1", user_db_id)
+        identities.invalidate(user_id)
+        await profile_cache.invalidate(profile_id)
+        await mark_dirty(redis_client, profile_id)
         await message.answer("Фото добавлено!")
     else:
         await message.answer("Пожалуйста, отправь фото!")
-        user_state[user_id]["step"] = "manage_photos"
-        await manage_photos(message, user_id)
+        await state.set_state(ProfileForm.manage_photos)
+        await manage_photos(message, state, user_id)
         return
 
-    user_state[user_id]["step"] = "manage_photos"
-    await manage_photos(message, user_id)
+    await state.set_state(ProfileForm.manage_photos)
+    await manage_photos(message, state, user_id)
 
 @dp.message(Command("view"))
 async def cmd_view(message: types.Message):
-    user_id = message.from_user.id
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
-            await message.answer("У тебя нет профиля! Создай его с помощью /profile.", reply_markup=main_menu_keyboard)
-            return
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user['id'])
-        if profile:
-            profile_text = (
-                f"Ник: {profile['nickname']}\n"
-                f"Возраст: {profile['age']}\n"
-                f"Пол: {profile['gender']}\n"
-                f"Интересы: {profile['interests']}\n"
-                f"Город: {profile['city']}\n"
-                f"Заполненность профиля: {profile['profile_completeness']}%"
-            )
-
-            photos = await conn.fetch(
-                "SELECT object_key FROM Photos WHERE user_id = $1 ORDER BY uploaded_at DESC LIMIT 3",
-                user['id']
-            )
-
-            if photos:
-                try:
-                    media = []
-                    for photo in photos:
-                        response = minio_client.get_object(bucket_name, photo['object_key'])
-                        photo_data = response.read()
-                        response.close()
-                        response.release_conn()
-                        photo_file = BufferedInputFile(
-                            file=photo_data,
-                            filename="profile_photo.jpg"
-                        )
-                        media.append(InputMediaPhoto(media=photo_file))
-                    await message.answer_media_group(media=media)
-                    await message.answer(profile_text, reply_markup=main_menu_keyboard)
-                except S3Error as e:
-                    logger.error(f"Error retrieving photo from MinIO: {str(e)}")
-                    await message.answer(profile_text, reply_markup=main_menu_keyboard)
-            else:
-                await message.answer(profile_text, reply_markup=main_menu_keyboard)
-        else:
-            await message.answer("У тебя нет профиля! Создай его с помощью /profile.", reply_markup=main_menu_keyboard)
-
-@dp.message(Command("find"))
-async def cmd_find(message: types.Message):
-    user_id = message.from_user.id
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM Users WHERE telegram_id = $1", user_id)
-        if not user:
-            await message.answer("Сначала создай профиль с помощью /profile!", reply_markup=main_menu_keyboard)
-            return
-        profile = await conn.fetchrow("SELECT * FROM Profiles WHERE user_id = $1", user['id'])
-        if not profile or profile['profile_completeness'] < 80:
-            await message.answer("Пожалуйста, заполни профиль полностью с помощью /profile и добавь фото!", reply_markup=main_menu_keyboard)
-            return
-
-        candidate = await conn.fetchrow(
-            """
-            SELECT u.telegram_id, p.id as profile_id, p.nickname, p.age, p.gender, p.interests, p.city
-            FROM Profiles p
-            JOIN Users u ON p.user_id = u.id
-            WHERE u.id != $1
-            AND p.gender != $2
-            AND p.city = $3
-            AND NOT EXISTS (
-                SELECT 1 FROM Matches m
-                WHERE (m.profile1_id = $4 AND m.profile2_id = p.id)
-                OR (m.profile1_id = p.id AND m.profile2_id = $4)
-            )
-            AND NOT EXISTS (
-                SELECT 1 FROM Interactions i
-                WHERE i.from_profile_id = $4 AND i.to_profile_id = p.id
-            )
-            LIMIT 1
-            """, #  AND i.action = 'skip'
-            user['id'], profile['gender'], profile['city'], profile['id']
+    user, profile = await identities.get(pool, message.from_user.id)
+    if not user:
+        await message.answer("У тебя нет профиля! Создай его с помощью /profile.", reply_markup=main_menu_keyboard)
+        return
+    card = await profile_cache.get(pool, profile['id']) if profile else None
+    if card:
+        profile_text = (
+            f"Ник: {card['nickname']}\n"
+            f"Возраст: {card['age']}\n"
+            f"Пол: {card['gender']}\n"
+            f"Интересы: {card['interests']}\n"
+            f"Город: {card['city']}\n"
+            f"Заполненность профиля: {card['profile_completeness']}%"
         )
 
-        # Если анкета из того же города не найдена, ищем анкеты из других городов
-        if not candidate:
-            candidate = await conn.fetchrow(
-                """
-                SELECT u.telegram_id, p.id as profile_id, p.nickname, p.age, p.gender, p.interests, p.city
-                FROM Profiles p
-                JOIN Users u ON p.user_id = u.id
-                WHERE u.id != $1
-                AND p.gender != $2
-                AND p.city != $3
-                AND NOT EXISTS (
-                    SELECT 1 FROM Matches m
-                    WHERE (m.profile1_id = $4 AND m.profile2_id = p.id)
-                    OR (m.profile1_id = p.id AND m.profile2_id = $4)
-                )
-                AND NOT EXISTS (
-                    SELECT 1 FROM Interactions i
-                    WHERE i.from_profile_id = $4 AND i.to_profile_id = p.id
-                )
-                LIMIT 1
-                """,
-                user['id'], profile['gender'], profile['city'], profile['id']
-            )
+        await send_profile_photos(message.chat.id, card['object_keys'], card['file_ids'])
+        await message.answer(profile_text, reply_markup=main_menu_keyboard)
+    else:
+        await message.answer("У тебя нет профиля! Создай его с помощью /profile.", reply_markup=main_menu_keyboard)
 
-        # Если кандидат не найден ни в одном из запросов
-        if not candidate:
-            await message.answer("Подходящих кандидатов не найдено. Попробуй позже!", reply_markup=main_menu_keyboard)
-            return
+@dp.message(Command("find"))
+async def cmd_find(message: types.Message, state: FSMContext):
+    user, profile = await identities.get(pool, message.from_user.id)
+    if not user:
+        await message.answer("Сначала создай профиль с помощью /profile!", reply_markup=main_menu_keyboard)
+        return
+    if not profile or profile['profile_completeness'] < 80:
+        await message.answer("Пожалуйста, заполни профиль полностью с помощью /profile и добавь фото!", reply_markup=main_menu_keyboard)
+        return
 
-        photos = await conn.fetch(
-            "SELECT object_key FROM Photos WHERE user_id = (SELECT id FROM Users WHERE telegram_id = $1) ORDER BY uploaded_at DESC LIMIT 3",
-            candidate['telegram_id']
-        )
+    # Кандидатов берём из заранее построенной очереди; её содержимое могло устареть,
+    # поэтому снятую пачку перепроверяем по фильтру «уже видел» (в БД — только при положительном
+    # ответе) и одним запросом на пригодность, карточку берём из кэша анкет, а непоказанных
+    # подходящих возвращаем в начало очереди
+    candidate = None
+    while candidate is None:
+        candidate_ids = await pop_candidates(pool, redis_client, profile, matchmaking_settings.candidate_check_batch)
+        if not candidate_ids:
+            break
+        unseen = await filter_unseen(pool, redis_client, profile['id'], candidate_ids)
+        eligible = await eligible_candidates(pool, profile, unseen)
+        if eligible:
+            await return_candidates(redis_client, profile['id'], eligible[1:])
+            candidate = await profile_cache.get(pool, eligible[0])
+
+    # Если подходящих кандидатов в очереди не осталось
+    if not candidate:
+        await message.answer("Подходящих кандидатов не найдено. Попробуй позже!", reply_markup=main_menu_keyboard)
+        return
 
-        candidate_text = (
-            f"Ник: {candidate['nickname']}\n"
-            f"Возраст: {candidate['age']}\n"
-            f"Пол: {candidate['gender']}\n"
-            f"Интересы: {candidate['interests']}\n"
-            f"Город: {candidate['city']}\n"
-            f"\nСогласен на мэтч? Ответь 'да' или 'нет'."
-        )
+    candidate_text = (
+        f"Ник: {candidate['nickname']}\n"
+        f"Возраст: {candidate['age']}\n"
+        f"Пол: {candidate['gender']}\n"
+        f"Интересы: {candidate['interests']}\n"
+        f"Город: {candidate['city']}\n"
+        f"\nСогласен на мэтч? Ответь 'да' или 'нет'."
+    )
 
-        if photos:
-            try:
-                media = []
-                for photo in photos:
-                    response = minio_client.get_object(bucket_name, photo['object_key'])
-                    photo_data = response.read()
-                    response.close()
-                    response.release_conn()
-                    photo_file = BufferedInputFile(
-                        file=photo_data,
-                        filename="profile_photo.jpg"
-                    )
-                    media.append(InputMediaPhoto(media=photo_file))
-                await message.answer_media_group(media=media)
-                await message.answer(candidate_text, reply_markup=main_menu_keyboard)
-            except S3Error as e:
-                logger.error(f"Error retrieving photo from MinIO: {str(e)}")
-                await message.answer(candidate_text, reply_markup=main_menu_keyboard)
-        else:
-            await message.answer(candidate_text, reply_markup=main_menu_keyboard)
+    await send_profile_photos(message.chat.id, candidate['object_keys'], candidate['file_ids'])
+    await message.answer(candidate_text, reply_markup=main_menu_keyboard)
 
-        user_state[user_id] = {
-            "step": "match_response",
-            "candidate_profile_id": candidate['profile_id'],
-            "from_profile_id": profile['id']
-        }
+    await state.set_state(FindForm.match_response)
+    await state.set_data({
+        "candidate_profile_id": candidate['profile_id'],
+        "from_profile_id": profile['id']
+    })
 
-async def process_match_response(message: types.Message):
-    user_id = message.from_user.id
+@dp.message(FindForm.match_response)
+async def process_match_response(message: types.Message, state: FSMContext):
     response = message.text.lower()
-    candidate_profile_id = user_state[user_id]["candidate_profile_id"]
-    from_profile_id = user_state[user_id]["from_profile_id"]
+    if response not in ("да", "нет"):
+        await message.answer("Пожалуйста, ответь 'да' или 'нет'!", reply_markup=main_menu_keyboard)
+        return
+
+    data = await state.get_data()
+    candidate_profile_id = data["candidate_profile_id"]
+    from_profile_id = data["from_profile_id"]
+    action = "like" if response == "да" else "skip"
+    # Фильтр «уже видел» обновляем сразу, не дожидаясь записи свайпа в Interactions
+    await mark_seen(redis_client, from_profile_id, candidate_profile_id)
+    await forget_liker(redis_client, from_profile_id, candidate_profile_id)
+
+    if action == "skip":
+        # Пропуск не может создать мэтч, поэтому пишется в Interactions пачкой в фоне
+        await enqueue_skip(redis_client, from_profile_id, candidate_profile_id)
+        await message.answer("Пользователь пропущен. Используй /find для поиска.", reply_markup=main_menu_keyboard)
+        await state.clear()
+        return
 
     async with pool.acquire() as conn:
-        # Проверка на существование взаимодействия
-        existing_interaction = await conn.fetchrow(
-            """
-            SELECT 1 FROM Interactions
-            WHERE from_profile_id = $1 AND to_profile_id = $2
-            """,
-            from_profile_id, candidate_profile_id
-        )
-        if existing_interaction:
+        swipe = await record_swipe(conn, from_profile_id, candidate_profile_id, action)
+        if not swipe['recorded']:
             await message.answer("Ты уже взаимодействовал с этим пользователем!", reply_markup=main_menu_keyboard)
-            del user_state[user_id]
+            await state.clear()
             return
+        await mark_dirty(redis_client, from_profile_id, candidate_profile_id)
+        if not swipe['matched']:
+            # Кандидат увидит зрителя в своей выдаче раньше остальных
+            await record_like(redis_client, from_profile_id, candidate_profile_id)
+
+        if swipe['matched']:
+            cards = await profile_cache.get_many(pool, [from_profile_id, candidate_profile_id])
+            user1 = cards.get(from_profile_id)
+            user2 = cards.get(candidate_profile_id)
+
+            if not user1 or not user2:
+                logger.error(f"User data not found: user1={user1}, user2={user2}")
+                await message.answer("Ошибка при создании мэтча. Пожалуйста, попробуй снова.", reply_markup=main_menu_keyboard)
+                await state.clear()
+                return
 
-        action = "like" if response == "да" else "skip"
-        await conn.execute(
-            """
-            INSERT INTO Interactions (from_profile_id, to_profile_id, action)
-            VALUES ($1, $2, $3)
-            """,
-            from_profile_id, candidate_profile_id, action
-        )
+            # Первому пользователю отправляем анкету второго, второму — анкету первого,
+            # и просим matchmaking пересчитать обоих; подтверждения брокера ждём пачкой
+            await publisher.publish_many([
+                ("notifications", {
+                    "user_info": {
+                        "to_user_id": user1['telegram_id'],
+                        "nickname": user2['nickname'],
+                        "age": user2['age'],
+                        "gender": user2['gender'],
+                        "interests": user2['interests'],
+                        "city": user2['city']
+                    },
+                    "object_keys": user2['object_keys'],
+                    "file_ids": user2['file_ids']
+                }),
+                ("notifications", {
+                    "user_info": {
+                        "to_user_id": user2['telegram_id'],
+                        "nickname": user1['nickname'],
+                        "age": user1['age'],
+                        "gender": user1['gender'],
+                        "interests": user1['interests'],
+                        "city": user1['city']
+                    },
+                    "object_keys": user1['object_keys'],
+                    "file_ids": user1['file_ids']
+                }),
+                ("matchmaking", {"user_id": user1['telegram_id']}),
+                ("matchmaking", {"user_id": user2['telegram_id']}),
+            ])
+            logger.info(f"Sent matchmaking messages for users {user1['telegram_id']} and {user2['telegram_id']}")
 
-        if response == "да":
-            mutual_like = await conn.fetchrow(
-                """
-                SELECT 1 FROM Interactions
-                WHERE from_profile_id = $1 AND to_profile_id = $2 AND action = 'like'
-                """,
-                candidate_profile_id, from_profile_id
-            )
-            if mutual_like:
-                await conn.execute(
-                    "INSERT INTO Matches (profile1_id, profile2_id) VALUES ($1, $2)",
-                    from_profile_id, candidate_profile_id
-                )
-
-                connection = get_rabbitmq_connection()
-                channel = connection.channel()
-                channel.queue_declare(queue="notifications")
-                user1 = await conn.fetchrow(
-                    """
-                    SELECT u.telegram_id, p.nickname, p.age, p.gender, p.interests, p.city
-                    FROM Users u 
-                    JOIN Profiles p ON u.id = p.user_id 
-                    WHERE p.id = $1
-                    """,
-                    from_profile_id
-                )
-                user2 = await conn.fetchrow(
-                    """
-                    SELECT u.telegram_id, p.nickname, p.age, p.gender, p.interests, p.city
-                    FROM Users u 
-                    JOIN Profiles p ON u.id = p.user_id 
-                    WHERE p.id = $1
-                    """,
-                    candidate_profile_id
-                )
-
-                if not user1 or not user2:
-                    logger.error(f"User data not found: user1={user1}, user2={user2}")
-                    await message.answer("Ошибка при создании мэтча. Пожалуйста, попробуй снова.", reply_markup=main_menu_keyboard)
-                    connection.close()
-                    del user_state[user_id]
-                    return
-
-                user1_photos = await conn.fetch(
-                    "SELECT object_key FROM Photos WHERE user_id = (SELECT id FROM Users WHERE telegram_id = $1) ORDER BY uploaded_at DESC LIMIT 3",
-                    user1['telegram_id']
-                )
-                user2_photos = await conn.fetch(
-                    "SELECT object_key FROM Photos WHERE user_id = (SELECT id FROM Users WHERE telegram_id = $1) ORDER BY uploaded_at DESC LIMIT 3",
-                    user2['telegram_id']
-                )
-
-                user1_object_keys = [photo['object_key'] for photo in user1_photos] if user1_photos else []
-                user2_object_keys = [photo['object_key'] for photo in user2_photos] if user2_photos else []
-
-                channel.basic_publish(
-                    exchange="",
-                    routing_key="notifications",
-                    body=json.dumps({
-                        "user_info": {
-                            "to_user_id": user1['telegram_id'],
-                            "nickname": user2['nickname'],
-                            "age": user2['age'],  
-                            "gender": user2['gender'],
-                            "interests": user2['interests'],
-                            "city": user2['city']
-                        },
-                        "object_keys": user2_object_keys
-                    })
-                )
-                # Второму пользователю отправляем анкету первого
-                channel.basic_publish(
-                    exchange="",
-                    routing_key="notifications",
-                    body=json.dumps({
-                        "user_info": {
-                            "to_user_id": user2['telegram_id'],
-                            "nickname": user1['nickname'],
-                            "age": user1['age'],
-                            "gender": user1['gender'],
-                            "interests": user1['interests'],
-                            "city": user1['city']
-                        },
-                        "object_keys": user1_object_keys
-                    })
-                )
-
-                # Отправляем сообщение в очередь matchmaking для обоих пользователей
-                channel.queue_declare(queue="matchmaking")
-                channel.basic_publish(
-                    exchange="",
-                    routing_key="matchmaking",
-                    body=json.dumps({"user_id": user1['telegram_id']})
-                )
-                channel.basic_publish(
-                    exchange="",
-                    routing_key="matchmaking",
-                    body=json.dumps({"user_id": user2['telegram_id']})
-                )
-                logger.info(f"Sent matchmaking messages for users {user1['telegram_id']} and {user2['telegram_id']}")
-
-                connection.close()
-
-                await message.answer("Мэтч создан! Оба пользователя уведомлены.", reply_markup=main_menu_keyboard)
-            else:
-                await message.answer("Ты лайкнул этого пользователя. Ожидай, пока он тоже тебя лайкнет!", reply_markup=main_menu_keyboard)
-        elif response == "нет":
-            await message.answer("Пользователь пропущен. Используй /find для поиска.", reply_markup=main_menu_keyboard)
+            await message.answer("Мэтч создан! Оба пользователя уведомлены.", reply_markup=main_menu_keyboard)
         else:
-            await message.answer("Пожалуйста, ответь 'да' или 'нет'!", reply_markup=main_menu_keyboard)
-            return
+            await message.answer("Ты лайкнул этого пользователя. Ожидай, пока он тоже тебя лайкнет!", reply_markup=main_menu_keyboard)
+
+    await state.clear()
 
-    del user_state[user_id]
+async def collect_metrics():
+    return {
+        "profile_cache": await profile_cache.stats(),
+        "matchmaking_events": await coalescing_stats(redis_client, MATCHMAKING_STATS_KEY)
+    }
+
+async def log_metrics():
+    # Пишем в лог в любом режиме: в long polling это единственный способ увидеть счётчики,
+    # в webhook-режиме они доступны ещё и через /metrics
+    while True:
+        await asyncio.sleep(telegram_settings.metrics_log_interval)
+        try:
+            logger.info(f"Bot metrics: {await collect_metrics()}")
+        except Exception as e:
+            logger.warning(f"Failed to collect bot metrics: {str(e)}")
 
 async def on_startup():
-    global pool
+    global pool, skip_flusher, metrics_task
     pool = await init_db()
+    await publisher.connect()
+    skip_flusher = SkipFlusher(
+        pool, redis_client,
+        consumer=f"{socket.gethostname()}-{os.getpid()}",
+        batch_size=matchmaking_settings.skip_flush_batch_size,
+        interval_ms=matchmaking_settings.skip_flush_interval_ms,
+        claim_idle_ms=matchmaking_settings.skip_claim_idle_ms
+    )
+    await skip_flusher.start()
+    metrics_task = asyncio.create_task(log_metrics())
     logger.info("Bot started with database connection")
 
-if __name__ == "__main__":
+async def on_shutdown():
+    metrics_task.cancel()
+    # Сначала дописываем накопленные пропуски, пока пул соединений ещё открыт
+    await skip_flusher.stop()
+    await publisher.close()
+    await pool.close()
+
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+async def readyz(request):
+    # Готовность — это доступность всех зависимостей, без которых апдейт не обработать
+    try:
+        async with pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+        await redis_client.ping()
+        if publisher.connection is None or publisher.connection.is_closed:
+            raise ConnectionError("RabbitMQ connection is not open")
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {str(e)}")
+        return web.json_response({"status": "unavailable", "error": str(e)}, status=503)
+    return web.json_response({"status": "ok"})
+
+async def metrics(request):
+    return web.json_response(await collect_metrics())
+
+async def configure_webhook():
+    """
+    Регистрирует webhook в Telegram или снимает его при работе через polling.
+    С WEBHOOK_REGISTER=0 Telegram не трогается вовсе: сервер поднимается без токена и публичного адреса.
+    """
+    try:
+        if telegram_settings.webhook_url and not telegram_settings.webhook_register:
+            logger.info("Webhook registration skipped, updates are expected from a local client")
+        elif telegram_settings.webhook_url:
+            await bot.set_webhook(
+                telegram_settings.webhook_url.rstrip("/") + telegram_settings.webhook_path,
+                secret_token=telegram_settings.webhook_secret or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"Webhook set to {telegram_settings.webhook_url}{telegram_settings.webhook_path}")
+        else:
+            await bot.delete_webhook()
+    finally:
+        await bot.session.close()
+
+def run_webhook():
+    """Один воркер webhook-сервера: своё событийное кольцо, пул соединений с БД и канал RabbitMQ."""
     dp.startup.register(on_startup)
-    dp.run_polling(bot)
\ No newline at end of file
+    dp.shutdown.register(on_shutdown)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=telegram_settings.webhook_secret or None
+    ).register(app, path=telegram_settings.webhook_path)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/metrics", metrics)
+    setup_application(app, dp, bot=bot)
+
+    web.run_app(
+        app,
+        host=telegram_settings.webhook_host,
+        port=telegram_settings.webhook_port,
+        reuse_port=telegram_settings.webhook_workers > 1,
+        print=None
+    )
+
+def run_webhook_workers(count):
+    # spawn, а не fork: каждый воркер заново создаёт клиентов Redis, MinIO и сессию бота
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_webhook, name=f"webhook-{i}") for i in range(count)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {count} webhook workers on port {telegram_settings.webhook_port}")
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    # Упавший воркер останавливает весь контейнер, перезапуском займётся docker
+    multiprocessing.connection.wait([worker.sentinel for worker in workers])
+    stop_workers(None, None)
+    for worker in workers:
+        worker.join()
+    return max(abs(worker.exitcode or 0) for worker in workers)
+
+if __name__ == "__main__":
+    asyncio.run(configure_webhook())
+    if not telegram_settings.webhook_url:
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+        dp.run_polling(bot)
+    elif telegram_settings.webhook_workers > 1:
+        raise SystemExit(run_webhook_workers(telegram_settings.webhook_workers))
+    else:
+        run_webhook()